@@ -0,0 +1,349 @@
+"""
+Contains image transforms that run on whole batches after collation.
+
+Per-image torchvision transforms run once per sample on PIL images inside
+the DataLoader workers. The transforms here take a collated batch tensor of
+shape (batch, channels, height, width), usually uint8 straight from
+transforms.PILToTensor(), and process the whole batch with a handful of
+tensor ops (on whichever device the batch is on). Random transforms still
+draw their parameters independently for every image in the batch.
+
+They're torch.nn.Modules, so they compose with torch.nn.Sequential and move
+to the GPU with .to(device). For example, instead of
+  transforms.Compose([transforms.Resize((64, 64)),
+                      transforms.RandomHorizontalFlip(),
+                      transforms.TrivialAugmentWide(),
+                      transforms.ToTensor()])
+use transforms.Compose([transforms.Resize((64, 64)), transforms.PILToTensor()])
+in the DataLoader and
+  nn.Sequential(ToFloat(), RandomHorizontalFlip(), TrivialAugmentWide())
+as the train_batch_transform of engine.train().
+
+Run this file to check the deterministic transforms (and every
+TrivialAugmentWide op) against their per-image torchvision equivalents:
+  python batch_transforms.py
+"""
+from typing import List, Sequence, Tuple, Union
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+def _per_sample(values: torch.Tensor) -> torch.Tensor:
+  """Reshapes a (batch,) tensor to broadcast over (batch, C, H, W)."""
+  return values.view(-1, 1, 1, 1)
+
+
+def _grayscale(x: torch.Tensor) -> torch.Tensor:
+  """Returns the (batch, 1, H, W) luma of a float RGB batch (ITU-R 601-2)."""
+  return (0.299 * x[:, 0:1] + 0.587 * x[:, 1:2] + 0.114 * x[:, 2:3])
+
+
+def _blend(x: torch.Tensor, other: torch.Tensor, factor: torch.Tensor) -> torch.Tensor:
+  """Blends each image with other by its factor, like PIL.ImageEnhance."""
+  return (other + _per_sample(factor) * (x - other)).clamp(0, 1)
+
+
+class ToFloat(nn.Module):
+  """Converts a uint8 batch to float32 in [0, 1] (like transforms.ToTensor)."""
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    if x.dtype == torch.uint8:
+      return x.float().div_(255)
+    return x.float()
+
+
+class Normalize(nn.Module):
+  """Normalizes a float batch with per-channel mean and standard deviation.
+
+  Args:
+    mean: Per-channel means, e.g. weights.transforms().mean.
+    std: Per-channel standard deviations.
+  """
+  def __init__(self, mean: Sequence[float], std: Sequence[float]) -> None:
+    super().__init__()
+    self.register_buffer("mean", torch.tensor(mean).view(1, -1, 1, 1), persistent=False)
+    self.register_buffer("std", torch.tensor(std).view(1, -1, 1, 1), persistent=False)
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    return (x - self.mean) / self.std
+
+
+class Resize(nn.Module):
+  """Resizes a batch to (height, width) with antialiased bilinear interpolation.
+
+  Args:
+    size: Output (height, width).
+  """
+  def __init__(self, size: Tuple[int, int]) -> None:
+    super().__init__()
+    self.size = tuple(size)
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    if tuple(x.shape[-2:]) == self.size:
+      return x
+    resized = F.interpolate(x.float(), size=self.size, mode="bilinear", align_corners=False, antialias=True)
+    if x.dtype == torch.uint8:
+      return resized.round_().clamp_(0, 255).to(torch.uint8)
+    return resized
+
+
+class CenterCrop(nn.Module):
+  """Crops the center (height, width) of every image in a batch."""
+  def __init__(self, size: Tuple[int, int]) -> None:
+    super().__init__()
+    self.size = tuple(size)
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    height, width = self.size
+    top = int(round((x.shape[-2] - height) / 2.0))
+    left = int(round((x.shape[-1] - width) / 2.0))
+    return x[..., top:top + height, left:left + width]
+
+
+def crop(x: torch.Tensor, top: torch.Tensor, left: torch.Tensor, size: Tuple[int, int]) -> torch.Tensor:
+  """Crops a different (height, width) window out of every image in a batch.
+
+  Args:
+    x: A (batch, C, H, W) tensor.
+    top: A (batch,) tensor of top offsets.
+    left: A (batch,) tensor of left offsets.
+    size: The (height, width) of the crops.
+
+  Returns:
+    A (batch, C, height, width) tensor.
+  """
+  height, width = size
+  rows = top.view(-1, 1) + torch.arange(height, device=x.device) # (batch, height)
+  cols = left.view(-1, 1) + torch.arange(width, device=x.device) # (batch, width)
+  batch = torch.arange(x.shape[0], device=x.device).view(-1, 1, 1)
+  # Advanced indexing gives (batch, height, width, C)
+  return x.permute(0, 2, 3, 1)[batch, rows[:, :, None], cols[:, None, :]].permute(0, 3, 1, 2)
+
+
+class RandomCrop(nn.Module):
+  """Crops a random (height, width) window out of every image in a batch.
+
+  Args:
+    size: Output (height, width).
+    padding: Zero padding added to every side before cropping.
+  """
+  def __init__(self, size: Tuple[int, int], padding: int=0) -> None:
+    super().__init__()
+    self.size = tuple(size)
+    self.padding = padding
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    if self.padding:
+      x = F.pad(x, [self.padding] * 4)
+    batch_size, height, width = x.shape[0], x.shape[-2], x.shape[-1]
+    top = torch.randint(0, height - self.size[0] + 1, (batch_size,), device=x.device)
+    left = torch.randint(0, width - self.size[1] + 1, (batch_size,), device=x.device)
+    return crop(x, top, left, self.size)
+
+
+class RandomHorizontalFlip(nn.Module):
+  """Flips each image in a batch horizontally with probability p."""
+  def __init__(self, p: float=0.5) -> None:
+    super().__init__()
+    self.p = p
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    flip = torch.rand(x.shape[0], device=x.device) < self.p
+    return torch.where(_per_sample(flip), x.flip(-1), x)
+
+
+def _affine(x: torch.Tensor, matrices: torch.Tensor) -> torch.Tensor:
+  """Warps each image by its own 2x3 affine matrix (nearest, zero fill).
+
+  The matrices map output pixel coordinates (relative to the image center)
+  to input pixel coordinates.
+  """
+  height, width = x.shape[-2:]
+  # Convert from pixel to normalized [-1, 1] coordinates: theta = S @ M @ S^-1
+  scale = torch.tensor([2.0 / width, 2.0 / height], device=x.device, dtype=x.dtype)
+  theta = matrices.clone()
+  theta[:, :, :2] = matrices[:, :, :2] * scale.view(1, 2, 1) / scale.view(1, 1, 2)
+  theta[:, :, 2] = matrices[:, :, 2] * scale.view(1, 2)
+  grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+  return F.grid_sample(x, grid, mode="nearest", padding_mode="zeros", align_corners=False)
+
+
+def _sharpness(x: torch.Tensor, factor: torch.Tensor) -> torch.Tensor:
+  """PIL-style sharpness: blends with a 3x3 smoothed copy (borders unchanged)."""
+  kernel = torch.tensor([[1.0, 1.0, 1.0], [1.0, 5.0, 1.0], [1.0, 1.0, 1.0]], device=x.device) / 13
+  kernel = kernel.expand(x.shape[1], 1, 3, 3)
+  smoothed = x.clone()
+  smoothed[..., 1:-1, 1:-1] = F.conv2d(x, kernel, groups=x.shape[1])
+  return _blend(x, smoothed, factor)
+
+
+def _autocontrast(x: torch.Tensor) -> torch.Tensor:
+  """Stretches every channel of every image to the full [0, 1] range."""
+  low = x.amin(dim=(-2, -1), keepdim=True)
+  high = x.amax(dim=(-2, -1), keepdim=True)
+  scale = torch.where(high > low, 1.0 / (high - low), torch.ones_like(high))
+  low = torch.where(high > low, low, torch.zeros_like(low))
+  return ((x - low) * scale).clamp(0, 1)
+
+
+class TrivialAugmentWide(nn.Module):
+  """TrivialAugment (wide magnitudes) with a random op per image in a batch.
+
+  Every image gets one op picked uniformly at random and a magnitude from
+  one of num_magnitude_bins bins (with a random sign for signed ops), as in
+  transforms.TrivialAugmentWide. Each op then runs once on the sub-batch of
+  images that picked it. Works on float batches in [0, 1] (apply ToFloat
+  first). Equalize is left out because its per-image histograms don't
+  vectorize well; the other 13 ops are the same.
+  """
+  OPS = ["Identity", "ShearX", "ShearY", "TranslateX", "TranslateY", "Rotate",
+         "Brightness", "Color", "Contrast", "Sharpness", "Posterize", "Solarize",
+         "AutoContrast"]
+
+  def __init__(self, num_magnitude_bins: int=31) -> None:
+    super().__init__()
+    self.num_magnitude_bins = num_magnitude_bins
+
+  def _magnitudes(self, op: str, bins: torch.Tensor) -> torch.Tensor:
+    """Maps magnitude bins to the op's magnitudes (same ranges as torchvision)."""
+    fraction = bins.float() / (self.num_magnitude_bins - 1)
+    if op in ("ShearX", "ShearY", "Brightness", "Color", "Contrast", "Sharpness"):
+      return 0.99 * fraction
+    if op in ("TranslateX", "TranslateY"):
+      return 32.0 * fraction
+    if op == "Rotate":
+      return 135.0 * fraction
+    if op == "Posterize":
+      return 8 - (bins.float() / ((self.num_magnitude_bins - 1) / 6)).round()
+    if op == "Solarize":
+      return 1.0 - fraction
+    return torch.zeros_like(fraction)
+
+  def _apply_op(self, op: str, x: torch.Tensor, magnitude: torch.Tensor) -> torch.Tensor:
+    """Applies op to every image with its own magnitude, like torchvision's autoaugment._apply_op."""
+    if op in ("ShearX", "ShearY", "TranslateX", "TranslateY", "Rotate"):
+      height, width = x.shape[-2:]
+      matrices = torch.zeros(x.shape[0], 2, 3, device=x.device, dtype=x.dtype)
+      matrices[:, 0, 0] = matrices[:, 1, 1] = 1
+      # Shears pivot on the top-left corner and translations are whole pixels (truncated), as in torchvision
+      if op == "ShearX":
+        matrices[:, 0, 1] = magnitude
+        matrices[:, 0, 2] = magnitude * height / 2
+      elif op == "ShearY":
+        matrices[:, 1, 0] = magnitude
+        matrices[:, 1, 2] = magnitude * width / 2
+      elif op == "TranslateX":
+        matrices[:, 0, 2] = -magnitude.trunc()
+      elif op == "TranslateY":
+        matrices[:, 1, 2] = -magnitude.trunc()
+      else:
+        angle = torch.deg2rad(magnitude)
+        matrices[:, 0, 0], matrices[:, 0, 1] = torch.cos(angle), -torch.sin(angle)
+        matrices[:, 1, 0], matrices[:, 1, 1] = torch.sin(angle), torch.cos(angle)
+      return _affine(x, matrices)
+    if op == "Brightness":
+      return _blend(x, torch.zeros_like(x), 1 + magnitude)
+    if op == "Color":
+      return _blend(x, _grayscale(x), 1 + magnitude)
+    if op == "Contrast":
+      mean = _grayscale(x).mean(dim=(-3, -2, -1), keepdim=True)
+      return _blend(x, mean, 1 + magnitude)
+    if op == "Sharpness":
+      return _sharpness(x, 1 + magnitude)
+    if op == "Posterize":
+      mask = (0xFF << (8 - magnitude.long())) & 0xFF
+      return ((x * 255).round().to(torch.long) & _per_sample(mask)).float() / 255
+    if op == "Solarize":
+      return torch.where(x >= _per_sample(magnitude), 1.0 - x, x)
+    if op == "AutoContrast":
+      return _autocontrast(x)
+    return x
+
+  def forward(self, x: torch.Tensor) -> torch.Tensor:
+    batch_size = x.shape[0]
+    ops = torch.randint(0, len(self.OPS), (batch_size,), device=x.device)
+    bins = torch.randint(0, self.num_magnitude_bins, (batch_size,), device=x.device)
+    signs = torch.where(torch.rand(batch_size, device=x.device) < 0.5, -1.0, 1.0)
+
+    out = x.clone()
+    for op_index, op in enumerate(self.OPS):
+      selected = (ops == op_index).nonzero().flatten()
+      if op == "Identity" or len(selected) == 0:
+        continue
+      magnitude = self._magnitudes(op, bins[selected])
+      if op in ("ShearX", "ShearY", "TranslateX", "TranslateY", "Rotate",
+                "Brightness", "Color", "Contrast", "Sharpness"):
+        magnitude = magnitude * signs[selected]
+      out[selected] = self._apply_op(op, x[selected], magnitude.to(x.dtype))
+    return out
+
+
+def _check_parity(num_images: int=16, seed: int=42) -> List[Tuple[str, float]]:
+  """Checks the batch transforms against per-image torchvision transforms.
+
+  Raises AssertionError if any differs from its torchvision equivalent by
+  more than its tolerance (on a 0-1 scale), otherwise returns a list of
+  (transform name, max absolute difference).
+  """
+  from PIL import Image
+  from torchvision import transforms
+  from torchvision.transforms import autoaugment
+
+  torch.manual_seed(seed)
+  images = torch.randint(0, 256, (num_images, 3, 96, 128), dtype=torch.uint8)
+  pil_images = [Image.fromarray(image.permute(1, 2, 0).numpy()) for image in images]
+  mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+
+  def per_image(transform: Union[nn.Module, transforms.Compose]) -> torch.Tensor:
+    return torch.stack([transform(image) for image in pil_images])
+
+  # (name, batched output, torchvision output, tolerance)
+  checks = [
+    ("ToFloat", ToFloat()(images), per_image(transforms.ToTensor()), 1e-6),
+    ("Normalize", Normalize(mean, std)(ToFloat()(images)),
+     per_image(transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean, std)])), 1e-5),
+    ("CenterCrop", ToFloat()(CenterCrop((64, 64))(images)),
+     per_image(transforms.Compose([transforms.CenterCrop((64, 64)), transforms.ToTensor()])), 1e-6),
+    ("RandomHorizontalFlip(p=1)", ToFloat()(RandomHorizontalFlip(p=1.0)(images)),
+     per_image(transforms.Compose([transforms.RandomHorizontalFlip(p=1.0), transforms.ToTensor()])), 1e-6),
+    # PIL resizes in fixed point, so values can be off by one step of 255
+    ("Resize", ToFloat()(Resize((64, 64))(images)),
+     per_image(transforms.Compose([transforms.Resize((64, 64)), transforms.ToTensor()])), 1.5 / 255),
+  ]
+  tops, lefts = torch.randint(0, 32, (num_images,)), torch.randint(0, 64, (num_images,))
+  checks.append(("crop", ToFloat()(crop(images, tops, lefts, (64, 64))),
+                 torch.stack([transforms.ToTensor()(transforms.functional.crop(image, int(top), int(left), 64, 64))
+                              for image, top, left in zip(pil_images, tops, lefts)]), 1e-6))
+
+  # TrivialAugmentWide ops (both signs, fractional translations) against torchvision's own _apply_op,
+  # which the geometric ops match exactly
+  floats = ToFloat()(images)
+  trivial_augment = TrivialAugmentWide()
+  op_magnitudes = [("ShearX", 0.3), ("ShearX", -0.5), ("ShearY", 0.3), ("ShearY", -0.5),
+                   ("TranslateX", 8.7), ("TranslateX", -8.7), ("TranslateY", 5.5), ("TranslateY", -5.5),
+                   ("Rotate", 30.0), ("Rotate", -30.0), ("Brightness", 0.5), ("Color", 0.5),
+                   ("Contrast", -0.5), ("Sharpness", 0.5), ("Posterize", 4.0), ("Solarize", 0.5),
+                   ("AutoContrast", 0.0)]
+  for op, magnitude in op_magnitudes:
+    if op == "Posterize": # torchvision only posterizes uint8 images
+      reference = torch.stack([autoaugment._apply_op(image, op, magnitude, transforms.InterpolationMode.NEAREST, None)
+                               for image in images]).float() / 255
+    else:
+      reference = torch.stack([autoaugment._apply_op(image, op, magnitude, transforms.InterpolationMode.NEAREST, None)
+                               for image in floats])
+    checks.append((f"TrivialAugmentWide {op}({magnitude:g})",
+                   trivial_augment._apply_op(op, floats, torch.full((num_images,), magnitude)),
+                   reference, 1e-4)) # torchvision's grayscale weights are rounded slightly differently
+
+  differences = []
+  for name, batched, reference, tolerance in checks:
+    difference = (batched - reference).abs().max().item()
+    assert difference <= tolerance, f"{name} differs from torchvision by {difference:.4f} (tolerance {tolerance:g})"
+    differences.append((name, difference))
+  return differences
+
+
+if __name__ == "__main__":
+  for name, difference in _check_parity():
+    print(f"{name:<32} max abs difference: {difference:.4f}")
@@ -0,0 +1,85 @@
+"""
+Benchmarks fp32 against bfloat16 autocast training with engine.py.
+
+Trains the same model from the same starting weights once in fp32 and once
+with use_amp=True, then reports training throughput and final test accuracy
+for both runs side by side.
+
+Example usage:
+  python benchmark_amp.py --model effnetb2 --epochs 3 --batch_size 32
+"""
+import argparse
+import json
+import time
+
+import torch
+import data_setup, engine, model_builder
+
+parser = argparse.ArgumentParser(description="Compare fp32 and bf16 autocast training.")
+parser.add_argument("--model", default="tinyvgg", choices=["tinyvgg", "effnetb2", "vit"])
+parser.add_argument("--train_dir", default="data/pizza_steak_sushi/train")
+parser.add_argument("--test_dir", default="data/pizza_steak_sushi/test")
+parser.add_argument("--epochs", type=int, default=3)
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--num_workers", type=int, default=data_setup.NUM_WORKERS)
+parser.add_argument("--learning_rate", type=float, default=0.001)
+parser.add_argument("--output", default=None, help="Optional path to write the results as JSON.")
+args = parser.parse_args()
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def run(use_amp: bool):
+  """Trains a fresh model and returns its throughput and final accuracy."""
+  torch.manual_seed(42)
+  model, transform = model_builder.create_model(args.model)
+  train_dataloader, test_dataloader, class_names = data_setup.create_dataloaders(
+      train_dir=args.train_dir,
+      test_dir=args.test_dir,
+      transform=transform,
+      batch_size=args.batch_size,
+      num_workers=args.num_workers
+  )
+  model.to(device)
+  loss_fn = torch.nn.CrossEntropyLoss()
+  optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad],
+                               lr=args.learning_rate)
+
+  train_time = 0.0
+  for epoch in range(args.epochs):
+    start_time = time.perf_counter()
+    train_loss, train_acc = engine.train_step(model=model,
+                                              dataloader=train_dataloader,
+                                              loss_fn=loss_fn,
+                                              optimizer=optimizer,
+                                              device=device,
+                                              use_amp=use_amp)
+    train_time += time.perf_counter() - start_time
+  test_loss, test_acc = engine.test_step(model=model,
+                                         dataloader=test_dataloader,
+                                         loss_fn=loss_fn,
+                                         device=device,
+                                         use_amp=use_amp)
+
+  num_samples = len(train_dataloader.dataset) * args.epochs
+  return {"precision": "bf16" if use_amp else "fp32",
+          "train_samples_per_sec": num_samples / train_time,
+          "train_loss": train_loss,
+          "train_acc": train_acc,
+          "test_loss": test_loss,
+          "test_acc": test_acc}
+
+
+results = [run(use_amp=False), run(use_amp=True)]
+
+print(f"{'precision':<10}{'samples/sec':>14}{'train_acc':>12}{'test_acc':>12}")
+for result in results:
+  print(f"{result['precision']:<10}"
+        f"{result['train_samples_per_sec']:>14.1f}"
+        f"{result['train_acc']:>12.4f}"
+        f"{result['test_acc']:>12.4f}")
+print(f"bf16 speedup: {results[1]['train_samples_per_sec'] / results[0]['train_samples_per_sec']:.2f}x")
+
+if args.output:
+  with open(args.output, "w") as f:
+    json.dump({"model": args.model, "device": device, "results": results}, f, indent=2)
@@ -0,0 +1,111 @@
+"""
+Benchmarks aspect-ratio bucketed batching against fixed-square batching.
+
+Runs inference over an ImageFolder style directory with three pipelines:
+  square:   Resize + CenterCrop to --image_size x --image_size (the
+            deployment transforms), which crops off the sides of
+            non-square images.
+  bucketed: ResizeToArea(--image_size**2) keeping every image's aspect
+            ratio, batched by AspectRatioBatchSampler and padded to a
+            common size per batch with pad_collate.
+  padded:   the same variable-size images batched in file order (no
+            buckets), to show the padding bucketing saves.
+
+Reports images/sec, the average fraction of each image cropped away and
+the fraction of batch pixels that are padding.
+
+Example usage:
+  python benchmark_bucketing.py --data_dir data/pizza_steak_sushi/test --model effnetb2
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+
+from functools import partial
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+import data_setup, model_builder
+
+parser = argparse.ArgumentParser(description="Compare bucketed and fixed-square batching throughput.")
+parser.add_argument("--data_dir", required=True, help="ImageFolder style directory to predict on.")
+parser.add_argument("--model", default="effnetb2", choices=["effnetb2"],
+                    help="A model that accepts any input size (TinyVGG only takes 64x64 images and ViT 224x224).")
+parser.add_argument("--image_size", type=int, default=288)
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--num_buckets", type=int, default=8)
+parser.add_argument("--num_workers", type=int, default=0)
+parser.add_argument("--output", default=None, help="Optional path to write the results as JSON.")
+args = parser.parse_args()
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+size = args.image_size
+normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+resize_to_area = data_setup.ResizeToArea(size * size)
+pipelines = {
+  "square": transforms.Compose([transforms.Resize(size), transforms.CenterCrop(size), transforms.ToTensor(), normalize]),
+  "bucketed": transforms.Compose([resize_to_area, transforms.ToTensor(), normalize]),
+  "padded": transforms.Compose([resize_to_area, transforms.ToTensor(), normalize]),
+}
+
+model, _ = model_builder.create_model(args.model)
+model = model.to(device).eval()
+sizes = data_setup.ImageFolderCustom(args.data_dir, fast_decode=False).image_sizes()
+widths, heights = sizes[:, 0].astype(np.float64), sizes[:, 1].astype(np.float64)
+
+results = []
+for name, transform in pipelines.items():
+  dataset = data_setup.ImageFolderCustom(args.data_dir, transform=transform, fast_decode=False)
+  collate_fn = partial(data_setup.pad_collate, pad_to_multiple=32)
+  if name == "square":
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+    batches = [list(range(start, min(start + args.batch_size, len(dataset))))
+               for start in range(0, len(dataset), args.batch_size)]
+    resized = np.full((len(dataset), 2), size)
+    cropped = 1 - np.minimum(widths, heights) ** 2 / (widths * heights)
+  else:
+    if name == "bucketed":
+      batch_sampler = data_setup.AspectRatioBatchSampler(sizes, args.batch_size, num_buckets=args.num_buckets, shuffle=False)
+    else:
+      batch_sampler = torch.utils.data.BatchSampler(range(len(dataset)), args.batch_size, drop_last=False)
+    dataloader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, num_workers=args.num_workers)
+    batches = list(batch_sampler)
+    resized = np.array([resize_to_area.get_size(int(w), int(h)) for w, h in sizes])
+    cropped = np.zeros(len(dataset))
+
+  # Fraction of the pixels in each (padded) batch that are padding
+  real_pixels = padded_pixels = 0
+  for batch in batches:
+    batch_height = -(-resized[batch, 0].max() // 32) * 32
+    batch_width = -(-resized[batch, 1].max() // 32) * 32
+    real_pixels += int((resized[batch, 0] * resized[batch, 1]).sum())
+    padded_pixels += len(batch) * int(batch_height) * int(batch_width)
+
+  # Time loading + inference over the whole directory (after one warm-up batch)
+  with torch.inference_mode():
+    model(next(iter(dataloader))[0].to(device))
+    if device == "cuda":
+      torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for X, _ in dataloader:
+      model(X.to(device))
+    if device == "cuda":
+      torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start_time
+
+  results.append({"pipeline": name,
+                  "images_per_sec": len(dataset) / elapsed,
+                  "cropped_fraction": float(cropped.mean()),
+                  "padding_fraction": 1 - real_pixels / padded_pixels})
+
+print(f"{'pipeline':<10}{'images/sec':>12}{'cropped':>10}{'padding':>10}")
+for result in results:
+  print(f"{result['pipeline']:<10}{result['images_per_sec']:>12.1f}"
+        f"{result['cropped_fraction']:>10.1%}{result['padding_fraction']:>10.1%}")
+
+if args.output:
+  with open(args.output, "w") as f:
+    json.dump({"device": device, "model": args.model, "results": results}, f, indent=2)
@@ -0,0 +1,84 @@
+"""
+Benchmarks the NCHW (contiguous) and NHWC (channels_last) memory formats.
+
+For each model and batch size, times inference and training steps on
+random inputs at the model's training resolution (64x64 for TinyVGG,
+288x288 for EffNetB2) in both memory formats and reports samples/sec.
+
+Example usage:
+  python benchmark_channels_last.py --models tinyvgg effnetb2 --batch_sizes 1 32
+"""
+import argparse
+import json
+import time
+
+import torch
+import model_builder
+
+IMAGE_SIZES = {"tinyvgg": 64, "effnetb2": 288}
+
+parser = argparse.ArgumentParser(description="Compare NCHW and NHWC samples/sec.")
+parser.add_argument("--models", nargs="+", default=["tinyvgg", "effnetb2"], choices=list(IMAGE_SIZES))
+parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 32])
+parser.add_argument("--steps", type=int, default=20, help="Timed steps per measurement.")
+parser.add_argument("--warmup_steps", type=int, default=3)
+parser.add_argument("--output", default=None, help="Optional path to write the results as JSON.")
+args = parser.parse_args()
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def time_steps(step_fn) -> float:
+  """Returns the average seconds per call of step_fn after warming up."""
+  for _ in range(args.warmup_steps):
+    step_fn()
+  if device == "cuda":
+    torch.cuda.synchronize()
+  start_time = time.perf_counter()
+  for _ in range(args.steps):
+    step_fn()
+  if device == "cuda":
+    torch.cuda.synchronize()
+  return (time.perf_counter() - start_time) / args.steps
+
+
+results = []
+for model_name in args.models:
+  for batch_size in args.batch_sizes:
+    for memory_format in (torch.contiguous_format, torch.channels_last):
+      torch.manual_seed(42)
+      model, _ = model_builder.create_model(model_name)
+      model = model.to(device, memory_format=memory_format)
+      loss_fn = torch.nn.CrossEntropyLoss()
+      optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=0.001)
+      size = IMAGE_SIZES[model_name]
+      X = torch.randn(batch_size, 3, size, size, device=device).to(memory_format=memory_format)
+      y = torch.randint(0, 3, (batch_size,), device=device)
+
+      def inference_step():
+        with torch.inference_mode():
+          model(X)
+
+      def train_step():
+        optimizer.zero_grad()
+        loss_fn(model(X), y).backward()
+        optimizer.step()
+
+      model.eval()
+      inference_time = time_steps(inference_step)
+      model.train()
+      train_time = time_steps(train_step)
+      results.append({"model": model_name,
+                      "batch_size": batch_size,
+                      "memory_format": "NHWC" if memory_format == torch.channels_last else "NCHW",
+                      "inference_samples_per_sec": batch_size / inference_time,
+                      "train_samples_per_sec": batch_size / train_time})
+
+print(f"{'model':<10}{'batch':>6}{'format':>8}{'inference/sec':>15}{'train/sec':>11}")
+for result in results:
+  print(f"{result['model']:<10}{result['batch_size']:>6}{result['memory_format']:>8}"
+        f"{result['inference_samples_per_sec']:>15.1f}{result['train_samples_per_sec']:>11.1f}")
+
+if args.output:
+  with open(args.output, "w") as f:
+    json.dump({"device": device, "results": results}, f, indent=2)
@@ -0,0 +1,172 @@
+"""
+Benchmarks every stage of the input pipeline on an ImageFolder directory.
+
+Measures images/sec of:
+  scan:      listing the class folders (find_classes) and every image
+             (a fresh FileIndex scan, then loading the saved index),
+  read:      reading the image files' bytes,
+  decode:    decoding them to RGB PIL images (optionally in draft mode),
+  transform: each transform of the pipeline on its own,
+  collate:   stacking transformed images into batches (per batch size),
+  transfer:  sending ready-made batches from DataLoader workers to the
+             main process (per num_workers and batch size),
+  end to end: a DataLoader over ImageFolderCustom (per num_workers and
+             batch size).
+
+Comparing the stages with the model's training speed (see
+engine.measure_step_time) shows whether loading is the bottleneck, and
+which part of it.
+
+Example usage:
+  python benchmark_dataloading.py --data_dir data/pizza_steak_sushi/train \
+    --num_workers 0 2 4 8 --batch_sizes 32 128 --output dataloading.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+
+import torch
+import data_setup
+
+from torch.utils.data import DataLoader, Dataset, default_collate
+from torchvision import transforms
+
+
+class _ConstantDataset(Dataset):
+  """Returns the same ready-made (image, label) sample, so loading it costs nothing."""
+  def __init__(self, image: torch.Tensor, length: int) -> None:
+    self.image = image
+    self.length = length
+
+  def __len__(self) -> int:
+    return self.length
+
+  def __getitem__(self, index: int):
+    return self.image, 0
+
+
+def time_dataloader(dataset: Dataset, batch_size: int, num_workers: int, num_batches: int) -> float:
+  """Returns images/sec of a DataLoader after its first batch (worker start-up)."""
+  dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                          pin_memory=torch.cuda.is_available())
+  iterator = iter(dataloader)
+  num_batches = min(num_batches, len(dataloader) - 1)
+  next(iterator)
+  start_time = time.perf_counter()
+  num_images = sum(len(next(iterator)[1]) for _ in range(num_batches))
+  elapsed = time.perf_counter() - start_time
+  del iterator # shuts the workers down
+  return num_images / elapsed if num_images else float("nan")
+
+
+parser = argparse.ArgumentParser(description="Measure images/sec of every input pipeline stage.")
+parser.add_argument("--data_dir", default="data/pizza_steak_sushi/train", help="ImageFolder style directory.")
+parser.add_argument("--image_size", type=int, default=224)
+parser.add_argument("--augment", action="store_true", help="Add TrivialAugmentWide to the transforms.")
+parser.add_argument("--fast_decode", action="store_true", help="Decode JPEGs in draft mode (see data_setup.load_image).")
+parser.add_argument("--num_samples", type=int, default=200, help="Images to time the per-image stages on.")
+parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 2, 4])
+parser.add_argument("--batch_sizes", type=int, nargs="+", default=[32, 128])
+parser.add_argument("--num_batches", type=int, default=10, help="Batches to time per DataLoader setting.")
+parser.add_argument("--output", default=None, help="Optional path to write the results as JSON.")
+args = parser.parse_args()
+
+transform_list = [transforms.Resize((args.image_size, args.image_size))]
+if args.augment:
+  transform_list.append(transforms.TrivialAugmentWide())
+transform_list += [transforms.ToTensor(), transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])]
+data_transform = transforms.Compose(transform_list)
+results = {"machine": {"platform": platform.platform(), "cpu_count": os.cpu_count(), "torch": torch.__version__},
+           "settings": vars(args)}
+
+# 1. Scanning the directory (into a temporary index, so the cached one isn't touched)
+start_time = time.perf_counter()
+classes, _ = data_setup.find_classes(args.data_dir)
+find_classes_time = time.perf_counter() - start_time
+with tempfile.TemporaryDirectory() as tmp_dir:
+  index_path = os.path.join(tmp_dir, "index.npz")
+  start_time = time.perf_counter()
+  index = data_setup.FileIndex(args.data_dir, index_path=index_path)
+  scan_time = time.perf_counter() - start_time
+  start_time = time.perf_counter()
+  data_setup.FileIndex(args.data_dir, index_path=index_path)
+  load_index_time = time.perf_counter() - start_time
+results["scan"] = {"num_images": len(index),
+                   "find_classes_sec": find_classes_time,
+                   "scan_images_per_sec": len(index) / scan_time,
+                   "saved_index_images_per_sec": len(index) / load_index_time}
+
+# 2. Per-image stages on a random sample of images (read -> decode -> each transform)
+paths = [index.path(i) for i in random.Random(42).sample(range(len(index)), min(args.num_samples, len(index)))]
+draft_size = data_setup.get_draft_size(data_transform) if args.fast_decode else None
+stage_times = {"read": 0.0, "decode": 0.0, **{repr(t): 0.0 for t in transform_list}}
+num_bytes, images = 0, []
+for path in paths:
+  start_time = time.perf_counter()
+  with open(path, "rb") as f:
+    data = f.read()
+  stage_times["read"] += time.perf_counter() - start_time
+  num_bytes += len(data)
+
+  start_time = time.perf_counter()
+  image = data_setup.load_image(io.BytesIO(data), draft_size)
+  stage_times["decode"] += time.perf_counter() - start_time
+
+  for t in transform_list:
+    start_time = time.perf_counter()
+    image = t(image)
+    stage_times[repr(t)] += time.perf_counter() - start_time
+  images.append(image)
+results["stages"] = [{"stage": stage, "images_per_sec": len(paths) / seconds} for stage, seconds in stage_times.items()]
+results["stages"][0]["mb_per_sec"] = num_bytes / 1e6 / stage_times["read"]
+per_image_time = sum(stage_times.values()) / len(paths)
+
+# 3. Collating transformed images into batches
+results["collate"] = []
+for batch_size in args.batch_sizes:
+  batch = [(images[i % len(images)], 0) for i in range(batch_size)]
+  start_time = time.perf_counter()
+  for _ in range(5):
+    default_collate(batch)
+  results["collate"].append({"batch_size": batch_size,
+                             "images_per_sec": 5 * batch_size / (time.perf_counter() - start_time)})
+
+# 4. Worker -> main process transfer of ready-made batches, and 5. the whole pipeline
+results["transfer"], results["end_to_end"] = [], []
+dataset = data_setup.ImageFolderCustom(args.data_dir, transform=data_transform, fast_decode=args.fast_decode)
+for num_workers in args.num_workers:
+  for batch_size in args.batch_sizes:
+    if num_workers > 0:
+      constant_dataset = _ConstantDataset(images[0], batch_size * (args.num_batches + 1))
+      results["transfer"].append({"num_workers": num_workers,
+                                  "batch_size": batch_size,
+                                  "images_per_sec": time_dataloader(constant_dataset, batch_size, num_workers, args.num_batches)})
+    results["end_to_end"].append({"num_workers": num_workers,
+                                  "batch_size": batch_size,
+                                  "images_per_sec": time_dataloader(dataset, batch_size, num_workers, args.num_batches)})
+
+# Print the report
+print(f"[INFO] {len(index)} images in {len(classes)} classes | find_classes: {find_classes_time * 1000:.1f}ms | "
+      f"scan: {results['scan']['scan_images_per_sec']:.0f} images/sec | "
+      f"saved index: {results['scan']['saved_index_images_per_sec']:.0f} images/sec")
+print(f"{'stage':<60}{'images/sec':>12}")
+for stage in results["stages"]:
+  print(f"{stage['stage'][:58]:<60}{stage['images_per_sec']:>12.1f}")
+print(f"{'(all per-image stages, one process)':<60}{1 / per_image_time:>12.1f}")
+for stage in results["collate"]:
+  print(f"{'collate (batch_size=' + str(stage['batch_size']) + ')':<60}{stage['images_per_sec']:>12.1f}")
+print(f"\n{'num_workers':>12}{'batch_size':>12}{'transfer':>12}{'end to end':>12}  (images/sec)")
+for end_to_end in results["end_to_end"]:
+  transfer = next((r["images_per_sec"] for r in results["transfer"]
+                   if r["num_workers"] == end_to_end["num_workers"] and r["batch_size"] == end_to_end["batch_size"]), None)
+  print(f"{end_to_end['num_workers']:>12}{end_to_end['batch_size']:>12}"
+        f"{(f'{transfer:.1f}' if transfer else '-'):>12}{end_to_end['images_per_sec']:>12.1f}")
+
+if args.output:
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=2)
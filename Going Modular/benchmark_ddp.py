@@ -0,0 +1,94 @@
+"""
+Benchmarks DistributedDataParallel training throughput for 1, 2, 4 and 8
+processes on one machine (gloo on CPU, NCCL on GPUs).
+
+Each run spawns the processes with ddp.spawn(), trains one warm-up epoch
+and then times the remaining epochs. Reports global samples/sec, speedup
+over one process and scaling efficiency (speedup / processes).
+
+Example usage:
+  python benchmark_ddp.py --model tinyvgg --processes 1 2 4 8 --epochs 3
+"""
+import argparse
+import json
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import data_setup, ddp, engine, model_builder
+
+
+def worker(args: argparse.Namespace, world_size: int, result_queue):
+  """Trains for args.epochs (+1 warm-up) epochs and reports rank 0's timings."""
+  device = ddp.setup()
+  torch.manual_seed(42)
+  model, transform = model_builder.create_model(args.model)
+  train_dataloader, _, _ = data_setup.create_dataloaders(
+      train_dir=args.train_dir,
+      test_dir=args.test_dir,
+      transform=transform,
+      batch_size=args.batch_size,
+      num_workers=args.num_workers,
+      distributed=True
+  )
+  model = torch.nn.parallel.DistributedDataParallel(model.to(device))
+  loss_fn = torch.nn.CrossEntropyLoss()
+  optimizer = torch.optim.Adam([p for p in model.parameters() if p.requires_grad], lr=0.001)
+
+  epoch_times = []
+  for epoch in range(args.epochs + 1):
+    train_dataloader.sampler.set_epoch(epoch)
+    dist.barrier()
+    start_time = time.perf_counter()
+    engine.train_step(model=model,
+                      dataloader=train_dataloader,
+                      loss_fn=loss_fn,
+                      optimizer=optimizer,
+                      device=device)
+    dist.barrier()
+    if epoch > 0: # skip the warm-up epoch
+      epoch_times.append(time.perf_counter() - start_time)
+
+  if ddp.is_main_process():
+    samples_per_epoch = len(train_dataloader.sampler) * world_size
+    result_queue.put({"processes": world_size,
+                      "threads_per_process": torch.get_num_threads(),
+                      "epoch_time": sum(epoch_times) / len(epoch_times),
+                      "samples_per_sec": samples_per_epoch * len(epoch_times) / sum(epoch_times)})
+  ddp.cleanup()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Benchmark DDP scaling over processes.")
+  parser.add_argument("--model", default="tinyvgg", choices=["tinyvgg", "effnetb2", "vit"])
+  parser.add_argument("--train_dir", default="data/pizza_steak_sushi/train")
+  parser.add_argument("--test_dir", default="data/pizza_steak_sushi/test")
+  parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+  parser.add_argument("--epochs", type=int, default=3, help="Timed epochs (after one warm-up epoch).")
+  parser.add_argument("--batch_size", type=int, default=32, help="Batch size per process.")
+  parser.add_argument("--num_workers", type=int, default=1, help="DataLoader workers per process.")
+  parser.add_argument("--output", default=None, help="Optional path to write the results as JSON.")
+  args = parser.parse_args()
+
+  result_queue = mp.get_context("spawn").SimpleQueue()
+  results = []
+  for world_size in args.processes:
+    ddp.spawn(worker, world_size, args, world_size, result_queue)
+    results.append(result_queue.get())
+
+  baseline = results[0]["samples_per_sec"] / results[0]["processes"]
+  print(f"[INFO] {os.cpu_count()} CPUs, model: {args.model}, batch size per process: {args.batch_size}")
+  print(f"{'processes':>10}{'threads':>9}{'epoch_time':>12}{'samples/sec':>14}{'speedup':>10}{'efficiency':>12}")
+  for result in results:
+    speedup = result["samples_per_sec"] / baseline
+    result["speedup"] = speedup
+    result["efficiency"] = speedup / result["processes"]
+    print(f"{result['processes']:>10}{result['threads_per_process']:>9}"
+          f"{result['epoch_time']:>11.2f}s{result['samples_per_sec']:>14.1f}"
+          f"{speedup:>9.2f}x{result['efficiency']:>12.2f}")
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump({"model": args.model, "batch_size": args.batch_size, "results": results}, f, indent=2)
@@ -0,0 +1,81 @@
+"""
+Benchmarks training with and without data_setup.DevicePrefetcher.
+
+Uses deliberately expensive per-image transforms (a large resize and a
+Gaussian blur before the usual resize) so loading a batch costs about as
+much as training on it, then times TinyVGG training epochs for each
+num_workers setting with and without background prefetching.
+
+Example usage:
+  python benchmark_prefetch.py --num_workers 0 2 4 --prefetch_batches 4
+"""
+import argparse
+import json
+import time
+
+import torch
+import data_setup, engine, model_builder
+
+from torchvision import transforms
+
+parser = argparse.ArgumentParser(description="Measure the overlap gain of DevicePrefetcher.")
+parser.add_argument("--train_dir", default="data/pizza_steak_sushi/train")
+parser.add_argument("--test_dir", default="data/pizza_steak_sushi/test")
+parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 2])
+parser.add_argument("--prefetch_batches", type=int, default=4)
+parser.add_argument("--blur_kernel", type=int, default=15, help="Odd Gaussian blur kernel size (bigger = more expensive transforms).")
+parser.add_argument("--epochs", type=int, default=2)
+parser.add_argument("--batch_size", type=int, default=32)
+parser.add_argument("--output", default=None, help="Optional path to write the results as JSON.")
+args = parser.parse_args()
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+# Expensive transforms
+data_transform = transforms.Compose([
+  transforms.Resize((256, 256)),
+  transforms.GaussianBlur(kernel_size=args.blur_kernel),
+  transforms.Resize((64, 64)),
+  transforms.ToTensor()
+])
+
+results = []
+for num_workers in args.num_workers:
+  for prefetch_batches in (0, args.prefetch_batches):
+    train_dataloader, _, class_names = data_setup.create_dataloaders(
+        train_dir=args.train_dir,
+        test_dir=args.test_dir,
+        transform=data_transform,
+        batch_size=args.batch_size,
+        num_workers=num_workers
+    )
+    if prefetch_batches:
+      train_dataloader = data_setup.DevicePrefetcher(train_dataloader, device, prefetch_batches)
+
+    torch.manual_seed(42)
+    model = model_builder.TinyVGG(input_shape=3, hidden_units=10, output_shape=len(class_names)).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
+
+    start_time = time.perf_counter()
+    for epoch in range(args.epochs):
+      engine.train_step(model=model,
+                        dataloader=train_dataloader,
+                        loss_fn=torch.nn.CrossEntropyLoss(),
+                        optimizer=optimizer,
+                        device=device)
+    train_time = time.perf_counter() - start_time
+
+    results.append({"num_workers": num_workers,
+                    "prefetch_batches": prefetch_batches,
+                    "samples_per_sec": len(train_dataloader.dataset) * args.epochs / train_time})
+
+print(f"{'num_workers':>12}{'prefetch':>10}{'samples/sec':>14}{'gain':>8}")
+for result in results:
+  baseline = next(r for r in results if r["num_workers"] == result["num_workers"] and r["prefetch_batches"] == 0)
+  result["gain"] = result["samples_per_sec"] / baseline["samples_per_sec"]
+  print(f"{result['num_workers']:>12}{result['prefetch_batches']:>10}"
+        f"{result['samples_per_sec']:>14.1f}{result['gain']:>7.2f}x")
+
+if args.output:
+  with open(args.output, "w") as f:
+    json.dump({"device": device, "blur_kernel": args.blur_kernel, "results": results}, f, indent=2)
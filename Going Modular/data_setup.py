@@ -2,19 +2,1461 @@
 Contains functionality for creating PyTorch DataLoaders for
 image classification data.
 """
+import hashlib
+import io
+import json
+import math
+import multiprocessing
 import os
+import platform
+import queue
+import random
+import shutil
+import tarfile
+import threading
+import time
 
+import numpy as np
+import torch
+import ddp
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from PIL import Image
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Sized, Tuple, Union
 from torchvision import datasets, transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, get_worker_info
+from torch.utils.data.distributed import DistributedSampler
 
 NUM_WORKERS = os.cpu_count()
+TUNING_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "going_modular", "dataloader_tuning.json")
+FILE_INDEX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "going_modular", "file_index")
+
+
+def find_classes(directory: str) -> Tuple[List[str], Dict[str, int]]:
+  """Finds the class folder names in a target directory.
+
+  Assumes target directory is in standard image classification format.
+
+  Args:
+    directory: Target directory to load class names from.
+
+  Returns:
+    A tuple of (list_of_class_names, dict(class_name: idx...)). For example:
+      find_classes("food_images/train")
+      >>> (["class_1", "class_2"], {"class_1": 0, ...})
+  """
+  classes = sorted(entry.name for entry in os.scandir(directory) if entry.is_dir())
+  if not classes:
+    raise FileNotFoundError(f"Could not find any classes in {directory}... Please check file structure")
+  class_to_idx = {class_name: i for i, class_name in enumerate(classes)}
+  return classes, class_to_idx
+
+
+def _scan_class_dir(class_dir: str, extensions: Tuple[str, ...]) -> Tuple[List[str], List[Tuple[str, int]]]:
+  """Recursively lists the image files under class_dir with os.scandir.
+
+  Returns a tuple of (sorted file paths, [(directory, mtime_ns), ...]).
+  """
+  files, directories, stack = [], [], [class_dir]
+  while stack:
+    directory = stack.pop()
+    directories.append((directory, os.stat(directory).st_mtime_ns))
+    with os.scandir(directory) as entries:
+      for entry in entries:
+        if entry.is_dir():
+          stack.append(entry.path)
+        elif entry.name.lower().endswith(extensions):
+          files.append(entry.path)
+  return sorted(files), directories
+
+
+class FileIndex:
+  """A compact, persistent index of the images in an ImageFolder style directory.
+
+  The class directories are scanned in parallel with os.scandir (in
+  subdirectories too) for files with any of extensions. Instead of a list
+  of path objects the paths are stored relative to root in one byte array
+  plus an array of offsets, and the labels in an int32 array. Pickling the
+  index into DataLoader workers then copies a few buffers, and the workers
+  don't touch millions of Python objects (which would copy their pages).
+
+  The index is saved to index_path and loaded from there next time, as
+  long as root has the same class folders and every directory under them
+  still has the modification time it had when the index was built (adding,
+  removing or renaming files changes the modification time of their
+  directory).
+
+  Args:
+    root: Path to a directory of class folders (root/class_name/image).
+    extensions: File extensions to index (lower case).
+    index_path: Where to save the index. Defaults to a file named after
+      the hash of root's absolute path in FILE_INDEX_DIR, so nothing is
+      written into the dataset. If it can't be written the index just
+      isn't saved.
+    persist: Whether to save and load the index at all. Defaults to True.
+  """
+  VERSION = 1
+
+  def __init__(self,
+               root: str,
+               extensions: Tuple[str, ...]=datasets.folder.IMG_EXTENSIONS,
+               index_path: Optional[str]=None,
+               persist: bool=True) -> None:
+    self.root = os.path.normpath(str(root))
+    self.extensions = tuple(extension.lower() for extension in extensions)
+    if index_path is None:
+      root_key = hashlib.sha1(os.path.abspath(self.root).encode()).hexdigest()[:16]
+      index_path = os.path.join(FILE_INDEX_DIR, f"{root_key}.npz")
+    self.index_path = Path(index_path)
+    if not (persist and self._load()):
+      self._scan()
+      if persist:
+        self._save()
+
+  def _scan(self):
+    """Scans the class directories in parallel and builds the arrays."""
+    self.classes, self.class_to_idx = find_classes(self.root)
+    class_dirs = [os.path.join(self.root, class_name) for class_name in self.classes]
+    # os.scandir and os.stat release the GIL, so threads scan in parallel
+    with ThreadPoolExecutor(max_workers=min(32, len(class_dirs))) as executor:
+      scans = list(executor.map(partial(_scan_class_dir, extensions=self.extensions), class_dirs))
+
+    # Store paths relative to root
+    prefix_length = len(os.path.join(self.root, ""))
+    relative_paths, labels, self.directories = [], [], []
+    for label, (files, directories) in enumerate(scans):
+      relative_paths.extend(os.fsencode(path[prefix_length:]) for path in files)
+      labels.extend([label] * len(files))
+      self.directories.extend((directory[prefix_length:], mtime) for directory, mtime in directories)
+
+    self.path_offsets = np.zeros(len(relative_paths) + 1, dtype=np.int64)
+    np.cumsum([len(path) for path in relative_paths], out=self.path_offsets[1:])
+    self.path_bytes = np.frombuffer(b"".join(relative_paths), dtype=np.uint8)
+    self.labels = np.asarray(labels, dtype=np.int32)
+
+  def _load(self) -> bool:
+    """Loads a saved index if it's still up to date. Returns whether it was."""
+    try:
+      with np.load(self.index_path) as saved:
+        if (int(saved["version"]) != self.VERSION or tuple(saved["extensions"]) != self.extensions
+            or saved["classes"].tolist() != find_classes(self.root)[0]):
+          return False
+        self.directories = list(zip(saved["directories"].tolist(), saved["directory_mtimes"].tolist()))
+        for directory, mtime in self.directories:
+          if os.stat(os.path.join(self.root, directory)).st_mtime_ns != mtime:
+            return False
+        self.classes = saved["classes"].tolist()
+        self.path_bytes = saved["path_bytes"]
+        self.path_offsets = saved["path_offsets"]
+        self.labels = saved["labels"]
+    except (OSError, KeyError, ValueError):
+      return False
+    self.class_to_idx = {class_name: i for i, class_name in enumerate(self.classes)}
+    return True
+
+  def _save(self):
+    """Saves the index atomically (skipped if index_path isn't writable)."""
+    directories, mtimes = zip(*self.directories)
+    tmp_path = self.index_path.with_name(f"{self.index_path.name}.{os.getpid()}.tmp")
+    try:
+      self.index_path.parent.mkdir(parents=True, exist_ok=True)
+      with open(tmp_path, "wb") as f:
+        np.savez(f,
+                 version=self.VERSION,
+                 extensions=np.array(self.extensions),
+                 classes=np.array(self.classes),
+                 path_bytes=self.path_bytes,
+                 path_offsets=self.path_offsets,
+                 labels=self.labels,
+                 directories=np.array(directories),
+                 directory_mtimes=np.array(mtimes, dtype=np.int64))
+      os.replace(tmp_path, self.index_path)
+    except OSError:
+      if tmp_path.exists():
+        tmp_path.unlink()
+
+  def __len__(self) -> int:
+    return len(self.labels)
+
+  def path(self, index: int) -> str:
+    """Returns the full path of the index-th image."""
+    start, end = self.path_offsets[index], self.path_offsets[index + 1]
+    return os.path.join(self.root, os.fsdecode(self.path_bytes[start:end].tobytes()))
+
+
+def get_draft_size(transform) -> Optional[Tuple[int, int]]:
+  """Returns the (width, height) an image is resized to first by transform.
+
+  Looks for a transforms.Resize at the start of transform (a Resize or a
+  Compose that starts with one). Returns None if there isn't one, e.g. for
+  crops whose output size doesn't say how much of the image they keep.
+  """
+  if isinstance(transform, transforms.Compose) and transform.transforms:
+    transform = transform.transforms[0]
+  if not isinstance(transform, transforms.Resize):
+    return None
+  if isinstance(transform.size, int):
+    return (transform.size, transform.size) # shorter side
+  if len(transform.size) == 1:
+    return (transform.size[0], transform.size[0])
+  height, width = transform.size
+  return (width, height)
+
+
+def load_image(path: Union[str, Path, BinaryIO], draft_size: Optional[Tuple[int, int]]=None) -> Image.Image:
+  """Opens an image as RGB, decoding JPEGs at a reduced size if possible.
+
+  With draft_size, JPEGs are decoded with PIL's draft mode, which scales
+  them down by 1/2, 1/4 or 1/8 in the DCT domain while decoding. The
+  largest reduction that keeps both sides at least draft_size (width,
+  height) is used, so a following resize to draft_size sees almost the
+  same image while decoding a large photo is several times faster. Other
+  formats are decoded at full size.
+
+  Args:
+    path: Path to the image file (or a binary file object).
+    draft_size: Optional (width, height) the image will be resized to
+      (see get_draft_size). Defaults to None (decode at full size).
+  """
+  with Image.open(path) as img:
+    if draft_size is not None:
+      img.draft("RGB", draft_size) # no-op for non-JPEG images
+    return img.convert("RGB")
+
+
+def read_image_sizes(paths: List[str], num_threads: int=16) -> np.ndarray:
+  """Reads the (width, height) of every image from its header, without decoding it.
+
+  Returns:
+    An int32 array of shape (len(paths), 2).
+  """
+  def read_size(path: str) -> Tuple[int, int]:
+    with Image.open(path) as img:
+      return img.size
+  with ThreadPoolExecutor(max_workers=num_threads) as executor:
+    return np.array(list(executor.map(read_size, paths)), dtype=np.int32).reshape(-1, 2)
+
+
+class ResizeToArea:
+  """Resizes an image to about area pixels, keeping its aspect ratio.
+
+  Unlike transforms.Resize + transforms.CenterCrop nothing is cropped off:
+  wide and tall images keep their whole field of view at the same number
+  of pixels (and so the same compute) as a square area**0.5 image. Both
+  sides are rounded to a multiple of round_to, so images of similar aspect
+  ratio (see AspectRatioBatchSampler) often end up exactly the same size.
+
+  Args:
+    area: Target number of pixels, e.g. 288 * 288.
+    round_to: Multiple to round the height and width to (e.g. the model's
+      total stride). Defaults to 32.
+    max_aspect_ratio: Most extreme aspect ratio kept; more extreme images
+      are squashed to it. Defaults to 3.
+  """
+  def __init__(self, area: int, round_to: int=32, max_aspect_ratio: float=3.0) -> None:
+    self.area = area
+    self.round_to = round_to
+    self.max_aspect_ratio = max_aspect_ratio
+
+  def get_size(self, width: int, height: int) -> Tuple[int, int]:
+    """Returns the (height, width) an image of width x height is resized to."""
+    aspect_ratio = min(max(width / height, 1 / self.max_aspect_ratio), self.max_aspect_ratio)
+    new_height = max(self.round_to, round((self.area / aspect_ratio) ** 0.5 / self.round_to) * self.round_to)
+    new_width = max(self.round_to, round((self.area * aspect_ratio) ** 0.5 / self.round_to) * self.round_to)
+    return new_height, new_width
+
+  def __call__(self, img: Image.Image) -> Image.Image:
+    return transforms.functional.resize(img, list(self.get_size(*img.size)), antialias=True)
+
+  def __repr__(self) -> str:
+    return f"{self.__class__.__name__}(area={self.area}, round_to={self.round_to}, max_aspect_ratio={self.max_aspect_ratio})"
+
+
+class AspectRatioBatchSampler(Sampler):
+  """Batches together images of similar aspect ratio.
+
+  Images are split into num_buckets buckets of (about) equally many images
+  by aspect ratio, and every batch is drawn from a single bucket. With a
+  transform that keeps the aspect ratio (e.g. ResizeToArea) the images of
+  a batch then have (nearly) the same size, so padding them to a common
+  size with pad_collate wastes little compute.
+
+  Pass it to a DataLoader as batch_sampler, e.g.
+    DataLoader(dataset, batch_sampler=AspectRatioBatchSampler(sizes, 32),
+               collate_fn=pad_collate)
+
+  Args:
+    sizes: An array of (width, height) per image (see read_image_sizes).
+    batch_size: Number of images per batch.
+    num_buckets: Number of aspect ratio buckets.
+    shuffle: Whether to shuffle the images within every bucket and the
+      order of the batches, differently every epoch (see set_epoch).
+      Without shuffling, images are sorted by aspect ratio within their
+      bucket. Defaults to True.
+    drop_last: Whether to drop the last, smaller batch of every bucket.
+    seed: Base seed for the shuffling (combined with the epoch).
+  """
+  def __init__(self,
+               sizes: np.ndarray,
+               batch_size: int,
+               num_buckets: int=8,
+               shuffle: bool=True,
+               drop_last: bool=False,
+               seed: int=0) -> None:
+    sizes = np.asarray(sizes, dtype=np.float64).reshape(-1, 2)
+    self.log_aspect_ratios = np.log(sizes[:, 0] / sizes[:, 1])
+    boundaries = np.quantile(self.log_aspect_ratios, np.linspace(0, 1, num_buckets + 1)[1:-1])
+    bucket_ids = np.searchsorted(boundaries, self.log_aspect_ratios, side="right")
+    self.buckets = [np.flatnonzero(bucket_ids == bucket) for bucket in range(num_buckets)]
+    self.buckets = [bucket for bucket in self.buckets if len(bucket)]
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.drop_last = drop_last
+    self.seed = seed
+    self.epoch = 0
+
+  def set_epoch(self, epoch: int):
+    """Sets the epoch, which changes the shuffle."""
+    self.epoch = epoch
+
+  def __iter__(self) -> Iterator[List[int]]:
+    rng = np.random.default_rng([self.seed, self.epoch])
+    batches = []
+    for bucket in self.buckets:
+      if self.shuffle:
+        bucket = rng.permutation(bucket)
+      else:
+        bucket = bucket[np.argsort(self.log_aspect_ratios[bucket], kind="stable")]
+      for start in range(0, len(bucket), self.batch_size):
+        batch = bucket[start:start + self.batch_size]
+        if len(batch) == self.batch_size or not self.drop_last:
+          batches.append(batch.tolist())
+    if self.shuffle:
+      batches = [batches[i] for i in rng.permutation(len(batches))]
+    return iter(batches)
+
+  def __len__(self) -> int:
+    if self.drop_last:
+      return sum(len(bucket) // self.batch_size for bucket in self.buckets)
+    return sum(-(-len(bucket) // self.batch_size) for bucket in self.buckets)
+
+
+def pad_collate(batch: List[Tuple[torch.Tensor, Any]],
+                pad_to_multiple: int=1,
+                padding_value: float=0.0) -> Tuple[torch.Tensor, torch.Tensor]:
+  """Collates (image, label) pairs of different sizes into one batch.
+
+  Every image is padded at the bottom and right to the largest height and
+  width in the batch (rounded up to pad_to_multiple). After normalization
+  a padding_value of 0 is the dataset mean. Use functools.partial to
+  change the defaults.
+
+  Returns:
+    A tuple of (images, labels) tensors.
+  """
+  images, labels = zip(*batch)
+  height = max(image.shape[-2] for image in images)
+  width = max(image.shape[-1] for image in images)
+  height = -(-height // pad_to_multiple) * pad_to_multiple
+  width = -(-width // pad_to_multiple) * pad_to_multiple
+  padded = images[0].new_full((len(images), images[0].shape[0], height, width), padding_value)
+  for i, image in enumerate(images):
+    padded[i, :, :image.shape[-2], :image.shape[-1]] = image
+  return padded, torch.as_tensor(labels)
+
+
+def _feistel_permute(positions: np.ndarray, num_samples: int, keys: np.ndarray) -> np.ndarray:
+  """Maps positions in [0, num_samples) to a pseudo-random permutation of them.
+
+  A balanced Feistel network with one round per key is a permutation of
+  the smallest power of 4 >= num_samples; values that land outside
+  [0, num_samples) are encrypted again until they don't ("cycle walking"),
+  which keeps it a permutation of [0, num_samples).
+  """
+  half_bits = max(1, (int(num_samples - 1).bit_length() + 1) // 2)
+  mask = np.uint64((1 << half_bits) - 1)
+  shift = np.uint64(half_bits)
+
+  def encrypt(x: np.ndarray) -> np.ndarray:
+    left, right = x >> shift, x & mask
+    for key in keys:
+      # splitmix64 finalizer of (right, key) as the round function
+      z = (right ^ key) * np.uint64(0x9E3779B97F4A7C15)
+      z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+      z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+      left, right = right, left ^ ((z ^ (z >> np.uint64(31))) & mask)
+    return (left << shift) | right
+
+  with np.errstate(over="ignore"):
+    permuted = encrypt(positions.astype(np.uint64))
+    outside = permuted >= num_samples
+    while outside.any():
+      permuted[outside] = encrypt(permuted[outside])
+      outside = permuted >= num_samples
+  return permuted.astype(np.int64)
+
+
+class SeekableSampler(Sampler):
+  """A shuffling sampler that can start from any position of an epoch.
+
+  The order of every epoch is a pseudo-random permutation that is a pure
+  function of (seed, epoch), computed index by index (a Feistel cipher
+  over the sample positions), so starting at the n-th sample of an epoch
+  costs the same as starting at the first: nothing before it is replayed
+  or materialized. Used to continue a preempted epoch exactly where it
+  stopped (see engine.train), with state_dict() saved in the checkpoint.
+
+  After every full pass it moves on to the next epoch (and its shuffle),
+  so it reshuffles every epoch without set_epoch being called; set_epoch
+  and set_start override the epoch and starting sample of the next pass.
+
+  Like DistributedSampler, it can split every epoch between num_replicas
+  processes, padding (or with drop_last, trimming) it so every process
+  gets equally many samples.
+
+  Args:
+    data_source: The dataset to sample from (only its length is used).
+    shuffle: Whether to shuffle (otherwise samples come in order).
+    seed: Seed of the permutation. Defaults to None, which draws one from
+      torch's global random number generator (like RandomSampler). Every
+      process of a distributed run has to use the same seed.
+    num_replicas: Number of processes to split every epoch between.
+      Defaults to the distributed world size (1 when not distributed).
+    rank: Rank of this process. Defaults to the distributed rank.
+    drop_last: Whether to drop the tail of the epoch instead of padding it
+      when it doesn't split evenly between the processes.
+  """
+  def __init__(self,
+               data_source: Sized,
+               shuffle: bool=True,
+               seed: Optional[int]=None,
+               num_replicas: Optional[int]=None,
+               rank: Optional[int]=None,
+               drop_last: bool=False) -> None:
+    self.dataset_size = len(data_source)
+    self.shuffle = shuffle
+    if seed is None:
+      seed = int(torch.empty((), dtype=torch.int64).random_().item())
+    self.seed = seed
+    self.num_replicas = ddp.get_world_size() if num_replicas is None else num_replicas
+    self.rank = ddp.get_rank() if rank is None else rank
+    if drop_last:
+      self.num_samples = self.dataset_size // self.num_replicas
+    else:
+      self.num_samples = -(-self.dataset_size // self.num_replicas)
+    self.epoch = 0
+    self.start = 0
+
+  def set_epoch(self, epoch: int):
+    """Sets the epoch, which changes the shuffle, and starts it from the beginning."""
+    self.epoch = epoch
+    self.start = 0
+
+  def set_start(self, start: int):
+    """Starts the next iteration at sample start (of this process) of the epoch."""
+    self.start = start
+
+  def state_dict(self) -> Dict[str, int]:
+    return {"seed": self.seed, "epoch": self.epoch, "start": self.start}
+
+  def load_state_dict(self, state_dict: Dict[str, int]):
+    self.seed = state_dict["seed"]
+    self.epoch = state_dict["epoch"]
+    self.start = state_dict["start"]
+
+  def __iter__(self) -> Iterator[int]:
+    keys = np.random.SeedSequence([self.seed, self.epoch]).generate_state(6, dtype=np.uint64)
+    # Process rank takes every num_replicas-th position, wrapping around
+    # the epoch to pad it (like DistributedSampler)
+    for chunk_start in range(self.start, self.num_samples, 4096):
+      local_positions = np.arange(chunk_start, min(chunk_start + 4096, self.num_samples), dtype=np.int64)
+      positions = (local_positions * self.num_replicas + self.rank) % self.dataset_size
+      if self.shuffle:
+        positions = _feistel_permute(positions, self.dataset_size, keys)
+      yield from positions.tolist()
+    self.epoch += 1
+    self.start = 0
+
+  def __len__(self) -> int:
+    # The length of a whole epoch, also when starting partway through
+    return self.num_samples
+
+
+class SharedSampleCache:
+  """An LRU cache of same-shaped uint8 samples in shared memory.
+
+  The samples, the index of which sample is in which slot and the
+  last-used times live in shared-memory tensors allocated when the cache
+  is created. DataLoader worker processes (and every epoch's new workers)
+  therefore all read and fill the same cache, while each one would
+  otherwise decode every image itself. A lock guards the bookkeeping.
+
+  The cache holds max_bytes // sample size samples (at most num_samples).
+  Once it's full, the least recently used sample is evicted to make room.
+
+  Args:
+    num_samples: Number of samples in the dataset.
+    sample_shape: Shape of every sample, e.g. (64, 64, 3).
+    max_bytes: Byte budget for the cached samples.
+  """
+  def __init__(self, num_samples: int, sample_shape: Tuple[int, ...], max_bytes: int) -> None:
+    self.sample_shape = tuple(sample_shape)
+    self.sample_bytes = int(np.prod(self.sample_shape))
+    self.num_slots = min(num_samples, max_bytes // self.sample_bytes)
+    self.storage = torch.empty((self.num_slots, self.sample_bytes), dtype=torch.uint8).share_memory_()
+    self.slot_of = torch.full((num_samples,), -1, dtype=torch.int64).share_memory_()
+    self.sample_of = torch.full((self.num_slots,), -1, dtype=torch.int64).share_memory_()
+    self.last_used = torch.full((self.num_slots,), -1, dtype=torch.int64).share_memory_() # -1 = free
+    self.counters = torch.zeros(4, dtype=torch.int64).share_memory_() # clock, hits, misses, evictions
+    self.lock = multiprocessing.Lock()
+    self._arrays = None # numpy views, created lazily in each process
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["_arrays"] = None
+    return state
+
+  def _views(self) -> Tuple[np.ndarray, ...]:
+    if self._arrays is None:
+      self._arrays = tuple(tensor.numpy() for tensor in
+                           (self.storage, self.slot_of, self.sample_of, self.last_used, self.counters))
+    return self._arrays
+
+  def get(self, index: int) -> Optional[np.ndarray]:
+    """Returns a copy of sample index, or None if it isn't cached."""
+    storage, slot_of, _, last_used, counters = self._views()
+    with self.lock:
+      slot = slot_of[index]
+      if slot < 0:
+        counters[2] += 1
+        return None
+      counters[0] += 1
+      counters[1] += 1
+      last_used[slot] = counters[0]
+      return storage[slot].reshape(self.sample_shape).copy()
+
+  def put(self, index: int, sample: np.ndarray):
+    """Caches sample index, evicting the least recently used sample if full."""
+    if self.num_slots == 0:
+      return
+    storage, slot_of, sample_of, last_used, counters = self._views()
+    with self.lock:
+      if slot_of[index] >= 0: # another worker got there first
+        return
+      slot = int(last_used.argmin()) # free slots first, then the least recently used
+      evicted = sample_of[slot]
+      if evicted >= 0:
+        slot_of[evicted] = -1
+        counters[3] += 1
+      storage[slot] = sample.reshape(-1)
+      sample_of[slot], slot_of[index] = index, slot
+      counters[0] += 1
+      last_used[slot] = counters[0]
+
+  def stats(self) -> Dict[str, float]:
+    """Returns the hit/miss/eviction counts, hit rate and memory use."""
+    _, _, sample_of, _, counters = self._views()
+    hits, misses, evictions = (int(count) for count in counters[1:])
+    cached_samples = int((sample_of >= 0).sum())
+    return {"hits": hits,
+            "misses": misses,
+            "evictions": evictions,
+            "hit_rate": hits / (hits + misses) if hits + misses else 0.0,
+            "cached_samples": cached_samples,
+            "cached_bytes": cached_samples * self.sample_bytes,
+            "capacity_bytes": self.num_slots * self.sample_bytes}
+
+  def reset_stats(self):
+    """Zeroes the hit/miss/eviction counts (e.g. at the start of an epoch)."""
+    with self.lock:
+      self.counters[1:] = 0
+
+
+def _load_cached(cache: SharedSampleCache,
+                 index: int,
+                 load: Callable[[int], Image.Image],
+                 resize: transforms.Resize) -> Image.Image:
+  """Returns the resized image index from cache, loading and caching it on a miss."""
+  sample = cache.get(index)
+  if sample is None:
+    sample = np.asarray(resize(load(index)))
+    cache.put(index, sample)
+  return Image.fromarray(sample)
+
+
+class ImageFolderCustom(Dataset):
+  """A Dataset of images stored as targ_dir/class_name/image.jpg.
+
+  A lighter version of torchvision.datasets.ImageFolder. The image paths
+  and labels come from a FileIndex, which is saved under FILE_INDEX_DIR
+  (~/.cache/going_modular/file_index, never in targ_dir) and reused until
+  the directory changes. With fast_decode=True and a transform that starts
+  with a transforms.Resize, JPEGs are decoded at the smallest scale that
+  still covers the resize (see load_image).
+
+  With cache_bytes > 0 (and a transform that starts with a fixed-size
+  Resize) decoded, resized images are kept in a SharedSampleCache shared
+  by all DataLoader workers; the rest of transform runs on every access.
+
+  Args:
+    targ_dir: Path to the directory of class folders.
+    transform: Optional transforms to apply to every image.
+    fast_decode: Whether to decode JPEGs at reduced size. Defaults to True.
+    index_path: Optional path to save the file index to instead (see FileIndex).
+    cache_bytes: Byte budget of the in-memory cache. Defaults to 0 (no cache).
+  """
+  def __init__(self,
+               targ_dir: str,
+               transform: Optional[transforms.Compose]=None,
+               fast_decode: bool=True,
+               index_path: Optional[str]=None,
+               cache_bytes: int=0) -> None:
+    # Index all image paths and labels
+    self.index = FileIndex(targ_dir, index_path=index_path)
+    self.transform = transform
+    self.draft_size = get_draft_size(transform) if fast_decode else None
+    # Create classes and class_to_idx attributes
+    self.classes, self.class_to_idx = self.index.classes, self.index.class_to_idx
+
+    # Optionally cache resized images in memory (and only run the rest of transform)
+    self.cache = None
+    if cache_bytes > 0:
+      self.resize, self.transform = _split_resize(transform, fixed_size=True)
+      self.cache = SharedSampleCache(len(self.index), (*self.resize.size, 3), cache_bytes)
+
+  @property
+  def targets(self) -> np.ndarray:
+    return self.index.labels
+
+  def load_image(self, index: int) -> Image.Image:
+    """Opens an image via a path and returns it."""
+    return load_image(self.index.path(index), self.draft_size)
+
+  def image_sizes(self) -> np.ndarray:
+    """Returns the (width, height) of every image, e.g. for AspectRatioBatchSampler."""
+    return read_image_sizes([self.index.path(index) for index in range(len(self))])
+
+  def __len__(self) -> int:
+    """Returns the total number of samples."""
+    return len(self.index)
+
+  def __getitem__(self, index: int) -> Tuple[torch.Tensor, int]:
+    """Returns one sample of data, data and label (X, y)."""
+    if self.cache is not None:
+      img = _load_cached(self.cache, index, self.load_image, self.resize)
+    else:
+      img = self.load_image(index)
+    class_idx = int(self.index.labels[index])
+
+    # Transform if necessary
+    if self.transform:
+      return self.transform(img), class_idx
+    return img, class_idx
+
+
+class SharedCacheImageFolder(datasets.ImageFolder):
+  """A datasets.ImageFolder that keeps decoded, resized images in memory.
+
+  transform must start with a fixed (height, width) transforms.Resize. The
+  output of the resize is cached in a SharedSampleCache of cache_bytes,
+  shared by all DataLoader workers, and the rest of transform (e.g. random
+  augmentations and ToTensor) runs on every access. Unlike
+  CachedImageFolder nothing is written to disk and the cache starts empty
+  every run, filling up during the first epoch.
+
+  Args:
+    root: Path to an ImageFolder style directory (root/class_name/image).
+    transform: Transforms starting with a fixed-size transforms.Resize.
+    cache_bytes: Byte budget of the cache.
+    fast_decode: Whether to decode JPEGs at reduced size (see load_image).
+  """
+  def __init__(self,
+               root: str,
+               transform: transforms.Compose,
+               cache_bytes: int,
+               fast_decode: bool=False) -> None:
+    resize, remaining_transform = _split_resize(transform, fixed_size=True)
+    super().__init__(root,
+                     transform=remaining_transform,
+                     loader=partial(load_image, draft_size=get_draft_size(resize) if fast_decode else None))
+    self.resize = resize
+    self.cache = SharedSampleCache(len(self.samples), (*resize.size, 3), cache_bytes)
+
+  def __getitem__(self, index: int) -> Tuple[torch.Tensor, int]:
+    img = _load_cached(self.cache, index, lambda i: self.loader(self.samples[i][0]), self.resize)
+    target = self.targets[index]
+    if self.transform is not None:
+      img = self.transform(img)
+    if self.target_transform is not None:
+      target = self.target_transform(target)
+    return img, target
+
+
+class CachedImageFolder(Dataset):
+  """An ImageFolder whose images are decoded and resized once into a cache.
+
+  The first time a directory is used, every image is decoded, converted to
+  RGB and passed through resize (a transforms.Resize with a fixed (height,
+  width) size). The results are stored in a memory-mapped uint8 array
+  (plus an array of labels) under cache_dir. Later epochs, runs and
+  DataLoader workers read pixels straight from that array, so they share
+  the page cache instead of re-decoding JPEGs.
+
+  The cache is keyed on the image paths, sizes and modification times and
+  on the resize parameters, so adding, removing or editing an image or
+  changing the resize builds a new cache. Adding, removing or editing
+  images deletes the stale cache; caches with other resize settings are
+  kept, since another run may be using them.
+
+  __getitem__ returns the cached image as a PIL image with transform
+  (e.g. random augmentations and ToTensor) applied on top.
+
+  Args:
+    root: Path to an ImageFolder style directory (root/class_name/image).
+    resize: A transforms.Resize with a (height, width) size.
+    cache_dir: Directory to store caches in.
+    transform: Optional transforms to apply after the cached resize.
+    fast_decode: Whether to decode JPEGs at reduced size when building the
+      cache (see load_image). Defaults to False.
+  """
+  def __init__(self,
+               root: str,
+               resize: transforms.Resize,
+               cache_dir: str,
+               transform: Optional[transforms.Compose]=None,
+               fast_decode: bool=False) -> None:
+    if isinstance(resize.size, int) or len(resize.size) != 2:
+      raise ValueError(f"CachedImageFolder needs a fixed (height, width) resize, got size={resize.size}")
+    folder = datasets.ImageFolder(root)
+    self.classes = folder.classes
+    self.class_to_idx = folder.class_to_idx
+    self.root = root
+    self.samples = folder.samples
+    self.targets = folder.targets
+    self.resize = resize
+    self.transform = transform
+    self.draft_size = get_draft_size(resize) if fast_decode else None
+
+    # Key the cache on the root directory and resize/decode parameters, then on the files
+    settings_key = hashlib.sha1(f"{Path(root).resolve()}|{resize!r}|{self.draft_size}".encode()).hexdigest()[:12]
+    fingerprint = hashlib.sha1()
+    for path, target in self.samples:
+      stat = os.stat(path)
+      fingerprint.update(f"{path}|{target}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    self.cache_path = Path(cache_dir) / f"{settings_key}-{fingerprint.hexdigest()[:16]}"
+
+    if not (self.cache_path / "meta.json").exists():
+      self._build_cache()
+      # Remove caches of older versions of the same directory with the same
+      # settings (caches with other resizes may still be in use)
+      for stale_path in Path(cache_dir).glob(f"{settings_key}-*"):
+        if stale_path != self.cache_path and not stale_path.name.endswith(".tmp"):
+          shutil.rmtree(stale_path, ignore_errors=True)
+
+    self.labels = np.load(self.cache_path / "labels.npy")
+    self._images = None # opened lazily so each DataLoader worker maps the file itself
+
+  def _load_and_resize(self, path: str) -> np.ndarray:
+    return np.asarray(self.resize(load_image(path, self.draft_size)))
+
+  def _build_cache(self):
+    """Decodes and resizes every image into a new cache directory."""
+    height, width = self.resize.size
+    tmp_path = self.cache_path.with_name(f"{self.cache_path.name}.{os.getpid()}.tmp")
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    print(f"[INFO] Caching {len(self.samples)} decoded images to: {self.cache_path}")
+
+    images = np.lib.format.open_memmap(tmp_path / "images.npy", mode="w+", dtype=np.uint8,
+                                       shape=(len(self.samples), height, width, 3))
+    # PIL releases the GIL while decoding and resizing, so threads run in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+      paths = [path for path, _ in self.samples]
+      for index, image in enumerate(executor.map(self._load_and_resize, paths)):
+        images[index] = image
+    images.flush()
+    del images
+    np.save(tmp_path / "labels.npy", np.asarray(self.targets, dtype=np.int64))
+    with open(tmp_path / "meta.json", "w") as f:
+      json.dump({"num_images": len(self.samples), "size": [height, width], "resize": repr(self.resize)}, f)
+
+    # Publish the finished cache in one step (another process may have beaten us to it)
+    try:
+      os.replace(tmp_path, self.cache_path)
+    except OSError:
+      shutil.rmtree(tmp_path, ignore_errors=True)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["_images"] = None
+    return state
+
+  def __len__(self) -> int:
+    return len(self.labels)
+
+  def __getitem__(self, index: int) -> Tuple[torch.Tensor, int]:
+    if self._images is None:
+      self._images = np.load(self.cache_path / "images.npy", mmap_mode="r")
+    img = Image.fromarray(np.array(self._images[index]))
+    if self.transform:
+      img = self.transform(img)
+    return img, int(self.labels[index])
+
+
+class PackedImageDataset(Dataset):
+  """Reads a split packed into tar shards by pack_dataset.py.
+
+  Uses the split's index to read any image straight out of its shard, so it
+  works with random sampling like an ImageFolder. The shards are
+  memory-mapped (lazily, once per DataLoader worker), so reading a sample
+  is a copy out of the page cache rather than a file open.
+
+  Args:
+    root: Path to a packed split directory (containing meta.json and index.npz).
+    transform: Optional transforms to apply to each PIL image.
+    fast_decode: Whether to decode images at reduced size when transform
+      starts with a smaller Resize (see load_image). Defaults to False.
+  """
+  def __init__(self,
+               root: str,
+               transform: Optional[transforms.Compose]=None,
+               fast_decode: bool=False) -> None:
+    self.root = Path(root)
+    with open(self.root / "meta.json") as f:
+      meta = json.load(f)
+    self.classes = meta["classes"]
+    self.class_to_idx = {class_name: i for i, class_name in enumerate(self.classes)}
+    self.shard_names = meta["shards"]
+    index = np.load(self.root / "index.npz")
+    self.shard_ids, self.offsets, self.sizes = index["shard"], index["offset"], index["size"]
+    self.targets = index["label"]
+    # Paths of the packed images relative to the source split (not stored by older packs)
+    self.paths = index["path"] if "path" in index else None
+    self.transform = transform
+    self.draft_size = get_draft_size(transform) if fast_decode else None
+    self._shards = None # memory-mapped lazily in each process
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["_shards"] = None
+    return state
+
+  def __len__(self) -> int:
+    return len(self.targets)
+
+  def load_bytes(self, index: int) -> bytes:
+    """Returns the encoded image bytes of a sample."""
+    if self._shards is None:
+      self._shards = [np.memmap(self.root / name, dtype=np.uint8, mode="r") for name in self.shard_names]
+    offset = self.offsets[index]
+    return self._shards[self.shard_ids[index]][offset:offset + self.sizes[index]].tobytes()
+
+  def __getitem__(self, index: int) -> Tuple[torch.Tensor, int]:
+    img = load_image(io.BytesIO(self.load_bytes(index)), self.draft_size)
+    if self.transform:
+      img = self.transform(img)
+    return img, int(self.targets[index])
+
+
+class TarShardStream(IterableDataset):
+  """Streams the samples of a split packed by pack_dataset.py shard by shard.
+
+  Unlike PackedImageDataset, which reads samples in random order through
+  the index, every shard is read sequentially from start to end, which is
+  what disks and network file systems are fastest at when the dataset
+  doesn't fit in the page cache. Samples are shuffled at two levels
+  instead of globally:
+    1. the order of the shards is shuffled every epoch (see set_epoch) and
+    2. samples pass through a shuffle buffer of shuffle_buffer (encoded)
+       images, which yields a random one of them for every new sample.
+
+  The shards are split between distributed processes (ranks) and the
+  DataLoader workers of each process. Every DataLoader worker batches its
+  own samples, so in distributed runs every rank yields
+  ceil(num_samples / (world_size * batch_size)) whole batches per epoch,
+  split as evenly as possible between its workers, so all processes run
+  the same number of batches: workers whose shards hold fewer samples
+  repeat a few (like DistributedSampler's padding) and workers whose
+  shards hold more skip the last few (different ones every epoch, as the
+  shard order changes). With fewer shards than
+  workers in total, every worker reads all shards and keeps every n-th
+  sample, which works but reads the data several times; pack with a
+  smaller --shard_size_mb to avoid that. The shard sizes come from the
+  split's index.npz.
+
+  Args:
+    root: Path to a packed split directory (containing meta.json).
+    transform: Optional transforms to apply to each PIL image.
+    shuffle: Whether to shuffle shards and samples. Defaults to True.
+    shuffle_buffer: Number of samples in the shuffle buffer.
+    seed: Base seed for the shuffling (combined with the epoch).
+    fast_decode: Whether to decode images at reduced size when transform
+      starts with a smaller Resize (see load_image). Defaults to False.
+    batch_size: batch_size of the DataLoader the stream is read with, so
+      distributed ranks can be given equally many whole batches.
+      Defaults to 1.
+  """
+  def __init__(self,
+               root: str,
+               transform: Optional[transforms.Compose]=None,
+               shuffle: bool=True,
+               shuffle_buffer: int=1000,
+               seed: int=0,
+               fast_decode: bool=False,
+               batch_size: int=1) -> None:
+    self.root = Path(root)
+    with open(self.root / "meta.json") as f:
+      meta = json.load(f)
+    self.classes = meta["classes"]
+    self.class_to_idx = {class_name: i for i, class_name in enumerate(self.classes)}
+    self.shard_names = meta["shards"]
+    self.num_samples = meta["num_samples"]
+    shard_ids = np.load(self.root / "index.npz")["shard"]
+    self.shard_sizes = dict(zip(self.shard_names, np.bincount(shard_ids, minlength=len(self.shard_names)).tolist()))
+    self.transform = transform
+    self.shuffle = shuffle
+    self.shuffle_buffer = shuffle_buffer if shuffle else 0
+    self.seed = seed
+    self.draft_size = get_draft_size(transform) if fast_decode else None
+    self.batch_size = batch_size
+    self.epoch = 0
+    # Read in the main process; DataLoader workers don't join the process group
+    self.rank, self.world_size = ddp.get_rank(), ddp.get_world_size()
+
+  def set_epoch(self, epoch: int):
+    """Sets the epoch, which changes the shard and sample order."""
+    self.epoch = epoch
+
+  def __len__(self) -> int:
+    """Returns the number of samples this process yields per epoch."""
+    if self.world_size == 1:
+      return self.num_samples
+    return math.ceil(self.num_samples / (self.world_size * self.batch_size)) * self.batch_size
+
+  def _read_shard(self, shard_name: str) -> Iterator[Tuple[bytes, int]]:
+    """Yields (image bytes, label) pairs from a shard in file order."""
+    data, label = {}, {}
+    with tarfile.open(self.root / shard_name, mode="r|") as tar:
+      for member in tar:
+        if not member.isfile():
+          continue
+        key, extension = os.path.splitext(member.name)
+        content = tar.extractfile(member).read()
+        if extension == ".cls":
+          label[key] = int(content)
+        else:
+          data[key] = content
+        if key in data and key in label:
+          yield data.pop(key), label.pop(key)
+
+  def _samples(self, shard_names: List[str], worker: int, num_workers: int) -> Iterator[Tuple[bytes, int]]:
+    """Yields the samples of one (rank, worker) pair from shard_names, once."""
+    if len(shard_names) >= num_workers:
+      for shard_name in shard_names[worker::num_workers]:
+        yield from self._read_shard(shard_name)
+    else:
+      index = 0
+      for shard_name in shard_names:
+        for sample in self._read_shard(shard_name):
+          if index % num_workers == worker:
+            yield sample
+          index += 1
+
+  def _quotas(self, shard_names: List[str], num_workers: int) -> List[int]:
+    """Returns how many samples each worker of this rank yields.
+
+    Without distributed training every worker yields all of its samples.
+    Otherwise the len(self) // batch_size batches of every rank are split
+    between its workers (the first ones getting one more batch if they
+    don't split evenly), and each worker trims or cycles its samples to
+    exactly its whole batches, so every rank runs the same number of
+    batches whatever the shard sizes.
+    """
+    total_workers = self.world_size * num_workers
+    workers = range(self.rank * num_workers, (self.rank + 1) * num_workers)
+    if len(shard_names) >= total_workers:
+      counts = [int(sum(self.shard_sizes[name] for name in shard_names[worker::total_workers])) for worker in workers]
+    else:
+      counts = [len(range(worker, self.num_samples, total_workers)) for worker in workers]
+    if self.world_size == 1:
+      return counts
+
+    num_batches = len(self) // self.batch_size
+    quotas = [(num_batches // num_workers + (i < num_batches % num_workers)) * self.batch_size
+              for i in range(num_workers)]
+    if any(quota > 0 and count == 0 for quota, count in zip(quotas, counts)):
+      raise ValueError(f"{self.root} has too few samples to give each of {total_workers} DataLoader workers "
+                       "(num_workers * world_size) some to cycle through; use fewer workers")
+    return quotas
+
+  def __iter__(self) -> Iterator[Tuple[torch.Tensor, int]]:
+    worker_info = get_worker_info()
+    worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+    # Every (rank, worker) pair reads its own subset of the shards
+    worker = self.rank * num_workers + worker_id
+    total_workers = self.world_size * num_workers
+
+    shard_names = list(self.shard_names)
+    if self.shuffle:
+      random.Random(f"{self.seed}-{self.epoch}").shuffle(shard_names) # the same order on every worker
+    quota = self._quotas(shard_names, num_workers)[worker_id]
+    rng = random.Random(f"{self.seed}-{self.epoch}-{worker}")
+
+    def stream():
+      # Cycle through the worker's samples until its quota is met
+      count = 0
+      while count < quota:
+        for sample in self._samples(shard_names, worker, total_workers):
+          yield sample
+          count += 1
+          if count == quota:
+            return
+
+    if not self.shuffle_buffer:
+      for sample in stream():
+        yield self._decode(*sample)
+      return
+
+    # Bounded shuffle buffer: hold encoded images and yield a random one per new sample
+    buffer = []
+    for sample in stream():
+      if len(buffer) < self.shuffle_buffer:
+        buffer.append(sample)
+        continue
+      index = rng.randrange(len(buffer))
+      buffer[index], sample = sample, buffer[index]
+      yield self._decode(*sample)
+    rng.shuffle(buffer)
+    for sample in buffer:
+      yield self._decode(*sample)
+
+  def _decode(self, data: bytes, label: int) -> Tuple[torch.Tensor, int]:
+    img = load_image(io.BytesIO(data), self.draft_size)
+    if self.transform:
+      img = self.transform(img)
+    return img, label
+
+
+class FeatureDataset(Dataset):
+  """Precomputed feature vectors and labels, memory-mapped from .npy files.
+
+  Reads path/features.npy (a float32 array of shape (num_samples,
+  feature_dim)) and path/labels.npy, as written by engine.cache_features
+  from the outputs of a frozen backbone.
+
+  Args:
+    path: Directory containing features.npy and labels.npy.
+  """
+  def __init__(self, path: Union[str, Path]) -> None:
+    self.path = Path(path)
+    self.labels = np.load(self.path / "labels.npy")
+    self._features = None # opened lazily so each DataLoader worker maps the file itself
+
+  @property
+  def targets(self) -> np.ndarray:
+    return self.labels
+
+  @property
+  def features(self) -> np.ndarray:
+    if self._features is None:
+      self._features = np.load(self.path / "features.npy", mmap_mode="r")
+    return self._features
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["_features"] = None
+    return state
+
+  def __len__(self) -> int:
+    return len(self.labels)
+
+  def __getitem__(self, index: int) -> Tuple[torch.Tensor, int]:
+    return torch.from_numpy(np.array(self.features[index])), int(self.labels[index])
+
+
+def _get_targets(dataset: Dataset) -> np.ndarray:
+  """Returns the label of every sample of dataset without loading any samples."""
+  for name in ("targets", "_labels"): # torchvision's Food101 keeps them in _labels
+    if hasattr(dataset, name):
+      return np.asarray(getattr(dataset, name))
+  raise ValueError(f"{type(dataset).__name__} has no targets to stratify by, use stratified=False")
+
+
+def _sample_paths_hash(dataset: Dataset) -> Optional[str]:
+  """Returns a hash of the paths (relative to the root) of dataset's samples, in order.
+
+  Returns None for datasets without sample paths (e.g. splits packed
+  before pack_dataset.py stored them).
+  """
+  if isinstance(dataset, ImageFolderCustom):
+    index = dataset.index
+    paths = (os.fsdecode(index.path_bytes[index.path_offsets[i]:index.path_offsets[i + 1]].tobytes())
+             for i in range(len(index)))
+  elif hasattr(dataset, "samples") and hasattr(dataset, "root"):
+    prefix_length = len(os.path.join(os.path.normpath(str(dataset.root)), ""))
+    paths = (os.path.normpath(path)[prefix_length:] for path, _ in dataset.samples)
+  elif isinstance(dataset, PackedImageDataset) and dataset.paths is not None:
+    paths = (str(path) for path in dataset.paths)
+  else:
+    return None
+  fingerprint = hashlib.sha1()
+  for path in paths:
+    fingerprint.update(path.replace(os.sep, "/").encode() + b"\n")
+  return fingerprint.hexdigest()
+
+
+class VirtualSubset(Dataset):
+  """A subset of a dataset given by an array of indices (nothing is copied).
+
+  Keeps the base dataset's classes and the subset's targets, so it can
+  stand in for the base dataset (e.g. in create_dataloaders).
+  """
+  def __init__(self, dataset: Dataset, indices: np.ndarray) -> None:
+    self.dataset = dataset
+    self.indices = np.asarray(indices, dtype=np.int64)
+    self.classes = getattr(dataset, "classes", None)
+
+  @property
+  def targets(self) -> np.ndarray:
+    return _get_targets(self.dataset)[self.indices]
+
+  def __len__(self) -> int:
+    return len(self.indices)
+
+  def __getitem__(self, index: int) -> Tuple[torch.Tensor, int]:
+    return self.dataset[int(self.indices[index])]
+
+
+class SubsetManifest:
+  """A percentage subset and/or k-fold split of a dataset, as index arrays.
+
+  Instead of copying images into a new folder per experiment (e.g. a 10%
+  subset of pizza_steak_sushi or a 20% subset of Food101), a manifest
+  stores the sorted indices of the chosen samples in the base dataset and,
+  for k-fold splits, the fold of every chosen sample. Saved as a small
+  .npz file (a few bytes per sample) and applied with apply(), or passed
+  to create_dataloaders as train_subset/test_subset.
+
+  Create one with SubsetManifest.sample(), e.g.
+    SubsetManifest.sample(train_data, fraction=0.2).save("train_20_percent.npz")
+    SubsetManifest.sample(train_data, num_folds=5).save("train_5_fold.npz")
+
+  Args:
+    indices: Indices of the chosen samples in the base dataset.
+    num_samples: Number of samples in the base dataset.
+    classes: Class names of the base dataset (checked when applied).
+    folds: Optional fold of every chosen sample.
+    metadata: Optional JSON-serializable dictionary of how the manifest
+      was made (fraction, seed, ...).
+    paths_hash: Optional hash of the base dataset's sample paths in order
+      (checked when applied, since e.g. ImageFolder and ImageFolderCustom
+      order files in subdirectories differently).
+  """
+  def __init__(self,
+               indices: np.ndarray,
+               num_samples: int,
+               classes: Optional[List[str]]=None,
+               folds: Optional[np.ndarray]=None,
+               metadata: Optional[Dict[str, Any]]=None,
+               paths_hash: Optional[str]=None) -> None:
+    self.indices = np.asarray(indices)
+    self.num_samples = num_samples
+    self.classes = classes
+    self.folds = None if folds is None else np.asarray(folds)
+    self.metadata = metadata or {}
+    self.paths_hash = paths_hash
+
+  @classmethod
+  def sample(cls,
+             dataset: Dataset,
+             fraction: float=1.0,
+             num_folds: Optional[int]=None,
+             stratified: bool=True,
+             seed: int=42) -> "SubsetManifest":
+    """Randomly chooses a fraction of dataset, optionally split into folds.
+
+    Args:
+      dataset: The base dataset.
+      fraction: Fraction of the samples to choose (of every class when
+        stratified, rounded, keeping at least one sample per class).
+      num_folds: Optional number of folds to split the chosen samples into.
+      stratified: Whether to keep the class proportions of dataset in the
+        subset and in every fold. Needs dataset.targets.
+      seed: Seed of the random choice.
+
+    Returns:
+      A SubsetManifest.
+    """
+    num_samples = len(dataset)
+    rng = np.random.default_rng(seed)
+    if stratified:
+      targets = _get_targets(dataset)
+      groups = [np.flatnonzero(targets == label) for label in np.unique(targets)]
+    else:
+      groups = [np.arange(num_samples)]
+
+    indices, folds, fold_offset = [], [], 0
+    for group in groups:
+      chosen = rng.permutation(group)[:max(1, round(fraction * len(group)))]
+      indices.append(chosen)
+      if num_folds:
+        # Deal every group's samples round-robin, continuing where the last
+        # group stopped, so the folds end up (nearly) equally large
+        folds.append((np.arange(len(chosen)) + fold_offset) % num_folds)
+        fold_offset += len(chosen)
+    indices = np.concatenate(indices)
+
+    # Keep the indices sorted, so a subset reads its files in directory order
+    order = np.argsort(indices, kind="stable")
+    index_dtype = np.uint32 if num_samples < 2**32 else np.int64
+    return cls(indices=indices[order].astype(index_dtype),
+               num_samples=num_samples,
+               classes=getattr(dataset, "classes", None),
+               folds=np.concatenate(folds)[order].astype(np.min_scalar_type(num_folds - 1)) if num_folds else None,
+               metadata={"fraction": fraction, "num_folds": num_folds, "stratified": stratified, "seed": seed},
+               paths_hash=_sample_paths_hash(dataset))
+
+  def save(self, path: Union[str, Path]):
+    """Saves the manifest as an .npz file."""
+    arrays = {"indices": self.indices,
+              "num_samples": self.num_samples,
+              "metadata": json.dumps(self.metadata)}
+    if self.classes is not None:
+      arrays["classes"] = np.array(self.classes)
+    if self.folds is not None:
+      arrays["folds"] = self.folds
+    if self.paths_hash is not None:
+      arrays["paths_hash"] = self.paths_hash
+    with open(path, "wb") as f:
+      np.savez(f, **arrays)
+
+  @classmethod
+  def load(cls, path: Union[str, Path]) -> "SubsetManifest":
+    """Loads a manifest saved with save()."""
+    with np.load(path) as saved:
+      return cls(indices=saved["indices"],
+                 num_samples=int(saved["num_samples"]),
+                 classes=saved["classes"].tolist() if "classes" in saved else None,
+                 folds=saved["folds"] if "folds" in saved else None,
+                 metadata=json.loads(str(saved["metadata"])),
+                 paths_hash=str(saved["paths_hash"]) if "paths_hash" in saved else None)
+
+  def select(self, fold: Optional[int]=None, holdout: bool=False) -> np.ndarray:
+    """Returns the chosen indices, optionally of a fold.
+
+    Args:
+      fold: Optional fold. Defaults to None (all chosen samples).
+      holdout: With fold, whether to return the indices in fold (e.g. for
+        validation) instead of those in every other fold (for training).
+    """
+    if fold is None:
+      return self.indices
+    if self.folds is None:
+      raise ValueError("This manifest has no folds, create it with num_folds")
+    if not 0 <= fold < self.folds.max() + 1:
+      raise ValueError(f"fold must be in [0, {self.folds.max() + 1}), got {fold}")
+    return self.indices[(self.folds == fold) == holdout]
+
+  def apply(self, dataset: Dataset, fold: Optional[int]=None, holdout: bool=False) -> VirtualSubset:
+    """Returns the subset of dataset (see select) after checking it's the base dataset."""
+    if len(dataset) != self.num_samples:
+      raise ValueError(f"Manifest was made for a dataset of {self.num_samples} samples, "
+                       f"got one of {len(dataset)}")
+    classes = getattr(dataset, "classes", None)
+    if self.classes is not None and classes is not None and list(classes) != self.classes:
+      raise ValueError("Manifest was made for a dataset with different classes")
+    if self.paths_hash is not None:
+      paths_hash = _sample_paths_hash(dataset)
+      if paths_hash is None:
+        raise ValueError(f"Can't check that the manifest matches the order of a {type(dataset).__name__}'s samples "
+                         "(e.g. a split packed without sample paths); make the manifest over the dataset itself")
+      if paths_hash != self.paths_hash:
+        raise ValueError("Manifest was made for a dataset with different files or a different file order "
+                         "(e.g. made over datasets.ImageFolder but applied to a packed, shuffled copy)")
+    return VirtualSubset(dataset, self.select(fold, holdout))
+
+
+def _time_dataloader(dataset: Dataset,
+                     batch_size: int,
+                     num_workers: int,
+                     prefetch_factor: Optional[int],
+                     step_time: float,
+                     num_batches: int) -> Tuple[float, float]:
+  """Times a DataLoader feeding a consumer that takes step_time per batch.
+
+  Returns a tuple of (seconds until the first batch, mean seconds per batch
+  the consumer waits for data once the prefetched batches are used up).
+  """
+  dataloader = DataLoader(dataset,
+                          batch_size=batch_size,
+                          shuffle=not isinstance(dataset, IterableDataset),
+                          num_workers=num_workers,
+                          prefetch_factor=prefetch_factor,
+                          pin_memory=torch.cuda.is_available())
+  warmup_batches = num_workers * (prefetch_factor or 0) + 1
+  start_time = time.perf_counter()
+  iterator = iter(dataloader)
+  startup_time, waits = 0.0, []
+  try:
+    for batch in range(min(len(dataloader), warmup_batches + num_batches)):
+      wait_start = time.perf_counter()
+      next(iterator)
+      wait = time.perf_counter() - wait_start
+      if batch == 0:
+        startup_time = time.perf_counter() - start_time
+      elif batch >= warmup_batches or len(dataloader) <= warmup_batches:
+        waits.append(wait)
+      time.sleep(step_time) # stand-in for the training step
+  finally:
+    del iterator # shuts the workers down
+  return startup_time, float(np.mean(waits)) if waits else 0.0
+
+
+def autotune_dataloader(dataset: Dataset,
+                        batch_size: int,
+                        step_time: Optional[float]=None,
+                        max_workers: Optional[int]=None,
+                        num_batches: int=10,
+                        cache_path: Optional[str]=TUNING_CACHE_PATH) -> Dict[str, Any]:
+  """Picks the cheapest DataLoader settings that keep a training loop fed.
+
+  Candidate settings are timed from cheapest to most expensive (0, 1, 2,
+  4, ... workers up to max_workers, each with a prefetch_factor of 2 and
+  then 4) against a consumer that takes step_time per batch. The first
+  one whose consumer waits less than 5% of step_time for data is picked.
+  If none keeps up, or step_time is None, the fastest one is picked
+  (preferring fewer workers when within 5% of it). persistent_workers is
+  turned on if starting the workers takes more than 5% of an epoch.
+
+  The result is printed and cached in cache_path, keyed on the machine
+  (host name, CPU count, GPU and torch version) and the workload (dataset,
+  transform, batch size, step time and max_workers), so later runs skip
+  the benchmark.
+
+  Args:
+    dataset: The Dataset to load, e.g. the training split.
+    batch_size: Number of samples per batch.
+    step_time: Seconds the training loop takes per batch (see
+      engine.measure_step_time). Defaults to None (maximize throughput).
+    max_workers: Most workers to try. Defaults to this process's share of
+      the CPU cores (all of them, divided between the processes of a
+      distributed run on this machine).
+    num_batches: Number of batches to time per candidate setting.
+    cache_path: JSON file to cache results in. None disables caching.
+
+  Returns:
+    A dictionary of DataLoader keyword arguments: {"num_workers": ...,
+    "prefetch_factor": ..., "persistent_workers": ...}.
+  """
+  if max_workers is None:
+    max_workers = max(1, (os.cpu_count() or 1) // int(os.environ.get("LOCAL_WORLD_SIZE", 1)))
+  machine = [platform.node(), str(os.cpu_count()), torch.__version__]
+  if torch.cuda.is_available():
+    machine.append(torch.cuda.get_device_name())
+  workload = [type(dataset).__name__, str(len(dataset)), str(getattr(dataset, "root", "")),
+              repr(getattr(dataset, "transform", None)), str(batch_size),
+              f"{step_time:.2g}" if step_time else "max", str(max_workers)]
+  key = hashlib.sha1("|".join(machine + workload).encode()).hexdigest()
+
+  # Reuse the result of an earlier run on this machine
+  cache = {}
+  if cache_path is not None and os.path.exists(cache_path):
+    try:
+      with open(cache_path) as f:
+        cache = json.load(f)
+    except (OSError, ValueError):
+      cache = {}
+  if key in cache:
+    settings = cache[key]
+    if ddp.is_main_process():
+      print(f"[INFO] Using cached DataLoader settings: {settings}")
+    return settings
+
+  worker_counts = [0] + [2**i for i in range(max_workers.bit_length()) if 2**i <= max_workers]
+  candidates = [(0, None)] + [(workers, prefetch) for workers in worker_counts[1:] for prefetch in (2, 4)]
+  tolerance = 0.05 * step_time if step_time else None
+  results = []
+  for num_workers, prefetch_factor in candidates:
+    startup_time, wait = _time_dataloader(dataset, batch_size, num_workers, prefetch_factor,
+                                          step_time or 0.0, num_batches)
+    results.append((num_workers, prefetch_factor, startup_time, wait))
+    if ddp.is_main_process():
+      print(f"[INFO] num_workers={num_workers}, prefetch_factor={prefetch_factor}: "
+            f"{startup_time:.3f}s startup, {wait * 1000:.2f}ms waiting per batch")
+    if tolerance is not None and wait <= tolerance:
+      break
+
+  if tolerance is not None and results[-1][3] <= tolerance:
+    best = results[-1]
+  else:
+    fastest = min(wait for _, _, _, wait in results)
+    best = next(result for result in results if result[3] <= 1.05 * fastest + 1e-4)
+  num_workers, prefetch_factor, startup_time, wait = best
+
+  num_batches_per_epoch = -(-len(dataset) // batch_size)
+  epoch_time = num_batches_per_epoch * ((step_time or 0.0) + wait)
+  settings = {"num_workers": num_workers,
+              "prefetch_factor": prefetch_factor,
+              "persistent_workers": num_workers > 0 and startup_time > 0.05 * epoch_time}
+  if ddp.is_main_process():
+    print(f"[INFO] Picked DataLoader settings: {settings}")
+
+  # Cache the result for the next run (written atomically, other processes may be tuning too)
+  if cache_path is not None:
+    cache[key] = settings
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+      os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+      with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2)
+      os.replace(tmp_path, cache_path)
+    except OSError as e:
+      print(f"[WARNING] Couldn't cache DataLoader settings in {cache_path}: {e}")
+  return settings
+
+
+def _is_packed(directory: str) -> bool:
+  """Returns True if directory is a split written by pack_dataset.py."""
+  return (Path(directory) / "index.npz").exists() and (Path(directory) / "meta.json").exists()
+
+
+def get_class_names(directory: str) -> List[str]:
+  """Returns the class names of an ImageFolder style or packed split directory."""
+  if _is_packed(directory):
+    with open(Path(directory) / "meta.json") as f:
+      return json.load(f)["classes"]
+  return find_classes(directory)[0]
+
+
+def _split_resize(transform: transforms.Compose, fixed_size: bool=False) -> Tuple[transforms.Resize, transforms.Compose]:
+  """Splits a Compose that starts with a Resize into (resize, remaining transforms).
+
+  With fixed_size=True the Resize must have a (height, width) size.
+  """
+  if not (isinstance(transform, transforms.Compose) and transform.transforms
+          and isinstance(transform.transforms[0], transforms.Resize)):
+    raise ValueError("Caching decoded images needs a transforms.Compose that starts with transforms.Resize")
+  resize = transform.transforms[0]
+  if fixed_size and (isinstance(resize.size, int) or len(resize.size) != 2):
+    raise ValueError(f"Caching decoded images needs a fixed (height, width) resize, got size={resize.size}")
+  return resize, transforms.Compose(transform.transforms[1:])
 
 def create_dataloaders(
     train_dir: str,
     test_dir: str,
     transform: transforms.Compose,
     batch_size: int,
-    num_workers: int=NUM_WORKERS
+    num_workers: Union[int, str]=NUM_WORKERS,
+    distributed: bool=False,
+    cache_dir: Optional[str]=None,
+    fast_decode: bool=False,
+    stream: bool=False,
+    memory_cache_bytes: int=0,
+    step_time: Optional[float]=None,
+    train_subset: Optional[Union[str, SubsetManifest]]=None,
+    test_subset: Optional[Union[str, SubsetManifest]]=None,
+    fold: Optional[int]=None
 ):
   """Creates training and testing DataLoaders.
 
@@ -26,7 +1468,47 @@ def create_dataloaders(
     test_dir: Path to testing directory.
     transform: torchvision transforms to perform on training and testing data.
     batch_size: Number of samples per batch in each of the DataLoaders.
-    num_workers: An integer for number of workers per DataLoader.
+    num_workers: An integer for number of workers per DataLoader, or
+      "auto" to pick the number of workers, prefetch factor and
+      persistent_workers with autotune_dataloader() (timed on the training
+      split, used for both DataLoaders).
+    distributed: Whether to split the data between the processes of a
+      distributed run (see ddp.py). batch_size is then per process. The test split is padded with a few repeated
+      samples if it doesn't divide evenly, so every process runs the same
+      number of batches.
+    cache_dir: Optional directory to cache decoded images in (see
+      CachedImageFolder). transform must then start with a fixed-size
+      transforms.Resize, which is applied once when the cache is built;
+      the rest of transform runs on the cached images every epoch.
+      Defaults to None (decode every image every epoch).
+    fast_decode: Whether to decode JPEGs at the smallest scale that still
+      covers the Resize transform starts with (see load_image). Much faster
+      for large photos, with slightly different pixels than a full-size
+      decode. Defaults to False.
+    stream: Whether to stream packed splits shard by shard with
+      TarShardStream (sequential reads, approximate shuffling) instead of
+      reading them in random order with PackedImageDataset. Needs splits
+      packed by pack_dataset.py. Defaults to False.
+    memory_cache_bytes: Optional byte budget (per split) for keeping
+      decoded images in memory, shared by all DataLoader workers (see
+      SharedCacheImageFolder). Like cache_dir, transform must start with a
+      fixed-size transforms.Resize. Defaults to 0 (no memory cache).
+    step_time: Optional seconds per training step for num_workers="auto"
+      to keep up with (see engine.measure_step_time). Defaults to None
+      (pick the fastest settings).
+    train_subset: Optional SubsetManifest (or path to a saved one) choosing
+      the training samples out of train_dir, e.g. a 20% subset. Defaults to
+      None (all of train_dir).
+    test_subset: Like train_subset, for test_dir.
+    fold: Optional fold of a k-fold train_subset to hold out: training
+      uses every other fold and the test DataLoader the held out fold (of
+      train_dir, in place of test_dir). Defaults to None.
+
+  train_dir and test_dir may also be splits packed into shards by
+  pack_dataset.py, in which case they're read with PackedImageDataset.
+
+  Unless streamed, the training data is shuffled by a SeekableSampler, so
+  engine.train can continue an interrupted epoch without replaying it.
 
   Returns:
     A tuple of (train_dataloader, test_dataloader, class_names).
@@ -39,28 +1521,206 @@ def create_dataloaders(
                              batch_size=32,
                              num_workers=4)
   """
-  # Use ImageFolder to create dataset(s)
-  train_data = datasets.ImageFolder(train_dir, transform=transform)
-  test_data = datasets.ImageFolder(test_dir, transform=transform)
+  # Use ImageFolder to create dataset(s) (or read splits packed by pack_dataset.py)
+  if stream:
+    if not (_is_packed(train_dir) and _is_packed(test_dir)):
+      raise ValueError("stream=True needs train_dir and test_dir packed by pack_dataset.py")
+    if cache_dir is not None or memory_cache_bytes > 0:
+      raise ValueError("cache_dir and memory_cache_bytes can't be used with packed splits")
+    train_data = TarShardStream(train_dir, transform=transform, shuffle=True, fast_decode=fast_decode, batch_size=batch_size)
+    test_data = TarShardStream(test_dir, transform=transform, shuffle=False, fast_decode=fast_decode, batch_size=batch_size)
+  elif _is_packed(train_dir) or _is_packed(test_dir):
+    if cache_dir is not None or memory_cache_bytes > 0:
+      raise ValueError("cache_dir and memory_cache_bytes can't be used with packed splits")
+    train_data = PackedImageDataset(train_dir, transform=transform, fast_decode=fast_decode)
+    test_data = PackedImageDataset(test_dir, transform=transform, fast_decode=fast_decode)
+  elif memory_cache_bytes > 0:
+    if cache_dir is not None:
+      raise ValueError("cache_dir and memory_cache_bytes can't be used together")
+    train_data = SharedCacheImageFolder(train_dir, transform=transform,
+                                        cache_bytes=memory_cache_bytes, fast_decode=fast_decode)
+    test_data = SharedCacheImageFolder(test_dir, transform=transform,
+                                       cache_bytes=memory_cache_bytes, fast_decode=fast_decode)
+  elif cache_dir is not None:
+    resize, remaining_transform = _split_resize(transform, fixed_size=True)
+    train_data = CachedImageFolder(train_dir, resize=resize, cache_dir=cache_dir,
+                                   transform=remaining_transform, fast_decode=fast_decode)
+    test_data = CachedImageFolder(test_dir, resize=resize, cache_dir=cache_dir,
+                                  transform=remaining_transform, fast_decode=fast_decode)
+  else:
+    loader = partial(load_image, draft_size=get_draft_size(transform) if fast_decode else None)
+    train_data = datasets.ImageFolder(train_dir, transform=transform, loader=loader)
+    test_data = datasets.ImageFolder(test_dir, transform=transform, loader=loader)
+
+  # Optionally select subsets (or a fold) of the data by index
+  if stream and (train_subset is not None or test_subset is not None):
+    raise ValueError("train_subset and test_subset can't be used with stream=True")
+  if fold is not None and (train_subset is None or test_subset is not None):
+    raise ValueError("fold needs a k-fold train_subset (and no test_subset)")
+  if isinstance(train_subset, (str, Path)):
+    train_subset = SubsetManifest.load(train_subset)
+  if isinstance(test_subset, (str, Path)):
+    test_subset = SubsetManifest.load(test_subset)
+  if fold is not None:
+    test_data = train_subset.apply(train_data, fold=fold, holdout=True)
+  elif test_subset is not None:
+    test_data = test_subset.apply(test_data)
+  if train_subset is not None:
+    train_data = train_subset.apply(train_data, fold=fold)
 
   # Get class names
   class_names = train_data.classes
 
+  # Shuffle the training data with a sampler that can resume partway through
+  # an epoch, giving each process of a distributed run its own shard of the
+  # data (streamed datasets shuffle and split their shards themselves)
+  train_sampler, test_sampler = None, None
+  if not stream:
+    train_sampler = SeekableSampler(train_data,
+                                    shuffle=True,
+                                    seed=0 if distributed else None, # every process needs the same seed
+                                    num_replicas=ddp.get_world_size() if distributed else 1,
+                                    rank=ddp.get_rank() if distributed else 0)
+  if distributed and not stream:
+    test_sampler = DistributedSampler(test_data,
+                                      num_replicas=ddp.get_world_size(),
+                                      rank=ddp.get_rank(),
+                                      shuffle=False)
+
+  # Optionally benchmark the worker settings (only pinning memory when there's a GPU to copy to)
+  if num_workers == "auto":
+    loader_settings = autotune_dataloader(train_data, batch_size=batch_size, step_time=step_time)
+  else:
+    loader_settings = {"num_workers": num_workers}
+
   # Turn images into data loaders
   train_dataloader = DataLoader(
       train_data,
       batch_size=batch_size,
-      shuffle=True,
-      num_workers=num_workers,
-      pin_memory=True,
+      shuffle=False, # the sampler (or stream) shuffles instead
+      sampler=train_sampler,
+      pin_memory=torch.cuda.is_available(),
+      **loader_settings
   )
   test_dataloader = DataLoader(
       test_data,
       batch_size=batch_size,
       shuffle=False, # don't need to shuffle test data
-      num_workers=num_workers,
-      pin_memory=True,
+      sampler=test_sampler,
+      pin_memory=torch.cuda.is_available(),
+      **loader_settings
   )
 
   # The following line was missing, causing the function to implicitly return None
   return (train_dataloader, test_dataloader, class_names) # Return the dataloaders and class names
+
+
+class DevicePrefetcher:
+  """Wraps a DataLoader to fetch batches and copy them to the device ahead of time.
+
+  A background thread pulls up to num_batches batches from the DataLoader
+  and moves them to the target device while the training loop is busy with
+  the current batch. On CUDA the copies are issued with non_blocking=True on
+  a separate stream (use pin_memory=True in the DataLoader for them to
+  overlap); on CPU the thread overlaps waiting on the DataLoader (and
+  in-process loading when num_workers=0) with compute.
+
+  Anything that reads .sampler or .dataset or calls len() keeps working, so
+  it can be passed to engine.train_step() in place of the DataLoader.
+
+  The DataLoader iterator is created by iter() on the calling thread, so
+  it draws its workers' base seed from the global random generator at the
+  same point as iterating the DataLoader directly would. With
+  num_workers=0, though, the background thread runs the transforms and
+  draws from the global random generators while training does, so runs
+  aren't bit-for-bit reproducible in that setting.
+
+  Args:
+    dataloader: A DataLoader to prefetch from.
+    device: A target device to copy batches to (e.g. "cuda" or "cpu").
+    num_batches: Number of batches to stage ahead of the training loop.
+
+  Example usage:
+    train_dataloader = DevicePrefetcher(train_dataloader, device="cuda")
+    for X, y in train_dataloader:
+      ... # X and y are already on the device
+  """
+  def __init__(self,
+               dataloader: DataLoader,
+               device: torch.device,
+               num_batches: int=2) -> None:
+    self.dataloader = dataloader
+    self.device = torch.device(device)
+    self.num_batches = num_batches
+
+  @property
+  def dataset(self):
+    return self.dataloader.dataset
+
+  @property
+  def sampler(self):
+    return self.dataloader.sampler
+
+  def __len__(self) -> int:
+    return len(self.dataloader)
+
+  def _load(self, iterator: Iterator, batches: queue.Queue, stop: threading.Event):
+    """Runs in the background thread, filling batches until stopped."""
+    stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+    try:
+      for batch in iterator:
+        ready = None
+        if stream is not None:
+          with torch.cuda.stream(stream):
+            batch = [tensor.to(self.device, non_blocking=True) for tensor in batch]
+            ready = torch.cuda.Event()
+            ready.record(stream)
+        else:
+          batch = [tensor.to(self.device) for tensor in batch]
+        if not self._put(batches, stop, (batch, ready)):
+          return
+    except Exception as e:
+      self._put(batches, stop, e)
+      return
+    self._put(batches, stop, None)
+
+  @staticmethod
+  def _put(batches: queue.Queue, stop: threading.Event, item) -> bool:
+    """Puts item in the queue unless stop is set first. Returns True if put."""
+    while not stop.is_set():
+      try:
+        batches.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+
+  def __iter__(self) -> Iterator[Tuple[torch.Tensor, ...]]:
+    # Create the DataLoader iterator (which draws the workers' base seed) here
+    # rather than in the thread, where it would race the training loop's draws
+    return self._iterate(iter(self.dataloader))
+
+  def _iterate(self, iterator: Iterator) -> Iterator[Tuple[torch.Tensor, ...]]:
+    batches = queue.Queue(maxsize=self.num_batches)
+    stop = threading.Event()
+    thread = threading.Thread(target=self._load, args=(iterator, batches, stop), daemon=True)
+    thread.start()
+    try:
+      while True:
+        item = batches.get()
+        if item is None:
+          return
+        if isinstance(item, Exception):
+          raise item
+        batch, ready = item
+        if ready is not None:
+          # Wait for the copy and tell the allocator the tensors are used on this stream
+          current_stream = torch.cuda.current_stream(self.device)
+          current_stream.wait_event(ready)
+          for tensor in batch:
+            tensor.record_stream(current_stream)
+        yield tuple(batch)
+    finally:
+      # Stop the thread if iteration ends early (e.g. break or an exception)
+      stop.set()
+      thread.join()
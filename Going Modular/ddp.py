@@ -0,0 +1,127 @@
+"""
+Contains helpers for multi-process DistributedDataParallel (DDP) training.
+
+Processes are either launched with torchrun, e.g.
+  torchrun --nproc_per_node=4 train.py
+or with spawn() below. Either way each process finds its rank and the
+world size in the RANK/WORLD_SIZE/LOCAL_RANK environment variables and
+joins the process group with setup(). The gloo backend is used on CPU-only
+machines and NCCL when CUDA is available.
+"""
+import multiprocessing
+import os
+import socket
+
+from typing import Callable, Optional
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def is_launched() -> bool:
+  """Returns True if this process was started by torchrun or spawn()."""
+  return "RANK" in os.environ and "WORLD_SIZE" in os.environ
+
+
+def is_distributed() -> bool:
+  """Returns True if the default process group has been initialized."""
+  return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+  """Returns the rank of this process (0 when not distributed)."""
+  return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+  """Returns the number of processes (1 when not distributed)."""
+  return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process() -> bool:
+  """Returns True on rank 0, the process that prints and saves."""
+  return get_rank() == 0
+
+
+def setup(backend: Optional[str]=None) -> torch.device:
+  """Joins the process group described by the environment variables.
+
+  Also splits this machine's CPU cores evenly between its processes, since
+  every process would otherwise start one intra-op thread per core.
+
+  Args:
+    backend: A torch.distributed backend. Defaults to "nccl" if CUDA is
+      available, otherwise "gloo".
+
+  Returns:
+    The device this process should train on.
+  """
+  rank = int(os.environ["RANK"])
+  world_size = int(os.environ["WORLD_SIZE"])
+  local_rank = int(os.environ.get("LOCAL_RANK", rank))
+  local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", world_size))
+  if backend is None:
+    backend = "nccl" if torch.cuda.is_available() else "gloo"
+
+  torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+  dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+
+  if backend == "nccl":
+    torch.cuda.set_device(local_rank)
+    return torch.device("cuda", local_rank)
+  return torch.device("cpu")
+
+
+def cleanup():
+  """Leaves the process group (if one was joined)."""
+  if is_distributed():
+    dist.destroy_process_group()
+
+
+def all_reduce_sum(tensor: torch.Tensor) -> torch.Tensor:
+  """Sums tensor in place across all processes (no-op when not distributed)."""
+  if is_distributed():
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+  return tensor
+
+
+def _find_free_port() -> int:
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+    s.bind(("127.0.0.1", 0))
+    return s.getsockname()[1]
+
+
+def _spawn_worker(local_rank: int, fn: Callable, world_size: int, master_port: int, args: tuple):
+  os.environ.update({"RANK": str(local_rank),
+                     "LOCAL_RANK": str(local_rank),
+                     "WORLD_SIZE": str(world_size),
+                     "LOCAL_WORLD_SIZE": str(world_size),
+                     "MASTER_ADDR": "127.0.0.1",
+                     "MASTER_PORT": str(master_port)})
+  # Spawned processes inherit "spawn" as their start method; go back to the
+  # platform default so DataLoader workers don't re-import everything
+  multiprocessing.set_start_method(None, force=True)
+  fn(*args)
+
+
+def spawn(fn: Callable, world_size: int, *args):
+  """Runs fn(*args) in world_size processes on this machine.
+
+  Each process gets the same environment variables torchrun would set, so
+  fn should call setup() (and cleanup()) just like a torchrun script.
+  fn and args must be picklable (e.g. fn defined at module level).
+
+  Example usage:
+    def main():
+      device = ddp.setup()
+      ...
+      ddp.cleanup()
+
+    if __name__ == "__main__":
+      ddp.spawn(main, 4)
+  """
+  mp.spawn(_spawn_worker,
+           args=(fn, world_size, _find_free_port(), args),
+           nprocs=world_size,
+           join=True)
@@ -3,75 +3,282 @@
 Contains functions for training and testinga PyTorch Modle\
 """
 
-from typing import Dict, List, Tuple
+import contextlib
+import functools
+import hashlib
+import os
+import shutil
+import time
+
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from tqdm.auto import tqdm
+import numpy as np
 import torch
 
+from torch.nn.parallel import DistributedDataParallel
+
+import data_setup
+import ddp
+import utils
+
+
+def _compute_metrics(loss_sum: torch.Tensor,
+                     correct: torch.Tensor,
+                     num_samples: int) -> Tuple[float, float]:
+  """Turns on-device running sums into average loss and accuracy.
+
+  Copies both sums to the host in a single transfer, so calling this once
+  per epoch (or per logging interval) is the only point the training loop
+  waits on the device. In distributed runs the sums are added up across
+  all processes first, so every process must call this at the same point.
+
+  Args:
+    loss_sum: Sum of the per-batch losses weighted by batch size.
+    correct: Number of correct predictions.
+    num_samples: Number of samples seen.
+
+  Returns:
+    A tuple of (average_loss, accuracy).
+  """
+  totals = torch.stack([loss_sum.double(),
+                        correct.double(),
+                        torch.tensor(num_samples, dtype=torch.float64, device=loss_sum.device)])
+  loss_sum, correct, num_samples = ddp.all_reduce_sum(totals).tolist()
+  if num_samples == 0:
+    return 0.0, 0.0
+  return loss_sum / num_samples, correct / num_samples
+
+
+def _to_device(X: torch.Tensor,
+               device: torch.device,
+               channels_last: bool=False,
+               batch_transform: Optional[Callable[[torch.Tensor], torch.Tensor]]=None) -> torch.Tensor:
+  """Sends a batch of inputs to the target device.
+
+  If given, batch_transform (see batch_transforms.py) is applied to the
+  batch once it's on the device. With channels_last=True 4D image batches
+  are also converted to the channels_last (NHWC) memory format; other
+  inputs are left as they are.
+  """
+  X = X.to(device)
+  if batch_transform is not None:
+    X = batch_transform(X)
+  if channels_last and X.dim() == 4:
+    return X.contiguous(memory_format=torch.channels_last)
+  return X
+
+
+def _record_time(timings: Optional[Dict[str, float]],
+                 phase: str,
+                 start_time: float,
+                 device_type: str) -> float:
+  """Adds the time since start_time to timings[phase] if timings is given.
+
+  Waits for queued CUDA work first so it's attributed to the right phase.
+  Does nothing (and never syncs) when timings is None.
+
+  Returns:
+    The current time, to be used as the start of the next phase.
+  """
+  if timings is None:
+    return start_time
+  if device_type == "cuda":
+    torch.cuda.synchronize()
+  now = time.perf_counter()
+  timings[phase] = timings.get(phase, 0.0) + now - start_time
+  return now
+
 
 def train_step(model: torch.nn.Module,
                dataloader: torch.utils.data.DataLoader,
                loss_fn: torch.nn.Module,
                optimizer: torch.optim.Optimizer,
-               device: torch.device) -> Tuple[float, float]:
+               device: torch.device,
+               log_interval: Optional[int]=None,
+               accumulation_steps: int=1,
+               use_amp: bool=False,
+               step_fn: Optional[Callable[[], None]]=None,
+               resume_state: Optional[Dict[str, Any]]=None,
+               callback: Optional[Callable[[Dict[str, Any]], None]]=None,
+               timings: Optional[Dict[str, float]]=None,
+               channels_last: bool=False,
+               batch_transform: Optional[Callable[[torch.Tensor], torch.Tensor]]=None,
+               exact_resume: bool=False) -> Tuple[float, float]:
   """Trains a PyTorch model for a single epoch.
 
   Turns a target PyTorch model to training mode and then
   runs through all of the required training steps (forward
   pass, loss calculation, optimizer step).
 
+  With accumulation_steps > 1 each DataLoader batch is treated as one
+  logical batch: it's split into that many micro-batches, gradients are
+  accumulated across them and the optimizer steps once per logical batch.
+  Layers that use batch statistics (e.g. BatchNorm) see micro-batches.
+
+  With use_amp=True the forward pass runs under bfloat16 autocast while
+  the loss, gradients and optimizer state stay in fp32.
+
   Args:
     model: A PyTorch model to be trained.
     dataloader: A DataLoader instance for the model to be trained on.
     loss_fn: A PyTorch loss function to minimize.
     optimizer: A PyTorch optimizer to help minimize the loss function.
     device: A target device to compute on (e.g. "cuda" or "cpu").
+    log_interval: Optional number of batches between printing the running
+      metrics. Metrics stay on the device in between, so the default (None)
+      only syncs once at the end of the epoch.
+    accumulation_steps: Number of micro-batches to split each DataLoader
+      batch into. Defaults to 1 (one forward/backward per batch).
+    use_amp: Whether to run the forward pass under bfloat16 autocast.
+    step_fn: Optional callable used in place of optimizer.step(), e.g. a
+      compiled optimizer step. Defaults to None (optimizer.step).
+    resume_state: Optional epoch progress dictionary (as passed to callback)
+      to continue a partially finished epoch from. The first
+      resume_state["batch"] batches are skipped and, if present,
+      resume_state["rng_state"] is restored before training continues.
+      A sampler with set_start (e.g. data_setup.SeekableSampler) starts
+      right after them, unless exact_resume; otherwise they're loaded and
+      thrown away, and the dataloader must be created from the same random
+      state as the interrupted epoch for them to match.
+    callback: Optional callable called after every optimizer step with a
+      dictionary of epoch progress: {"batch": batches done, "loss_sum": ...,
+      "correct": ..., "num_samples": ...}. The running metrics are
+      on-device tensors, so reading them forces a sync.
+    timings: Optional dictionary to add per-phase wall-clock seconds to,
+      under the keys "data" (waiting on the dataloader), "to_device",
+      "forward" (including the loss), "backward" and "optimizer", plus
+      "samples_per_sec" for the epoch. On CUDA each phase boundary syncs,
+      so only pass this when the breakdown is wanted. Defaults to None.
+    channels_last: Whether to convert image batches to the channels_last
+      (NHWC) memory format. The model should be converted as well.
+    batch_transform: Optional callable applied to every input batch once
+      it's on the device, e.g. batched augmentation from batch_transforms.py.
+      Its time counts towards "to_device". Defaults to None.
+    exact_resume: Whether to load and throw away the skipped batches of
+      resume_state even when the sampler could seek past them, so random
+      transforms in DataLoader workers draw the same random numbers as in
+      the interrupted epoch. Defaults to False.
 
   Returns:
-    A tuple of training loss and training accuracy metrics.
+    A tuple of training loss and training accuracy metrics, averaged
+    over samples (loss_fn is expected to use mean reduction).
     In the form (train_loss, train_accuracy). For example:
 
     (0.1112, 0.8743)
   """
   # Put model in train mode
   model.train()
+  device_type = torch.device(device).type
+  step_fn = step_fn or optimizer.step
+  ddp_model = getattr(model, "_orig_mod", model) # look through torch.compile
 
-  # Setup train loss and train accuracy values
-  train_loss, train_acc = 0, 0
+  # Setup running loss sum and correct prediction count on the target device
+  # so accumulating them doesn't force a host sync every batch
+  train_loss = torch.zeros((), device=device)
+  train_correct = torch.zeros((), dtype=torch.long, device=device)
+  num_samples = 0
+
+  # Continue a partially finished epoch after the batches already trained on,
+  # seeking straight past them when the sampler can (see data_setup.SeekableSampler)
+  # or else loading and throwing them away
+  start_batch = 0
+  seek = hasattr(dataloader.sampler, "set_start") and not exact_resume
+  if resume_state is not None:
+      start_batch = resume_state["batch"]
+      train_loss += resume_state["loss_sum"].to(device)
+      train_correct += resume_state["correct"].to(device)
+      num_samples = resume_state["num_samples"]
+      if seek:
+          dataloader.sampler.set_start(num_samples)
+  iterator = iter(dataloader)
+  if resume_state is not None:
+      if not seek:
+          for _ in range(start_batch):
+              next(iterator)
+
+      # The sampler has drawn its random numbers by now, so restore the
+      # random state from the point the epoch was interrupted at
+      if "rng_state" in resume_state:
+          utils.set_rng_state(resume_state["rng_state"])
 
   # Loop through data loader data batches
-  for batch, (X, y) in enumerate(dataloader):
+  epoch_start_time = phase_start_time = time.perf_counter()
+  for batch, (X, y) in enumerate(iterator, start=start_batch):
+      phase_start_time = _record_time(timings, "data", phase_start_time, device_type)
+
       # Send data to target device
-      X, y = X.to(device), y.to(device)
+      X, y = _to_device(X, device, channels_last, batch_transform), y.to(device)
+      phase_start_time = _record_time(timings, "to_device", phase_start_time, device_type)
+
+      # 1. Optimizer zero grad (once per logical batch)
+      optimizer.zero_grad()
 
-      # 1. Forward pass
-      y_pred = model(X)
+      # 2. Split the logical batch into micro-batches so only one
+      # micro-batch of activations is held in memory at a time
+      micro_batches = [(X_micro, y_micro) for X_micro, y_micro in zip(torch.tensor_split(X, accumulation_steps),
+                                                                      torch.tensor_split(y, accumulation_steps))
+                       if len(y_micro) > 0]
+      for micro_batch, (X_micro, y_micro) in enumerate(micro_batches):
+          # With DDP, only all-reduce the gradients in the last micro-batch's backward
+          sync = micro_batch == len(micro_batches) - 1 or not isinstance(ddp_model, DistributedDataParallel)
+          with contextlib.nullcontext() if sync else ddp_model.no_sync():
+              # 3. Forward pass (optionally in bfloat16 autocast)
+              with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=use_amp):
+                  y_pred = model(X_micro)
 
-      # 2. Calculate  and accumulate loss
-      loss = loss_fn(y_pred, y)
-      train_loss += loss.item()
+              # 4. Calculate and accumulate loss in fp32 (weighted by micro-batch size)
+              loss = loss_fn(y_pred.float(), y_micro)
+              train_loss += loss.detach() * len(y_micro)
 
-      # 3. Optimizer zero grad
-      optimizer.zero_grad()
+              # Calculate and accumulate correct predictions (argmax of the logits
+              # is the same as argmax of the softmax probabilities)
+              y_pred_class = y_pred.argmax(dim=1)
+              train_correct += (y_pred_class == y_micro).sum()
+              phase_start_time = _record_time(timings, "forward", phase_start_time, device_type)
+
+              # 5. Loss backward, scaled so the accumulated gradients equal
+              # the gradients of the mean loss over the whole logical batch
+              (loss * (len(y_micro) / len(y))).backward()
+              phase_start_time = _record_time(timings, "backward", phase_start_time, device_type)
+
+      # 6. Optimizer step (once per logical batch)
+      step_fn()
+      num_samples += len(y)
+      _record_time(timings, "optimizer", phase_start_time, device_type)
+
+      if callback is not None:
+          callback({"batch": batch + 1,
+                    "loss_sum": train_loss,
+                    "correct": train_correct,
+                    "num_samples": num_samples})
 
-      # 4. Loss backward
-      loss.backward()
+      # Optionally sync and print the running metrics
+      if log_interval and (batch + 1) % log_interval == 0:
+          running_loss, running_acc = _compute_metrics(train_loss, train_correct, num_samples)
+          if ddp.is_main_process():
+              print(f"  batch: {batch+1}/{len(dataloader)} | "
+                    f"train_loss: {running_loss:.4f} | "
+                    f"train_acc: {running_acc:.4f}")
 
-      # 5. Optimizer step
-      optimizer.step()
+      # Start timing the wait for the next batch
+      phase_start_time = time.perf_counter()
 
-      # Calculate and accumulate accuracy metric across all batches
-      y_pred_class = torch.argmax(torch.softmax(y_pred, dim=1), dim=1)
-      train_acc += (y_pred_class == y).sum().item()/len(y_pred)
+  if timings is not None:
+      num_trained = num_samples - (resume_state["num_samples"] if resume_state else 0)
+      timings["samples_per_sec"] = num_trained / (time.perf_counter() - epoch_start_time)
 
-  # Adjust metrics to get average loss and accuracy per batch
-  train_loss = train_loss / len(dataloader)
-  train_acc = train_acc / len(dataloader)
-  return train_loss, train_acc
+  # Sync once to get average loss and accuracy per sample
+  return _compute_metrics(train_loss, train_correct, num_samples)
 
 def test_step(model: torch.nn.Module,
               dataloader: torch.utils.data.DataLoader,
               loss_fn: torch.nn.Module,
-              device: torch.device) -> Tuple[float, float]:
+              device: torch.device,
+              use_amp: bool=False,
+              timings: Optional[Dict[str, float]]=None,
+              channels_last: bool=False,
+              batch_transform: Optional[Callable[[torch.Tensor], torch.Tensor]]=None) -> Tuple[float, float]:
   """Tests a PyTorch model for a single epoch.
 
   Turns a target PyTorch model to "eval" mode and then performs
@@ -82,41 +289,517 @@ def test_step(model: torch.nn.Module,
     dataloader: A DataLoader instance for the model to be tested on.
     loss_fn: A PyTorch loss function to calculate loss on the test data.
     device: A target device to compute on (e.g. "cuda" or "cpu").
+    use_amp: Whether to run the forward pass under bfloat16 autocast
+      (the loss is still computed in fp32).
+    timings: Optional dictionary to add per-phase wall-clock seconds to,
+      under the keys "data", "to_device" and "forward", plus
+      "samples_per_sec" for the epoch. Defaults to None.
+    channels_last: Whether to convert image batches to the channels_last
+      (NHWC) memory format. The model should be converted as well.
+    batch_transform: Optional callable applied to every input batch once
+      it's on the device (see batch_transforms.py). Defaults to None.
 
   Returns:
-    A tuple of testing loss and testing accuracy metrics.
+    A tuple of testing loss and testing accuracy metrics, averaged
+    over samples.
     In the form (test_loss, test_accuracy). For example:
 
     (0.0223, 0.8985)
   """
   # Put model in eval mode
   model.eval()
+  device_type = torch.device(device).type
 
-  # Setup test loss and test accuracy values
-  test_loss, test_acc = 0, 0
+  # Setup running loss sum and correct prediction count on the target device
+  test_loss = torch.zeros((), device=device)
+  test_correct = torch.zeros((), dtype=torch.long, device=device)
+  num_samples = 0
 
   # Turn on inference context manager
   with torch.inference_mode():
       # Loop through DataLoader batches
+      epoch_start_time = phase_start_time = time.perf_counter()
       for batch, (X, y) in enumerate(dataloader):
+          phase_start_time = _record_time(timings, "data", phase_start_time, device_type)
+
           # Send data to target device
-          X, y = X.to(device), y.to(device)
+          X, y = _to_device(X, device, channels_last, batch_transform), y.to(device)
+          phase_start_time = _record_time(timings, "to_device", phase_start_time, device_type)
 
-          # 1. Forward pass
-          test_pred_logits = model(X)
+          # 1. Forward pass (optionally in bfloat16 autocast)
+          with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=use_amp):
+              test_pred_logits = model(X).float()
 
-          # 2. Calculate and accumulate loss
+          # 2. Calculate and accumulate loss (weighted by batch size)
           loss = loss_fn(test_pred_logits, y)
-          test_loss += loss.item()
+          test_loss += loss * len(y)
 
-          # Calculate and accumulate accuracy
+          # Calculate and accumulate correct predictions
           test_pred_labels = test_pred_logits.argmax(dim=1)
-          test_acc += ((test_pred_labels == y).sum().item()/len(test_pred_labels))
+          test_correct += (test_pred_labels == y).sum()
+          num_samples += len(y)
+          phase_start_time = _record_time(timings, "forward", phase_start_time, device_type)
+
+  if timings is not None:
+      timings["samples_per_sec"] = num_samples / (time.perf_counter() - epoch_start_time)
+
+  # Sync once to get average loss and accuracy per sample
+  return _compute_metrics(test_loss, test_correct, num_samples)
+
+
+@contextlib.contextmanager
+def _preserve_model_state(model: torch.nn.Module):
+  """Restores the model's buffers, mode and the random state and clears gradients on exit."""
+  was_training = model.training
+  rng_state = torch.get_rng_state()
+  cuda_rng_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+  buffers = {name: buffer.clone() for name, buffer in model.named_buffers()}
+  try:
+    yield
+  finally:
+    with torch.no_grad():
+      for name, buffer in model.named_buffers():
+        buffer.copy_(buffers[name])
+    for param in model.parameters():
+      param.grad = None
+    torch.set_rng_state(rng_state)
+    if cuda_rng_state is not None:
+      torch.cuda.set_rng_state_all(cuda_rng_state)
+    model.train(was_training)
+
+
+def _compile_model(model: torch.nn.Module,
+                   dataloader: torch.utils.data.DataLoader,
+                   loss_fn: torch.nn.Module,
+                   device: torch.device,
+                   compile_mode: str,
+                   use_amp: bool=False,
+                   channels_last: bool=False,
+                   batch_transform: Optional[Callable[[torch.Tensor], torch.Tensor]]=None) -> Tuple[torch.nn.Module, float]:
+  """Compiles a model with torch.compile and warms it up on one batch.
+
+  torch.compile is lazy, so the first batch of a training forward/backward
+  and of an eval forward is run here to trigger compilation. The model's
+  parameters aren't updated and its buffers (e.g. BatchNorm running stats),
+  gradients and the random number generator state are restored afterwards.
+  If compiling fails for any reason the eager model is returned instead.
+
+  Args:
+    model: A PyTorch model to compile.
+    dataloader: A DataLoader to take the warm-up batch from.
+    loss_fn: A PyTorch loss function for the warm-up backward pass.
+    device: A target device to compute on (e.g. "cuda" or "cpu").
+    compile_mode: A torch.compile mode, e.g. "default", "reduce-overhead"
+      or "max-autotune".
+    use_amp: Whether to warm up under bfloat16 autocast.
+    channels_last: Whether to warm up on channels_last inputs.
+    batch_transform: Optional callable to apply to the warm-up batch.
+
+  Returns:
+    A tuple of (model, compile_time) where model is the compiled model (or
+    the eager model if compilation failed) and compile_time is the warm-up
+    time in seconds.
+  """
+  device_type = torch.device(device).type
+  start_time = time.perf_counter()
+  # Undo the side effects of the warm-up batch afterwards
+  with _preserve_model_state(model):
+    try:
+      compiled_model = torch.compile(model, mode=compile_mode)
+      X, y = next(iter(dataloader))
+      X, y = _to_device(X, device, channels_last, batch_transform), y.to(device)
+
+      # Compile the training forward and backward graphs
+      compiled_model.train()
+      with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=use_amp):
+        y_pred = compiled_model(X)
+      loss_fn(y_pred.float(), y).backward()
+
+      # Compile the eval forward graph
+      compiled_model.eval()
+      with torch.inference_mode(), torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=use_amp):
+        compiled_model(X)
+    except Exception as e:
+      print(f"[WARNING] torch.compile failed, falling back to eager mode: {type(e).__name__}: {e}")
+      compiled_model = model
+  compile_time = time.perf_counter() - start_time
+
+  return compiled_model, compile_time
+
+
+def measure_step_time(model: torch.nn.Module,
+                      loss_fn: torch.nn.Module,
+                      X: torch.Tensor,
+                      y: torch.Tensor,
+                      device: torch.device,
+                      num_steps: int=5,
+                      use_amp: bool=False) -> float:
+  """Measures how long a training forward and backward pass takes on one batch.
+
+  Useful for sizing the input pipeline (see data_setup.autotune_dataloader):
+  the DataLoader has to deliver a batch at least this often to keep the
+  model busy. One untimed step is run first. Like compiling, this leaves
+  the model's buffers, gradients, mode and the random state as they were
+  (the optimizer isn't stepped, so its time isn't included).
+
+  Args:
+    model: A PyTorch model.
+    loss_fn: A PyTorch loss function.
+    X: A batch of inputs (e.g. torch.rand(32, 3, 64, 64)).
+    y: A batch of targets.
+    device: A target device to compute on (e.g. "cuda" or "cpu").
+    num_steps: Number of timed steps to average over.
+    use_amp: Whether to run the forward pass under bfloat16 autocast.
+
+  Returns:
+    The mean seconds per step.
+  """
+  device_type = torch.device(device).type
+  X, y = X.to(device), y.to(device)
+  with _preserve_model_state(model):
+    model.train()
+    for step in range(num_steps + 1):
+      if step == 1: # the first step is an untimed warm-up
+        if device_type == "cuda":
+          torch.cuda.synchronize()
+        start_time = time.perf_counter()
+      with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=use_amp):
+        y_pred = model(X)
+      loss_fn(y_pred.float(), y).backward()
+    if device_type == "cuda":
+      torch.cuda.synchronize()
+    step_time = (time.perf_counter() - start_time) / num_steps
+  return step_time
+
+
+def _get_head_name(model: torch.nn.Module) -> str:
+  """Returns the name of the only top-level submodule of model with trainable parameters."""
+  trainable = [name for name, child in model.named_children()
+               if any(param.requires_grad for param in child.parameters())]
+  if len(trainable) != 1 or any(param.requires_grad for param in model.parameters(recurse=False)):
+    raise ValueError("Caching features needs a model whose only trainable parameters are in one "
+                     "top-level head module (e.g. model_builder.create_effnetb2_model's classifier "
+                     f"or create_vit_model's heads), got trainable modules: {trainable}")
+  return trainable[0]
+
+
+def _describe_code(code: Any) -> str:
+  """Returns a hash of a code object's bytecode and constants (including nested functions')."""
+  constants = [_describe_code(constant) if hasattr(constant, "co_code") else repr(constant) for constant in code.co_consts]
+  return hashlib.sha1(code.co_code + repr(constants).encode()).hexdigest()[:16]
+
+
+def _describe_callable(function: Any) -> str:
+  """Returns a description of a callable that's the same in every process and run.
+
+  Unlike repr(), which for functions, lambdas and plain objects contains a
+  memory address, functions are described by their name, code, defaults
+  and closure, functools.partials by their function and arguments and
+  objects without a repr of their own by their class and attributes.
+  """
+  if isinstance(function, functools.partial):
+    return (f"partial({_describe_callable(function.func)}, {[_describe_callable(arg) for arg in function.args]}, "
+            f"{[(key, _describe_callable(value)) for key, value in sorted(function.keywords.items())]})")
+  if hasattr(function, "__code__"):
+    closure = [_describe_callable(cell.cell_contents) for cell in function.__closure__ or ()]
+    defaults = [_describe_callable(default) for default in function.__defaults__ or ()]
+    return (f"{function.__module__}.{function.__qualname__}"
+            f"({_describe_code(function.__code__)}, {defaults}, {closure})")
+  if hasattr(function, "__qualname__"): # classes and builtins
+    return f"{getattr(function, '__module__', '')}.{function.__qualname__}"
+  description = repr(function)
+  if " at 0x" in description and hasattr(function, "__dict__"):
+    attributes = [(name, _describe_callable(value)) for name, value in sorted(vars(function).items())]
+    return f"{type(function).__module__}.{type(function).__qualname__}({attributes})"
+  return description
+
+
+def _update_dataset_fingerprint(fingerprint: Any, dataset: torch.utils.data.Dataset) -> None:
+  """Adds which samples of which files dataset loads (and how) to a hashlib hash.
+
+  Subsets (data_setup.VirtualSubset, torch.utils.data.Subset) add their
+  indices and then their base dataset's fingerprint; datasets read from
+  disk add their root, files, loader and transform. Raises ValueError for
+  datasets it can't identify, rather than risk reusing another dataset's
+  features.
+  """
+  if hasattr(dataset, "dataset") and hasattr(dataset, "indices"):
+    fingerprint.update(f"{type(dataset).__name__}|".encode())
+    fingerprint.update(np.ascontiguousarray(dataset.indices, dtype=np.int64).tobytes())
+    _update_dataset_fingerprint(fingerprint, dataset.dataset)
+    return
+  if isinstance(dataset, data_setup.FeatureDataset):
+    fingerprint.update(f"FeatureDataset|{dataset.path.resolve()}".encode())
+    return
+  root = getattr(dataset, "root", None)
+  if root is None:
+    raise ValueError(f"Can't identify the files of a {type(dataset).__name__} to key the feature cache on "
+                     "(it needs a root, or to be a subset of a dataset with one)")
+  fingerprint.update(f"{type(dataset).__name__}|{Path(root).resolve()}|{len(dataset)}|"
+                     f"{getattr(dataset, 'transform', None)!r}|{getattr(dataset, 'draft_size', None)}|"
+                     f"{getattr(dataset, 'resize', None)!r}|{getattr(dataset, 'shard_names', None)}|"
+                     f"{_describe_callable(getattr(dataset, 'loader', None))}|"
+                     f"{data_setup._sample_paths_hash(dataset)}".encode())
+
 
-  # Adjust metrics to get average loss and accuracy per batch
-  test_loss = test_loss / len(dataloader)
-  test_acc = test_acc / len(dataloader)
-  return test_loss, test_acc
+def cache_features(model: torch.nn.Module,
+                   dataloader: torch.utils.data.DataLoader,
+                   device: torch.device,
+                   cache_dir: str,
+                   use_amp: bool=False,
+                   channels_last: bool=False,
+                   batch_transform: Optional[Callable[[torch.Tensor], torch.Tensor]]=None) -> data_setup.FeatureDataset:
+  """Runs a model's frozen backbone once over a dataset and caches its features.
+
+  The model's head (its only top-level submodule with trainable parameters,
+  e.g. "classifier" or "heads") is swapped for nn.Identity and the rest of
+  the model runs in eval mode over every sample of dataloader.dataset, in
+  order. The outputs (e.g. EffNetB2's pooled 1408-dim features) are stored
+  in a memory-mapped float32 array under cache_dir, so the head can be
+  trained on them without running the backbone again.
+
+  The cache is keyed on the backbone's weights and on which samples of
+  which files the dataset loads and how (its root, file list, loader,
+  transform and labels, and the indices of any subset of it, e.g. a fold),
+  so changing any of those builds a new one (edit images in place and the
+  cache has to be deleted by hand). Random
+  augmentations are baked in by the single pass, so the dataset should
+  use deterministic transforms.
+
+  Args:
+    model: A PyTorch model with a frozen backbone and a trainable head.
+    dataloader: A DataLoader over a map-style dataset (its batch size,
+      workers and collate_fn are reused, its sampler isn't).
+    device: A target device to compute on (e.g. "cuda" or "cpu").
+    cache_dir: Directory to store feature caches in.
+    use_amp: Whether to run the backbone under bfloat16 autocast.
+    channels_last: Whether to convert image batches to channels_last.
+    batch_transform: Optional callable applied to every batch once it's on
+      the device (see train_step).
+
+  Returns:
+    A data_setup.FeatureDataset of the features and labels.
+  """
+  dataset = dataloader.dataset
+  if isinstance(dataset, torch.utils.data.IterableDataset):
+    raise ValueError("Caching features needs a map-style dataset, not a stream")
+  if len(dataset) == 0:
+    raise ValueError("Can't cache the features of an empty dataset")
+  head_name = _get_head_name(model)
+
+  # Key the cache on the backbone weights and the dataset
+  fingerprint = hashlib.sha1(f"{_describe_callable(batch_transform)}|{use_amp}|".encode())
+  _update_dataset_fingerprint(fingerprint, dataset)
+  for name, tensor in model.state_dict().items():
+    if not name.startswith(f"{head_name}."):
+      fingerprint.update(name.encode())
+      fingerprint.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+  try:
+    fingerprint.update(np.ascontiguousarray(data_setup._get_targets(dataset), dtype=np.int64).tobytes())
+  except ValueError:
+    pass
+  cache_path = Path(cache_dir) / fingerprint.hexdigest()[:16]
+  if (cache_path / "labels.npy").exists():
+    return data_setup.FeatureDataset(cache_path)
+
+  loader = torch.utils.data.DataLoader(dataset,
+                                       batch_size=dataloader.batch_size or 32,
+                                       shuffle=False,
+                                       num_workers=dataloader.num_workers,
+                                       collate_fn=dataloader.collate_fn,
+                                       pin_memory=torch.cuda.is_available())
+  tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+  tmp_path.mkdir(parents=True, exist_ok=True)
+  if ddp.is_main_process():
+    print(f"[INFO] Caching backbone features of {len(dataset)} samples to: {cache_path}")
+
+  device_type = torch.device(device).type
+  head = getattr(model, head_name)
+  setattr(model, head_name, torch.nn.Identity())
+  try:
+    with _preserve_model_state(model), torch.inference_mode():
+      model.eval()
+      features, labels, start = None, [], 0
+      for X, y in tqdm(loader, disable=not ddp.is_main_process()):
+        X = _to_device(X, device, channels_last, batch_transform)
+        with torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=use_amp):
+          batch_features = model(X).float().flatten(1).cpu().numpy()
+        if features is None:
+          features = np.lib.format.open_memmap(tmp_path / "features.npy", mode="w+", dtype=np.float32,
+                                               shape=(len(dataset), batch_features.shape[1]))
+        features[start:start + len(batch_features)] = batch_features
+        labels.append(y.numpy())
+        start += len(batch_features)
+  finally:
+    setattr(model, head_name, head)
+  features.flush()
+  del features
+  np.save(tmp_path / "labels.npy", np.concatenate(labels).astype(np.int64))
+
+  # Publish the finished cache in one step (another process may have beaten us to it)
+  try:
+    os.replace(tmp_path, cache_path)
+  except OSError:
+    shutil.rmtree(tmp_path, ignore_errors=True)
+  return data_setup.FeatureDataset(cache_path)
+
+
+def _find_trainable_boundary(model: torch.nn.Module, X: torch.Tensor) -> Tuple[Optional[str], int]:
+  """Finds where the frozen prefix of a model ends by tracing one forward pass.
+
+  Records the order leaf modules run in and returns a tuple of (name of
+  the first one with trainable parameters, number of modules run before
+  it). The name is None if the model has no frozen prefix, no trainable
+  leaf module, or trainable parameters owned directly by a container
+  module (which code between module calls might use).
+  """
+  modules = dict(model.named_modules())
+  if any(param.requires_grad for module in modules.values() for param in module.parameters(recurse=False)
+         if list(module.children())):
+    return None, 0
+
+  order = []
+  handles = [module.register_forward_pre_hook(lambda module, args, name=name: order.append(name))
+             for name, module in modules.items() if not list(module.children())]
+  try:
+    with _preserve_model_state(model), torch.no_grad():
+      model(X)
+  finally:
+    for handle in handles:
+      handle.remove()
+
+  order = list(dict.fromkeys(order)) # first call of every module
+  for index, name in enumerate(order):
+    if any(param.requires_grad for param in modules[name].parameters()):
+      return (name, index) if index > 0 else (None, 0)
+  return None, 0
+
+
+def skip_frozen_prefix(model: torch.nn.Module, boundary: str) -> Callable[[], None]:
+  """Runs a model's frozen prefix without autograd.
+
+  Hooks turn gradient tracking off when model's forward pass starts and
+  back on (if it was on) when the boundary module (the first module with
+  trainable parameters, see _find_trainable_boundary) is called, and
+  restore it when the forward pass ends, even if it raises. The frozen
+  prefix then runs under torch.no_grad (torch.inference_mode would create
+  tensors the trainable layers can't save for backward).
+
+  Args:
+    model: A PyTorch model (not a DistributedDataParallel wrapper).
+    boundary: Name of the first trainable module, as in model.named_modules().
+
+  Returns:
+    A callable that removes the hooks again.
+  """
+  grad_enabled = []
+
+  def disable_grad(module, args):
+    grad_enabled.append(torch.is_grad_enabled())
+    torch.set_grad_enabled(False)
+
+  def enable_grad(module, args):
+    if grad_enabled:
+      torch.set_grad_enabled(grad_enabled[-1])
+
+  def restore_grad(module, args, output):
+    torch.set_grad_enabled(grad_enabled.pop())
+
+  handles = [model.register_forward_pre_hook(disable_grad),
+             model.get_submodule(boundary).register_forward_pre_hook(enable_grad),
+             model.register_forward_hook(restore_grad, always_call=True)]
+
+  def remove():
+    for handle in handles:
+      handle.remove()
+  return remove
+
+
+def _measure_step_with_saved_bytes(model: torch.nn.Module,
+                                   loss_fn: torch.nn.Module,
+                                   X: torch.Tensor,
+                                   y: torch.Tensor,
+                                   device: torch.device,
+                                   use_amp: bool=False) -> Tuple[float, int]:
+  """Returns (seconds per training step, bytes of tensors autograd saves for backward per step)."""
+  saved_bytes = 0
+
+  def pack(tensor: torch.Tensor) -> torch.Tensor:
+    nonlocal saved_bytes
+    saved_bytes += tensor.numel() * tensor.element_size()
+    return tensor
+
+  num_steps = 5
+  with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+    step_time = measure_step_time(model, loss_fn, X, y, device, num_steps=num_steps, use_amp=use_amp)
+  return step_time, saved_bytes // (num_steps + 1) # measure_step_time runs a warm-up step too
+
+
+def _compile_optimizer_step(optimizer: torch.optim.Optimizer,
+                            compile_mode: str) -> Callable[[], None]:
+  """Compiles optimizer.step, falling back to the eager step on failure.
+
+  Args:
+    optimizer: A PyTorch optimizer whose step should be compiled.
+    compile_mode: A torch.compile mode.
+
+  Returns:
+    A callable that performs one optimizer step.
+  """
+  step = {"fn": torch.compile(optimizer.step, mode=compile_mode)}
+
+  def step_fn():
+    try:
+      step["fn"]()
+    except Exception as e:
+      if step["fn"] == optimizer.step:
+        raise
+      print(f"[WARNING] Compiling optimizer.step failed, falling back to eager mode: {type(e).__name__}: {e}")
+      step["fn"] = optimizer.step
+      step["fn"]()
+
+  return step_fn
+
+
+def _create_profiler(profile_dir: str,
+                     schedule: Tuple[int, int, int],
+                     row_limit: int) -> torch.profiler.profile:
+  """Creates a torch.profiler.profile that profiles one window of steps.
+
+  When the window's active steps finish, a trace is written to profile_dir
+  (a Chrome trace JSON file that TensorBoard's profiler plugin also reads)
+  along with a table of the top operators by self time ("top_ops.txt").
+
+  Args:
+    profile_dir: A directory to write the trace and operator table to.
+    schedule: A tuple of (wait, warmup, active) numbers of steps.
+    row_limit: Number of operators to keep in the table.
+
+  Returns:
+    A torch.profiler.profile instance (not yet started).
+  """
+  wait, warmup, active = schedule
+  activities = [torch.profiler.ProfilerActivity.CPU]
+  if torch.cuda.is_available():
+    activities.append(torch.profiler.ProfilerActivity.CUDA)
+  sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+  trace_handler = torch.profiler.tensorboard_trace_handler(profile_dir)
+
+  def on_trace_ready(prof: torch.profiler.profile):
+    trace_handler(prof)
+    table = prof.key_averages().table(sort_by=sort_by, row_limit=row_limit)
+    with open(os.path.join(profile_dir, "top_ops.txt"), "w") as f:
+      f.write(table)
+    print(f"[INFO] Saved profiler trace and top {row_limit} operators to: {profile_dir}")
+    print(table)
+
+  return torch.profiler.profile(
+      activities=activities,
+      schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+      on_trace_ready=on_trace_ready,
+      record_shapes=True,
+      profile_memory=True
+  )
 
 
 def train(model: torch.nn.Module,
@@ -125,7 +808,26 @@ def train(model: torch.nn.Module,
           optimizer: torch.optim.Optimizer,
           loss_fn: torch.nn.Module,
           epochs: int,
-          device: torch.device) -> Dict[str, List[float]]:
+          device: torch.device,
+          log_interval: Optional[int]=None,
+          accumulation_steps: int=1,
+          use_amp: bool=False,
+          compile_mode: Optional[str]=None,
+          compile_step: bool=False,
+          checkpoint_dir: Optional[str]=None,
+          checkpoint_interval: Optional[int]=None,
+          resume_from: Optional[str]=None,
+          time_phases: bool=False,
+          profile_dir: Optional[str]=None,
+          profile_schedule: Tuple[int, int, int]=(1, 1, 5),
+          profile_row_limit: int=20,
+          prefetch_batches: int=0,
+          channels_last: bool=False,
+          train_batch_transform: Optional[Callable[[torch.Tensor], torch.Tensor]]=None,
+          test_batch_transform: Optional[Callable[[torch.Tensor], torch.Tensor]]=None,
+          feature_cache_dir: Optional[str]=None,
+          frozen_prefix_no_grad: bool=False,
+          exact_resume: bool=False) -> Dict[str, List[float]]:
   """Trains and tests a PyTorch model.
 
   Passes a target PyTorch models through train_step() and test_step()
@@ -134,6 +836,12 @@ def train(model: torch.nn.Module,
 
   Calculates, prints and stores evaluation metrics throughout.
 
+  For multi-process training (see ddp.py) pass a DistributedDataParallel
+  model and dataloaders from data_setup.create_dataloaders(distributed=True).
+  Metrics are then averaged over every process, the train sampler is told
+  the epoch so each one shuffles differently, and only rank 0 prints and
+  saves checkpoints.
+
   Args:
     model: A PyTorch model to be trained and tested.
     train_dataloader: A DataLoader instance for the model to be trained on.
@@ -142,6 +850,84 @@ def train(model: torch.nn.Module,
     loss_fn: A PyTorch loss function to calculate loss on both datasets.
     epochs: An integer indicating how many epochs to train for.
     device: A target device to compute on (e.g. "cuda" or "cpu").
+    log_interval: Optional number of batches between printing running
+      training metrics. Defaults to None (sync once per epoch).
+    accumulation_steps: Number of micro-batches each training batch is
+      split into before stepping the optimizer, e.g. a DataLoader with
+      batch_size=4096 and accumulation_steps=128 trains on batches of 4096
+      while only holding activations for 32 samples at a time.
+    use_amp: Whether to run training and testing forward passes under
+      bfloat16 autocast. Loss and optimizer state stay in fp32.
+    compile_mode: Optional torch.compile mode ("default", "reduce-overhead",
+      "max-autotune", ...). If set, the model is compiled and warmed up
+      before the first epoch, and the warm-up time is stored separately
+      from the epoch times. Falls back to eager mode if compiling fails.
+      Defaults to None (eager mode).
+    compile_step: Whether to also compile optimizer.step (only used when
+      compile_mode is set). Its compilation happens during the first epoch.
+    checkpoint_dir: Optional directory to save a full training checkpoint
+      ("checkpoint.pth") to at the end of every epoch. Checkpoints hold the
+      model and optimizer state, epoch and batch position, random number
+      generator states and the results so far, and are written atomically
+      from a background thread. Defaults to None (no checkpoints).
+    checkpoint_interval: Optional number of training batches between extra
+      mid-epoch checkpoints (requires checkpoint_dir).
+    resume_from: Optional path to a checkpoint to continue training from.
+      Given the same dataloaders and settings, training continues exactly
+      as if it hadn't been interrupted. Resuming mid-epoch seeks past the
+      batches before the checkpoint if the train sampler supports it (see
+      data_setup.SeekableSampler, whose state is saved in checkpoints),
+      and otherwise re-iterates (and discards) them. After a seek the
+      rest of the epoch sees the same samples in the same order, but
+      random transforms running in DataLoader workers draw different
+      random numbers than they would have (their random state isn't
+      replayed past the skipped batches); see exact_resume.
+    time_phases: Whether to record per-phase wall-clock time (see
+      train_step/test_step) and samples/sec for every epoch. Stored in the
+      results as e.g. "train_data_time", "train_forward_time",
+      "train_samples_per_sec" and "test_forward_time". Defaults to False.
+    profile_dir: Optional directory to profile a window of training steps
+      into with torch.profiler. A Chrome/TensorBoard trace and a table of
+      the top operators ("top_ops.txt") are written once the window ends.
+      Defaults to None (no profiling).
+    profile_schedule: Tuple of (wait, warmup, active) training steps for
+      the profiling window. Defaults to (1, 1, 5).
+    profile_row_limit: Number of operators in the top operator table.
+    prefetch_batches: Number of batches to load and copy to the device
+      ahead of time in a background thread (see data_setup.DevicePrefetcher).
+      Defaults to 0 (load batches in the training loop).
+    channels_last: Whether to convert the model and image batches to the
+      channels_last (NHWC) memory format, which oneDNN/cuDNN convolutions
+      are usually faster in. Defaults to False.
+    train_batch_transform: Optional callable applied to every training
+      batch once it's on the device, e.g. an nn.Sequential of
+      batch_transforms.py transforms. Lets the DataLoader only decode and
+      resize images (transforms.PILToTensor() gives uint8 batches) while
+      augmentation and normalization run as a few ops over the whole
+      batch. Defaults to None.
+    test_batch_transform: Optional callable applied to every testing batch
+      once it's on the device. Defaults to None.
+    feature_cache_dir: Optional directory to cache backbone features in.
+      For models whose only trainable part is a head (e.g. from
+      model_builder.create_effnetb2_model or create_vit_model), the frozen
+      backbone is run once over both datasets in eval mode (see
+      cache_features) and only the head is trained and tested, on the
+      cached features, every epoch. The dataloaders' batch sizes are kept
+      (and training still shuffles); their transforms should be
+      deterministic. Not supported in distributed runs. Defaults to None.
+    frozen_prefix_no_grad: Whether to run the frozen start of the model
+      (every module that runs before the first module with trainable
+      parameters, found by tracing a forward pass) without autograd, e.g.
+      the backbone of a feature extractor or the frozen blocks of a
+      partially unfrozen model (see skip_frozen_prefix). The tensors saved
+      for backward and the time per training step with and without it are
+      printed and stored as "frozen_prefix_saved_bytes" and
+      "frozen_prefix_step_time" ([without, with]). Defaults to False.
+    exact_resume: Whether to resume mid-epoch by re-iterating (and
+      discarding) the batches before the checkpoint even when the sampler
+      could seek past them. Slower, but random transforms in DataLoader
+      workers then continue bit for bit as in the interrupted run.
+      Defaults to False.
 
   Returns:
     A dictionary of training and testing loss as well as training and
@@ -156,40 +942,241 @@ def train(model: torch.nn.Module,
                   train_acc: [0.3945, 0.3945],
                   test_loss: [1.2641, 1.5706],
                   test_acc: [0.3400, 0.2973]}
+    Wall-clock seconds per epoch are stored under "epoch_time" and, when
+    compiling, the warm-up time under "compile_time".
   """
   # Create empty results dictionary
   results = {"train_loss": [],
       "train_acc": [],
       "test_loss": [],
-      "test_acc": []
+      "test_acc": [],
+      "epoch_time": []
   }
 
+  # Optionally switch convolutions to the NHWC memory format
+  if channels_last:
+      model.to(memory_format=torch.channels_last)
+
+  # Move batch transforms with buffers (e.g. normalization constants) to the device
+  for batch_transform in (train_batch_transform, test_batch_transform):
+      if isinstance(batch_transform, torch.nn.Module):
+          batch_transform.to(device)
+
+  # Optionally run the frozen backbone once and only train the head on its features
+  train_model = model
+  if feature_cache_dir is not None:
+      if ddp.is_distributed():
+          raise ValueError("feature_cache_dir isn't supported in distributed runs")
+      train_features = cache_features(model, train_dataloader, device, os.path.join(feature_cache_dir, "train"),
+                                      use_amp=use_amp, channels_last=channels_last, batch_transform=train_batch_transform)
+      test_features = cache_features(model, test_dataloader, device, os.path.join(feature_cache_dir, "test"),
+                                     use_amp=use_amp, channels_last=channels_last, batch_transform=test_batch_transform)
+      train_dataloader = torch.utils.data.DataLoader(train_features,
+                                                     batch_size=train_dataloader.batch_size,
+                                                     sampler=data_setup.SeekableSampler(train_features),
+                                                     pin_memory=torch.cuda.is_available())
+      test_dataloader = torch.utils.data.DataLoader(test_features,
+                                                    batch_size=test_dataloader.batch_size,
+                                                    pin_memory=torch.cuda.is_available())
+      train_model = getattr(model, _get_head_name(model))
+      channels_last, train_batch_transform, test_batch_transform = False, None, None
+
+  # Optionally run the frozen prefix of the model without autograd
+  remove_prefix_hooks = None
+  if frozen_prefix_no_grad:
+      hooked_model = train_model.module if isinstance(train_model, DistributedDataParallel) else train_model
+      with _preserve_model_state(hooked_model): # keep the random state fetching a batch changes
+          X, y = next(iter(test_dataloader))
+      micro_batch_size = max(1, len(y) // accumulation_steps)
+      X, y = _to_device(X[:micro_batch_size], device, channels_last, test_batch_transform), y[:micro_batch_size].to(device)
+      boundary, num_frozen = _find_trainable_boundary(hooked_model, X)
+      if boundary is None:
+          if ddp.is_main_process():
+              print("[INFO] No frozen prefix found, running the whole model with autograd")
+      else:
+          step_time, saved_bytes = _measure_step_with_saved_bytes(hooked_model, loss_fn, X, y, device, use_amp)
+          remove_prefix_hooks = skip_frozen_prefix(hooked_model, boundary)
+          prefix_step_time, prefix_saved_bytes = _measure_step_with_saved_bytes(hooked_model, loss_fn, X, y, device, use_amp)
+          results["frozen_prefix_step_time"] = [step_time, prefix_step_time]
+          results["frozen_prefix_saved_bytes"] = [saved_bytes, prefix_saved_bytes]
+          if ddp.is_main_process():
+              print(f"[INFO] Running {num_frozen} frozen modules (before {boundary}) without autograd | "
+                    f"saved for backward per micro-batch: {saved_bytes / 1024**2:.1f} -> {prefix_saved_bytes / 1024**2:.1f} MB | "
+                    f"step time: {step_time * 1000:.1f} -> {prefix_step_time * 1000:.1f} ms")
+
+  # Optionally stage batches on the device ahead of the training loop
+  if prefetch_batches > 0:
+      train_dataloader = data_setup.DevicePrefetcher(train_dataloader, device, prefetch_batches)
+      test_dataloader = data_setup.DevicePrefetcher(test_dataloader, device, prefetch_batches)
+
+  # Optionally restore the model, optimizer, results and random state from a checkpoint
+  start_epoch, resume_state, epoch_rng_state = 0, None, None
+  if resume_from is not None:
+      checkpoint = utils.load_checkpoint(resume_from)
+      model.load_state_dict(checkpoint["model"])
+      optimizer.load_state_dict(checkpoint["optimizer"])
+      results = checkpoint["results"]
+      start_epoch = checkpoint["epoch"]
+      # Shuffle the same way (the sampler's seed may have been drawn at random)
+      if checkpoint.get("sampler") is not None and hasattr(train_dataloader.sampler, "load_state_dict"):
+          train_dataloader.sampler.load_state_dict(checkpoint["sampler"])
+      if checkpoint["progress"] is not None:
+          # Replay the interrupted epoch from its starting random state
+          resume_state = dict(checkpoint["progress"], rng_state=checkpoint["rng_state"])
+          # The saved running sums are totals over all processes, so only
+          # rank 0 continues from them (the metrics are summed across ranks)
+          if not ddp.is_main_process():
+              resume_state["loss_sum"] = torch.zeros_like(resume_state["loss_sum"])
+              resume_state["correct"] = torch.zeros_like(resume_state["correct"])
+          epoch_rng_state = checkpoint["epoch_rng_state"]
+          utils.set_rng_state(epoch_rng_state)
+      else:
+          utils.set_rng_state(checkpoint["rng_state"])
+      if ddp.is_main_process():
+          print(f"[INFO] Resuming from {resume_from} at epoch {start_epoch+1}"
+                + (f", batch {resume_state['batch']+1}" if resume_state else ""))
+
+  # Write checkpoints from a background thread (on rank 0 only)
+  writer = None
+  if checkpoint_dir is not None and ddp.is_main_process():
+      writer = utils.CheckpointWriter()
+
+  def save_checkpoint(epoch: int, progress: Optional[Dict[str, Any]]):
+      writer.save(state={"model": model.state_dict(),
+                         "optimizer": optimizer.state_dict(),
+                         "epoch": epoch,
+                         "progress": progress,
+                         "results": results,
+                         "rng_state": utils.get_rng_state(),
+                         "epoch_rng_state": epoch_rng_state,
+                         "sampler": (train_dataloader.sampler.state_dict()
+                                     if hasattr(train_dataloader.sampler, "state_dict") else None)},
+                  path=os.path.join(checkpoint_dir, "checkpoint.pth"))
+
+  # Optionally compile the model (and optimizer step) before training
+  step_fn = None
+  if compile_mode is not None:
+      train_model, compile_time = _compile_model(model=train_model,
+                                           dataloader=test_dataloader,
+                                           loss_fn=loss_fn,
+                                           device=device,
+                                           compile_mode=compile_mode,
+                                           use_amp=use_amp,
+                                           channels_last=channels_last,
+                                           batch_transform=test_batch_transform)
+      results["compile_time"] = [compile_time]
+      if ddp.is_main_process():
+          print(f"[INFO] Compile/warm-up time (mode={compile_mode}): {compile_time:.2f}s")
+      if compile_step:
+          step_fn = _compile_optimizer_step(optimizer, compile_mode)
+
+  # Optionally profile a window of training steps
+  profiler = None
+  if profile_dir is not None:
+      profiler = _create_profiler(profile_dir=profile_dir,
+                                  schedule=profile_schedule,
+                                  row_limit=profile_row_limit)
+      profiler.start()
+
   # Loop through training and testing steps for a number of epochs
-  for epoch in tqdm(range(epochs)):
-      train_loss, train_acc = train_step(model=model,
+  try:
+    for epoch in tqdm(range(start_epoch, epochs), initial=start_epoch, total=epochs,
+                      disable=not ddp.is_main_process()):
+      start_time = time.perf_counter()
+
+      # Give distributed samplers (and streamed datasets) a different shuffle every epoch
+      if hasattr(train_dataloader.sampler, "set_epoch"):
+          train_dataloader.sampler.set_epoch(epoch)
+      if hasattr(train_dataloader.dataset, "set_epoch"):
+          train_dataloader.dataset.set_epoch(epoch)
+
+      # Remember the random state the epoch starts from (used to replay it
+      # when resuming from a mid-epoch checkpoint)
+      if resume_state is None:
+          epoch_rng_state = utils.get_rng_state()
+
+      def step_callback(progress: Dict[str, Any]):
+          if profiler is not None:
+              profiler.step()
+          if (checkpoint_dir is not None and checkpoint_interval
+              and progress["batch"] % checkpoint_interval == 0
+              and progress["batch"] < len(train_dataloader)):
+              # Only rank 0 writes checkpoints, so save the running sums of
+              # all processes (every process takes part in the all-reduce)
+              totals = ddp.all_reduce_sum(torch.stack([progress["loss_sum"].double(), progress["correct"].double()]))
+              if writer is not None:
+                  save_checkpoint(epoch=epoch, progress=dict(progress,
+                                                             loss_sum=totals[0].to(progress["loss_sum"].dtype),
+                                                             correct=totals[1].to(progress["correct"].dtype)))
+
+      train_timings = {} if time_phases else None
+      test_timings = {} if time_phases else None
+
+      train_loss, train_acc = train_step(model=train_model,
                                           dataloader=train_dataloader,
                                           loss_fn=loss_fn,
                                           optimizer=optimizer,
-                                          device=device)
-      test_loss, test_acc = test_step(model=model,
+                                          device=device,
+                                          log_interval=log_interval,
+                                          accumulation_steps=accumulation_steps,
+                                          use_amp=use_amp,
+                                          step_fn=step_fn,
+                                          resume_state=resume_state,
+                                          callback=step_callback,
+                                          timings=train_timings,
+                                          channels_last=channels_last,
+                                          batch_transform=train_batch_transform,
+                                          exact_resume=exact_resume)
+      resume_state = None
+      test_loss, test_acc = test_step(model=train_model,
           dataloader=test_dataloader,
           loss_fn=loss_fn,
-          device=device)
+          device=device,
+          use_amp=use_amp,
+          timings=test_timings,
+          channels_last=channels_last,
+          batch_transform=test_batch_transform)
+      epoch_time = time.perf_counter() - start_time
 
       # Print out what's happening
-      print(
-          f"Epoch: {epoch+1} | "
-          f"train_loss: {train_loss:.4f} | "
-          f"train_acc: {train_acc:.4f} | "
-          f"test_loss: {test_loss:.4f} | "
-          f"test_acc: {test_acc:.4f}"
-      )
+      if ddp.is_main_process():
+          print(
+              f"Epoch: {epoch+1} | "
+              f"train_loss: {train_loss:.4f} | "
+              f"train_acc: {train_acc:.4f} | "
+              f"test_loss: {test_loss:.4f} | "
+              f"test_acc: {test_acc:.4f} | "
+              f"epoch_time: {epoch_time:.2f}s"
+          )
+      if time_phases and ddp.is_main_process():
+          print("  train: " + " | ".join(f"{phase}: {seconds:.3f}s" for phase, seconds in train_timings.items() if phase != "samples_per_sec")
+                + f" | {train_timings['samples_per_sec']:.1f} samples/sec")
+          print("  test: " + " | ".join(f"{phase}: {seconds:.3f}s" for phase, seconds in test_timings.items() if phase != "samples_per_sec")
+                + f" | {test_timings['samples_per_sec']:.1f} samples/sec")
 
       # Update results dictionary
       results["train_loss"].append(train_loss)
       results["train_acc"].append(train_acc)
       results["test_loss"].append(test_loss)
       results["test_acc"].append(test_acc)
+      results["epoch_time"].append(epoch_time)
+      if time_phases:
+          for split, timings in (("train", train_timings), ("test", test_timings)):
+              for phase, value in timings.items():
+                  key = f"{split}_{phase}" if phase == "samples_per_sec" else f"{split}_{phase}_time"
+                  results.setdefault(key, []).append(value)
+
+      # Save a checkpoint at the end of every epoch
+      if writer is not None:
+          save_checkpoint(epoch=epoch + 1, progress=None)
+  finally:
+    if profiler is not None:
+      profiler.stop()
+    # Wait for any checkpoint still being written
+    if writer is not None:
+      writer.close()
+    if remove_prefix_hooks is not None:
+      remove_prefix_hooks()
 
   # Return the filled results at the end of the epochs
   return results
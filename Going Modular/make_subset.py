@@ -0,0 +1,49 @@
+"""
+Makes a subset manifest of an ImageFolder split instead of copying images.
+
+Randomly chooses --fraction of the images in --data_dir (of every class,
+unless --no_stratify) and optionally splits them into --num_folds folds,
+then saves the indices of the chosen images as a small .npz manifest (see
+data_setup.SubsetManifest). Pass the manifest to
+data_setup.create_dataloaders as train_subset/test_subset (with fold= to
+hold out a fold), or set TRAIN_SUBSET/TEST_SUBSET/FOLD in train.py.
+
+Example usage:
+  python make_subset.py --data_dir data/pizza_steak_sushi/train \
+    --fraction 0.2 --output data/pizza_steak_sushi/train_20_percent.npz
+  python make_subset.py --data_dir data/pizza_steak_sushi/train \
+    --num_folds 5 --output data/pizza_steak_sushi/train_5_fold.npz
+"""
+import argparse
+
+import numpy as np
+
+from torchvision import datasets
+
+import data_setup
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Save a random subset / k-fold split of an ImageFolder split as a manifest.")
+  parser.add_argument("--data_dir", required=True,
+                      help="ImageFolder style directory (e.g. data/pizza_steak_sushi/train) or split packed by pack_dataset.py.")
+  parser.add_argument("--output", required=True, help="Path to save the .npz manifest to.")
+  parser.add_argument("--fraction", type=float, default=1.0, help="Fraction of the images to choose.")
+  parser.add_argument("--num_folds", type=int, default=None, help="Optional number of folds to split the chosen images into.")
+  parser.add_argument("--no_stratify", action="store_true", help="Choose images regardless of their class.")
+  parser.add_argument("--seed", type=int, default=42)
+  args = parser.parse_args()
+
+  # Index the files the way create_dataloaders does (the manifest checks the order when applied)
+  if data_setup._is_packed(args.data_dir):
+    dataset = data_setup.PackedImageDataset(args.data_dir)
+  else:
+    dataset = datasets.ImageFolder(args.data_dir)
+  manifest = data_setup.SubsetManifest.sample(dataset,
+                                              fraction=args.fraction,
+                                              num_folds=args.num_folds,
+                                              stratified=not args.no_stratify,
+                                              seed=args.seed)
+  manifest.save(args.output)
+  class_counts = np.bincount(np.asarray(dataset.targets)[manifest.indices], minlength=len(dataset.classes))
+  print(f"[INFO] Saved {len(manifest.indices)} of {len(dataset)} images from {args.data_dir} to {args.output} "
+        f"({', '.join(f'{name}: {count}' for name, count in zip(dataset.classes, class_counts))})")
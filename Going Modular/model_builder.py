@@ -1,7 +1,9 @@
 """
 This contains PyTorch model code to instantial TinyVGG model
+and the EffNetB2/ViT-B/16 feature extractors.
 """
 import torch
+import torchvision
 from torch import nn
 
 class TinyVGG(nn.Module):
@@ -54,3 +56,94 @@ class TinyVGG(nn.Module):
       x = self.classifier(x)
       return x
       # return self.classifier(self.block_2(self.block_1(x))) # <- leverage the benefits of operator fusion
+
+
+def create_effnetb2_model(num_classes:int=3,
+                          seed:int=42):
+    """Creates an EfficientNetB2 feature extractor model and transforms.
+
+    Args:
+        num_classes (int, optional): number of classes in the classifier head.
+            Defaults to 3.
+        seed (int, optional): random seed value. Defaults to 42.
+
+    Returns:
+        model (torch.nn.Module): EffNetB2 feature extractor model.
+        transforms (torchvision.transforms): EffNetB2 image transforms.
+    """
+    # Create EffNetB2 pretrained weights, transforms and model
+    weights = torchvision.models.EfficientNet_B2_Weights.DEFAULT
+    transforms = weights.transforms()
+    model = torchvision.models.efficientnet_b2(weights=weights)
+
+    # Freeze all layers in base model
+    for param in model.parameters():
+        param.requires_grad = False
+
+    # Change classifier head with random seed for reproducibility
+    torch.manual_seed(seed)
+    model.classifier = nn.Sequential(
+        nn.Dropout(p=0.3, inplace=True),
+        nn.Linear(in_features=1408, out_features=num_classes),
+    )
+
+    return model, transforms
+
+
+def create_vit_model(num_classes:int=3,
+                     seed:int=42):
+    """Creates a ViT-B/16 feature extractor model and transforms.
+
+    Args:
+        num_classes (int, optional): number of target classes. Defaults to 3.
+        seed (int, optional): random seed value for output layer. Defaults to 42.
+
+    Returns:
+        model (torch.nn.Module): ViT-B/16 feature extractor model.
+        transforms (torchvision.transforms): ViT-B/16 image transforms.
+    """
+    # Create ViT_B_16 pretrained weights, transforms and model
+    weights = torchvision.models.ViT_B_16_Weights.DEFAULT
+    transforms = weights.transforms()
+    model = torchvision.models.vit_b_16(weights=weights)
+
+    # Freeze all layers in model
+    for param in model.parameters():
+        param.requires_grad = False
+
+    # Change classifier head to suit our needs (this will be trainable)
+    torch.manual_seed(seed)
+    model.heads = nn.Sequential(nn.Linear(in_features=768, # keep this the same as original model
+                                          out_features=num_classes)) # update to reflect target number of classes
+
+    return model, transforms
+
+
+def create_model(model_name: str,
+                 num_classes: int=3,
+                 hidden_units: int=10):
+    """Creates one of the models above by name along with its transforms.
+
+    Args:
+        model_name (str): one of "tinyvgg", "effnetb2" or "vit".
+        num_classes (int, optional): number of output classes. Defaults to 3.
+        hidden_units (int, optional): hidden units for TinyVGG. Defaults to 10.
+
+    Returns:
+        model (torch.nn.Module): the requested model.
+        transforms (torchvision.transforms): image transforms for the model.
+    """
+    if model_name == "tinyvgg":
+        model = TinyVGG(input_shape=3,
+                        hidden_units=hidden_units,
+                        output_shape=num_classes)
+        transforms = torchvision.transforms.Compose([
+            torchvision.transforms.Resize((64, 64)),
+            torchvision.transforms.ToTensor()
+        ])
+        return model, transforms
+    if model_name == "effnetb2":
+        return create_effnetb2_model(num_classes=num_classes)
+    if model_name == "vit":
+        return create_vit_model(num_classes=num_classes)
+    raise ValueError(f"Unknown model_name: {model_name}, expected 'tinyvgg', 'effnetb2' or 'vit'")
@@ -0,0 +1,135 @@
+"""
+Packs an ImageFolder dataset into a few large tar shards for fast loading.
+
+Walks source_dir/train and source_dir/test (each laid out as
+split/class_name/image.jpg), resizes every image so its shorter side is
+--size pixels, re-encodes it as JPEG in a pool of processes and appends
+the results to tar shards of about --shard_size_mb each:
+
+  output_dir/
+    train/
+      shard-00000.tar   # 00000000.jpg, 00000000.cls, 00000001.jpg, ...
+      shard-00001.tar
+      index.npz         # shard, byte offset, byte size, label and source path of every image
+      meta.json         # class names, number of images and shard file names
+    test/
+      ...
+
+Samples are shuffled (with --seed) before packing so every shard holds a
+mix of classes. Read the shards back with data_setup.PackedImageDataset
+(random access through the index), data_setup.TarShardStream (sequential
+reads with approximate shuffling) or data_setup.create_dataloaders, which
+picks packed splits up automatically (and streams them with stream=True).
+
+Example usage:
+  python pack_dataset.py --source_dir data/pizza_steak_sushi \
+    --output_dir data/pizza_steak_sushi_packed --size 256
+"""
+import argparse
+import io
+import json
+import os
+import random
+import tarfile
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from PIL import Image
+from torchvision import datasets
+
+
+def encode_image(path: str, size: int, quality: int) -> bytes:
+  """Loads an image, resizes its shorter side to size and returns JPEG bytes."""
+  with Image.open(path) as img:
+    img = img.convert("RGB")
+    scale = size / min(img.size)
+    if scale < 1: # only ever shrink images
+      img = img.resize((round(img.width * scale), round(img.height * scale)), Image.BILINEAR)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def _add_member(tar: tarfile.TarFile, name: str, data: bytes) -> int:
+  """Appends a file to tar and returns the byte offset of its data."""
+  info = tarfile.TarInfo(name=name)
+  info.size = len(data)
+  header_size = len(info.tobuf(tar.format, tar.encoding, tar.errors))
+  offset = tar.offset + header_size
+  tar.addfile(info, io.BytesIO(data))
+  return offset
+
+
+def pack_split(source_dir: Path,
+               output_dir: Path,
+               size: int,
+               quality: int,
+               shard_size: int,
+               num_processes: int,
+               seed: int):
+  """Packs one split (e.g. data/pizza_steak_sushi/train) into tar shards."""
+  classes, class_to_idx = datasets.folder.find_classes(str(source_dir))
+  samples = datasets.folder.make_dataset(str(source_dir), class_to_idx,
+                                         extensions=datasets.folder.IMG_EXTENSIONS)
+  random.Random(seed).shuffle(samples)
+  output_dir.mkdir(parents=True, exist_ok=True)
+
+  shard_ids = np.zeros(len(samples), dtype=np.int32)
+  offsets = np.zeros(len(samples), dtype=np.int64)
+  sizes = np.zeros(len(samples), dtype=np.int64)
+  labels = np.array([label for _, label in samples], dtype=np.int64)
+  # Paths relative to source_dir, so subset manifests can check which images they pick
+  relative_paths = np.array([Path(os.path.relpath(path, source_dir)).as_posix() for path, _ in samples])
+  shard_names, tar = [], None
+
+  encode = partial(encode_image, size=size, quality=quality)
+  with ProcessPoolExecutor(max_workers=num_processes) as executor:
+    paths = [path for path, _ in samples]
+    for index, data in enumerate(executor.map(encode, paths, chunksize=16)):
+      # Start a new shard once the current one is full
+      if tar is None or tar.offset >= shard_size:
+        if tar is not None:
+          tar.close()
+        shard_names.append(f"shard-{len(shard_names):05d}.tar")
+        tar = tarfile.open(output_dir / shard_names[-1], "w")
+
+      shard_ids[index] = len(shard_names) - 1
+      offsets[index] = _add_member(tar, f"{index:08d}.jpg", data)
+      sizes[index] = len(data)
+      _add_member(tar, f"{index:08d}.cls", str(labels[index]).encode())
+  if tar is not None:
+    tar.close()
+
+  np.savez(output_dir / "index.npz", shard=shard_ids, offset=offsets, size=sizes, label=labels, path=relative_paths)
+  with open(output_dir / "meta.json", "w") as f:
+    json.dump({"classes": classes,
+               "num_samples": len(samples),
+               "shards": shard_names,
+               "size": size,
+               "quality": quality}, f, indent=2)
+  print(f"[INFO] Packed {len(samples)} images from {source_dir} into {len(shard_names)} shard(s) in {output_dir}")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Pack ImageFolder train/test splits into tar shards.")
+  parser.add_argument("--source_dir", required=True, help="Directory containing train/ and test/ ImageFolder splits.")
+  parser.add_argument("--output_dir", required=True)
+  parser.add_argument("--splits", nargs="+", default=["train", "test"])
+  parser.add_argument("--size", type=int, default=256, help="Shorter side of the packed images in pixels.")
+  parser.add_argument("--quality", type=int, default=90, help="JPEG quality of the packed images.")
+  parser.add_argument("--shard_size_mb", type=int, default=256)
+  parser.add_argument("--num_processes", type=int, default=os.cpu_count())
+  parser.add_argument("--seed", type=int, default=42)
+  args = parser.parse_args()
+
+  for split in args.splits:
+    pack_split(source_dir=Path(args.source_dir) / split,
+               output_dir=Path(args.output_dir) / split,
+               size=args.size,
+               quality=args.quality,
+               shard_size=args.shard_size_mb * 1024 * 1024,
+               num_processes=args.num_processes,
+               seed=args.seed)
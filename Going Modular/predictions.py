@@ -0,0 +1,211 @@
+"""
+Contains functions for making and storing predictions with a trained
+PyTorch image classification model.
+"""
+import json
+import pathlib
+
+from functools import partial
+from timeit import default_timer as timer
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+import torchvision
+
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from tqdm.auto import tqdm
+
+import data_setup
+
+
+def pred_and_store(paths: List[pathlib.Path],
+                   model: torch.nn.Module,
+                   transform: torchvision.transforms,
+                   class_names: List[str],
+                   device: str="cuda" if torch.cuda.is_available() else "cpu") -> List[Dict]:
+  """Predicts on a list of images one at a time and stores the results.
+
+  Args:
+    paths: Image paths, laid out as .../class_name/image.jpg.
+    model: A trained PyTorch model.
+    transform: Transforms to turn a PIL image into the model's input.
+    class_names: Class names in the model's output order.
+    device: A target device to compute on (e.g. "cuda" or "cpu").
+
+  Returns:
+    A list with one dictionary per image: {"image_path": ...,
+    "class_name": ..., "pred_prob": ..., "pred_class": ...,
+    "time_for_pred": ..., "correct": ...}.
+  """
+  # Prepare model for inference by sending it to target device and turning on eval() mode
+  model.to(device)
+  model.eval()
+
+  pred_list = []
+  for path in tqdm(paths):
+    pred_dict = {}
+
+    # Get the sample path and ground truth class name
+    pred_dict["image_path"] = path
+    class_name = pathlib.Path(path).parent.stem
+    pred_dict["class_name"] = class_name
+
+    # Time the image loading, transforming and prediction
+    start_time = timer()
+    img = Image.open(path)
+    transformed_image = transform(img).unsqueeze(0).to(device)
+
+    # Get prediction probability, prediction label and prediction class
+    with torch.inference_mode():
+      pred_logit = model(transformed_image)
+      pred_prob = torch.softmax(pred_logit, dim=1)
+      pred_label = torch.argmax(pred_prob, dim=1)
+      pred_class = class_names[pred_label.cpu()]
+
+      # Make sure things in the dictionary are on CPU (required for inspecting predictions later on)
+      pred_dict["pred_prob"] = round(pred_prob.unsqueeze(0).max().cpu().item(), 4)
+      pred_dict["pred_class"] = pred_class
+
+      end_time = timer()
+      pred_dict["time_for_pred"] = round(end_time-start_time, 4)
+
+    # Does the pred match the true label?
+    pred_dict["correct"] = class_name == pred_class
+    pred_list.append(pred_dict)
+
+  return pred_list
+
+
+class _ImagePathDataset(Dataset):
+  """Loads and transforms images from a list of paths.
+
+  Returns (image, index, seconds spent loading and transforming the image).
+  """
+  def __init__(self, paths: List[pathlib.Path], transform: torchvision.transforms) -> None:
+    self.paths = [str(path) for path in paths]
+    self.transform = transform
+
+  def __len__(self) -> int:
+    return len(self.paths)
+
+  def __getitem__(self, index: int) -> Tuple[torch.Tensor, int, float]:
+    start_time = timer()
+    image = self.transform(data_setup.load_image(self.paths[index]))
+    return image, index, timer() - start_time
+
+
+def _collate_with_times(batch: List[Tuple[torch.Tensor, int, float]],
+                        collate_fn: Callable) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+  """Collates _ImagePathDataset samples with an (image, label) collate_fn plus their load times."""
+  X, indices = collate_fn([(image, index) for image, index, _ in batch])
+  return X, indices, torch.tensor([load_time for _, _, load_time in batch])
+
+
+def pred_and_store_batched(paths: List[pathlib.Path],
+                           model: torch.nn.Module,
+                           transform: torchvision.transforms,
+                           class_names: List[str],
+                           device: str="cuda" if torch.cuda.is_available() else "cpu",
+                           batch_size: int=64,
+                           num_workers: int=data_setup.NUM_WORKERS,
+                           output_path: Optional[str]=None,
+                           num_buckets: Optional[int]=None,
+                           pad_to_multiple: int=32) -> Optional[List[Dict]]:
+  """Predicts on batches of images loaded in parallel and stores the results.
+
+  Like pred_and_store(), but images are decoded and transformed by
+  num_workers DataLoader workers while the model predicts on batches of
+  batch_size images. Every image gets the same dictionary as with
+  pred_and_store(), where "time_for_pred" is the image's share of the
+  wall-clock time (waiting for its batch plus predicting on it, divided
+  by the batch size), plus a breakdown of its latency:
+    "load_time": seconds spent loading and transforming this image (in a
+      worker, overlapping with predictions on earlier batches),
+    "model_time": the image's share of the batch's prediction time.
+
+  With num_buckets, images are grouped into batches of similar aspect
+  ratio (see data_setup.AspectRatioBatchSampler) and padded to a common
+  size per batch (see data_setup.pad_collate). Use it with a transform
+  that keeps the aspect ratio, e.g.
+    transforms.Compose([data_setup.ResizeToArea(288 * 288),
+                        transforms.ToTensor(),
+                        transforms.Normalize(mean, std)])
+  so wide and tall images aren't cropped to a square. Without it,
+  transform has to produce images of one size.
+
+  Args:
+    paths: Image paths, laid out as .../class_name/image.jpg.
+    model: A trained PyTorch model.
+    transform: Transforms to turn a PIL image into the model's input.
+    class_names: Class names in the model's output order.
+    device: A target device to compute on (e.g. "cuda" or "cpu").
+    batch_size: Number of images per batch.
+    num_workers: Number of DataLoader workers to load images with.
+    output_path: Optional path of a JSON Lines file to write the results
+      to as every batch finishes, instead of keeping them all in memory.
+    num_buckets: Optional number of aspect ratio buckets to batch images
+      by. Defaults to None (batches in the order of paths).
+    pad_to_multiple: With num_buckets, the multiple to pad batch heights
+      and widths to.
+
+  Returns:
+    A list with one dictionary per image, in the order of paths, or None
+    if the results were written to output_path (in the order they were
+    predicted in).
+  """
+  model.to(device)
+  model.eval()
+
+  dataset = _ImagePathDataset(paths, transform)
+  if num_buckets:
+    sampler = data_setup.AspectRatioBatchSampler(data_setup.read_image_sizes(dataset.paths),
+                                                 batch_size=batch_size,
+                                                 num_buckets=num_buckets,
+                                                 shuffle=False)
+    collate_fn = partial(_collate_with_times,
+                         collate_fn=partial(data_setup.pad_collate, pad_to_multiple=pad_to_multiple))
+    dataloader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_fn,
+                            num_workers=num_workers, pin_memory=torch.cuda.is_available())
+  else:
+    dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers,
+                            pin_memory=torch.cuda.is_available())
+
+  pred_list = None if output_path else [None] * len(paths)
+  output_file = open(output_path, "w") if output_path else None
+  try:
+    with torch.inference_mode():
+      wait_start_time = timer()
+      for X, indices, load_times in tqdm(dataloader):
+        model_start_time = timer()
+        pred_probs = torch.softmax(model(X.to(device, non_blocking=True)), dim=1)
+        max_probs, pred_labels = pred_probs.max(dim=1)
+        # Copying to the CPU waits for the predictions
+        max_probs, pred_labels = max_probs.cpu().tolist(), pred_labels.cpu().tolist()
+        end_time = timer()
+
+        lines = []
+        for index, load_time, pred_prob, pred_label in zip(indices.tolist(), load_times.tolist(), max_probs, pred_labels):
+          class_name = pathlib.Path(paths[index]).parent.stem
+          pred_dict = {"image_path": paths[index],
+                       "class_name": class_name,
+                       "pred_prob": round(pred_prob, 4),
+                       "pred_class": class_names[pred_label],
+                       "time_for_pred": round((end_time - wait_start_time) / len(indices), 4),
+                       "correct": class_name == class_names[pred_label],
+                       "load_time": round(load_time, 4),
+                       "model_time": round((end_time - model_start_time) / len(indices), 4)}
+          if output_file is None:
+            pred_list[index] = pred_dict
+          else:
+            lines.append(json.dumps(pred_dict, default=str) + "\n")
+        if output_file is not None:
+          output_file.writelines(lines)
+          output_file.flush()
+        wait_start_time = timer()
+  finally:
+    if output_file is not None:
+      output_file.close()
+
+  return pred_list
+
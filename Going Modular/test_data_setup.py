@@ -0,0 +1,62 @@
+"""
+Tests for data_setup.py. Run with:
+  python -m pytest test_data_setup.py
+"""
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from PIL import Image
+from torch.utils.data import DataLoader
+from torchvision import datasets, transforms
+
+import data_setup
+import pack_dataset
+
+
+@pytest.fixture(scope="module")
+def source_dir(tmp_path_factory) -> Path:
+  """Writes 53 small random images (3 uneven classes) as an ImageFolder split."""
+  source_dir = tmp_path_factory.mktemp("images")
+  rng = np.random.default_rng(0)
+  for i in range(53):
+    class_dir = source_dir / f"class_{i % 3 if i < 45 else 0}"
+    class_dir.mkdir(exist_ok=True)
+    Image.fromarray(rng.integers(0, 256, (16, 16, 3), dtype=np.uint8)).save(class_dir / f"{i}.jpg")
+  return source_dir
+
+
+@pytest.fixture(scope="module")
+def packed_split(source_dir: Path, tmp_path_factory) -> Path:
+  """Packs source_dir into shards of different sizes."""
+  output_dir = tmp_path_factory.mktemp("packed") / "train"
+  pack_dataset.pack_split(source_dir, output_dir, size=16, quality=90, shard_size=4096, num_processes=1, seed=42)
+  return output_dir
+
+
+@pytest.mark.parametrize("num_workers", [0, 2, 3])
+@pytest.mark.parametrize("batch_size", [1, 4, 8])
+def test_tar_shard_stream_gives_ranks_equal_batches(packed_split: Path, num_workers: int, batch_size: int):
+  world_size = 2
+  for epoch in range(4):
+    batches_per_rank = []
+    for rank in range(world_size):
+      stream = data_setup.TarShardStream(packed_split, transform=transforms.ToTensor(), batch_size=batch_size)
+      stream.rank, stream.world_size = rank, world_size
+      stream.set_epoch(epoch)
+      dataloader = DataLoader(stream, batch_size=batch_size, num_workers=num_workers)
+      batches = list(dataloader)
+      assert all(len(y) == batch_size for _, y in batches)
+      assert sum(len(y) for _, y in batches) == len(stream)
+      batches_per_rank.append(len(batches))
+    assert batches_per_rank[0] == batches_per_rank[1], f"epoch {epoch}: {batches_per_rank}"
+
+
+def test_subset_manifest_refuses_a_packed_split_in_another_order(source_dir: Path, packed_split: Path):
+  manifest = data_setup.SubsetManifest.sample(datasets.ImageFolder(source_dir), fraction=0.5)
+  packed = data_setup.PackedImageDataset(packed_split)
+  with pytest.raises(ValueError):
+    manifest.apply(packed)
+  packed_manifest = data_setup.SubsetManifest.sample(packed, fraction=0.5)
+  assert len(packed_manifest.apply(packed)) == len(packed_manifest.indices)
@@ -1,9 +1,13 @@
 """
 Trains a PyTorch image classification model using device-agnostic code.
+
+Runs in a single process by default. For data-parallel training either set
+NUM_PROCESSES > 1 or launch with torchrun, e.g.
+  torchrun --nproc_per_node=4 train.py
 """
 import os
 import torch
-import data_setup, engine, model_builder, utils
+import batch_transforms, data_setup, ddp, engine, model_builder, utils
 
 from torchvision import transforms
 
@@ -12,50 +16,146 @@ NUM_EPOCHS = 5
 BATCH_SIZE = 32
 HIDDEN_UNITS = 10
 LEARNING_RATE = 0.001
+ACCUMULATION_STEPS = 1 # micro-batches per BATCH_SIZE batch (raise to fit bigger batches in memory)
+USE_AMP = False # run forward passes in bfloat16 autocast
+COMPILE_MODE = None # torch.compile mode, e.g. "default" or "max-autotune" (None = eager)
+COMPILE_STEP = False # also compile optimizer.step when COMPILE_MODE is set
+CHECKPOINT_DIR = "checkpoints" # full training state is saved here every epoch
+CHECKPOINT_INTERVAL = None # optional number of batches between mid-epoch checkpoints
+RESUME_FROM = None # e.g. "checkpoints/checkpoint.pth" to continue an interrupted run
+EXACT_RESUME = False # replay (not seek past) batches before a mid-epoch checkpoint, so worker augmentations resume exactly
+TIME_PHASES = False # print/store per-phase (data, forward, backward...) timings each epoch
+PROFILE_DIR = None # e.g. "profiles/tinyvgg" to save a torch.profiler trace of a few training steps
+NUM_PROCESSES = 1 # data-parallel processes to spawn (BATCH_SIZE is per process)
+PREFETCH_BATCHES = 0 # batches to load and copy to the device ahead of time in a background thread
+CHANNELS_LAST = False # train in the channels_last (NHWC) memory format
+CACHE_DIR = None # e.g. "data/cache" to decode and resize every image only once
+FAST_DECODE = False # decode JPEGs at reduced size (PIL draft mode) when they're resized down anyway
+MEMORY_CACHE_MB = 0 # e.g. 512 to keep decoded images in memory shared by all DataLoader workers (per split)
+STREAM_SHARDS = False # stream packed splits (see pack_dataset.py) shard by shard instead of random reads
+AUTOTUNE_DATALOADER = False # benchmark DataLoader workers/prefetching against the model's step time (cached per machine)
+BATCH_TRANSFORMS = False # load uint8 images and convert whole batches on the device (batch_transforms.py)
+TRAIN_SUBSET = None # e.g. "data/train_20_percent.npz", a data_setup.SubsetManifest choosing training images by index
+TEST_SUBSET = None # like TRAIN_SUBSET, for the test images
+FOLD = None # with a k-fold TRAIN_SUBSET, the fold to hold out and evaluate on (instead of the test images)
+
+
+def main():
+  # Setup directories
+  train_dir = "data/pizza_steak_sushi/train"
+  test_dir = "data/pizza_steak_sushi/test"
+
+  # Setup target device (joining the process group in distributed runs)
+  distributed = ddp.is_launched()
+  if distributed:
+    device = ddp.setup()
+  else:
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+  # Create transforms
+  data_transform = transforms.Compose([
+    transforms.Resize((64, 64)),
+    transforms.ToTensor()
+  ])
+  batch_transform = None
+  if BATCH_TRANSFORMS:
+    # Workers only decode and resize; ToTensor's scaling happens per batch
+    data_transform = transforms.Compose([
+      transforms.Resize((64, 64)),
+      transforms.PILToTensor()
+    ])
+    batch_transform = batch_transforms.ToFloat()
+
+  # Create model with help from model_builder.py
+  class_names = data_setup.get_class_names(train_dir)
+  model = model_builder.TinyVGG(
+      input_shape=3,
+      hidden_units=HIDDEN_UNITS,
+      output_shape=len(class_names)
+  ).to(device)
+  if distributed:
+    model = torch.nn.parallel.DistributedDataParallel(model)
+
+  # Set loss and optimizer
+  loss_fn = torch.nn.CrossEntropyLoss()
+  optimizer = torch.optim.Adam(model.parameters(),
+                               lr=LEARNING_RATE)
+
+  # Optionally time a training step for the DataLoader settings to keep up with
+  step_time = None
+  if AUTOTUNE_DATALOADER:
+    micro_batch_size = BATCH_SIZE // ACCUMULATION_STEPS
+    step_time = ACCUMULATION_STEPS * engine.measure_step_time(
+        model=model,
+        loss_fn=loss_fn,
+        X=torch.rand(micro_batch_size, 3, 64, 64),
+        y=torch.zeros(micro_batch_size, dtype=torch.long),
+        device=device,
+        use_amp=USE_AMP
+    )
+
+  # Create DataLoaders with help from data_setup.py
+  train_dataloader, test_dataloader, _ = data_setup.create_dataloaders(
+      train_dir=train_dir,
+      test_dir=test_dir,
+      transform=data_transform,
+      batch_size=BATCH_SIZE,
+      num_workers="auto" if AUTOTUNE_DATALOADER else max(1, data_setup.NUM_WORKERS // ddp.get_world_size()),
+      distributed=distributed,
+      cache_dir=CACHE_DIR,
+      fast_decode=FAST_DECODE,
+      stream=STREAM_SHARDS,
+      memory_cache_bytes=MEMORY_CACHE_MB * 1024 * 1024,
+      step_time=step_time,
+      train_subset=TRAIN_SUBSET,
+      test_subset=TEST_SUBSET,
+      fold=FOLD
+  )
+
+  # Start training with help from engine.py
+  engine.train(model=model,
+               train_dataloader=train_dataloader,
+               test_dataloader=test_dataloader,
+               loss_fn=loss_fn,
+               optimizer=optimizer,
+               epochs=NUM_EPOCHS,
+               device=device,
+               accumulation_steps=ACCUMULATION_STEPS,
+               use_amp=USE_AMP,
+               compile_mode=COMPILE_MODE,
+               compile_step=COMPILE_STEP,
+               checkpoint_dir=CHECKPOINT_DIR,
+               checkpoint_interval=CHECKPOINT_INTERVAL,
+               resume_from=RESUME_FROM,
+               exact_resume=EXACT_RESUME,
+               time_phases=TIME_PHASES,
+               profile_dir=PROFILE_DIR,
+               prefetch_batches=PREFETCH_BATCHES,
+               channels_last=CHANNELS_LAST,
+               train_batch_transform=batch_transform,
+               test_batch_transform=batch_transform)
+
+  if MEMORY_CACHE_MB and ddp.is_main_process():
+    for split, dataloader in (("train", train_dataloader), ("test", test_dataloader)):
+      # Look through subsets (TRAIN_SUBSET/TEST_SUBSET/FOLD) to the cached dataset
+      dataset = dataloader.dataset
+      while isinstance(dataset, data_setup.VirtualSubset):
+        dataset = dataset.dataset
+      if getattr(dataset, "cache", None) is None:
+        continue
+      stats = dataset.cache.stats()
+      print(f"[INFO] {split} memory cache: {stats['hit_rate']:.1%} hit rate, "
+            f"{stats['cached_bytes'] / 1024**2:.1f}/{stats['capacity_bytes'] / 1024**2:.1f} MB used")
+
+  # Save the model with help from utils.py (on rank 0 only)
+  utils.save_model(model=model,
+                   target_dir="models",
+                   model_name="05_going_modular_script_mode_tinyvgg_model.pth")
+  ddp.cleanup()
+
 
-# Setup directories
-train_dir = "data/pizza_steak_sushi/train"
-test_dir = "data/pizza_steak_sushi/test"
-
-# Setup target device
-device = "cuda" if torch.cuda.is_available() else "cpu"
-
-# Create transforms
-data_transform = transforms.Compose([
-  transforms.Resize((64, 64)),
-  transforms.ToTensor()
-])
-
-# Create DataLoaders with help from data_setup.py
-train_dataloader, test_dataloader, class_names = data_setup.create_dataloaders(
-    train_dir=train_dir,
-    test_dir=test_dir,
-    transform=data_transform,
-    batch_size=BATCH_SIZE
-)
-
-# Create model with help from model_builder.py
-model = model_builder.TinyVGG(
-    input_shape=3,
-    hidden_units=HIDDEN_UNITS,
-    output_shape=len(class_names)
-).to(device)
-
-# Set loss and optimizer
-loss_fn = torch.nn.CrossEntropyLoss()
-optimizer = torch.optim.Adam(model.parameters(),
-                             lr=LEARNING_RATE)
-
-# Start training with help from engine.py
-engine.train(model=model,
-             train_dataloader=train_dataloader,
-             test_dataloader=test_dataloader,
-             loss_fn=loss_fn,
-             optimizer=optimizer,
-             epochs=NUM_EPOCHS,
-             device=device)
-
-# Save the model with help from utils.py
-utils.save_model(model=model,
-                 target_dir="models",
-                 model_name="05_going_modular_script_mode_tinyvgg_model.pth")
+if __name__ == "__main__":
+  if NUM_PROCESSES > 1 and not ddp.is_launched():
+    ddp.spawn(main, NUM_PROCESSES)
+  else:
+    main()
@@ -1,12 +1,28 @@
+"""
+Contains various utility functions for PyTorch model saving, checkpointing
+and random state handling.
+"""
+import os
+import queue
+import random
+import threading
 
 from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
 import torch
 
+import ddp
+
 def save_model(model: torch.nn.Module,
                target_dir: str,
                model_name: str):
   """Saves a PyTorch model to a target directory.
 
+  In distributed runs only rank 0 saves, and a DistributedDataParallel
+  model is unwrapped so the saved state_dict loads into a plain model.
+
   Args:
     model: A target PyTorch model to save.
     target_dir: A directory for saving the model to.
@@ -18,6 +34,12 @@ def save_model(model: torch.nn.Module,
                target_dir="models",
                model_name="05_going_modular_tingvgg_model.pth")
   """
+  # Only save once per distributed run
+  if not ddp.is_main_process():
+    return
+  if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+    model = model.module
+
   # Create target directory
   target_dir_path = Path(target_dir)
   target_dir_path.mkdir(parents=True,
@@ -31,3 +53,123 @@ def save_model(model: torch.nn.Module,
   print(f"[INFO] Saving model to: {model_save_path}")
   torch.save(obj=model.state_dict(),
              f=model_save_path)
+
+
+def get_rng_state() -> Dict[str, Any]:
+  """Returns the state of every random number generator used in training.
+
+  Covers Python's random module, NumPy's global generator, torch's CPU
+  generator and (if available) every CUDA generator.
+  """
+  return {"python": random.getstate(),
+          "numpy": np.random.get_state(),
+          "torch": torch.get_rng_state(),
+          "cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}
+
+
+def set_rng_state(state: Dict[str, Any]):
+  """Restores random number generator states returned by get_rng_state()."""
+  random.setstate(state["python"])
+  np.random.set_state(state["numpy"])
+  torch.set_rng_state(state["torch"])
+  if state["cuda"] is not None and torch.cuda.is_available():
+    torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def _to_cpu(obj: Any) -> Any:
+  """Recursively copies every tensor in obj to CPU memory.
+
+  The copy is a snapshot, so training can keep updating the original
+  tensors in place while the copy is written to disk.
+  """
+  if isinstance(obj, torch.Tensor):
+    return obj.detach().to("cpu", copy=True)
+  if isinstance(obj, dict):
+    return {key: _to_cpu(value) for key, value in obj.items()}
+  if isinstance(obj, (list, tuple)):
+    return type(obj)(_to_cpu(value) for value in obj)
+  return obj
+
+
+def save_checkpoint(state: Dict[str, Any],
+                    path: str):
+  """Atomically saves a checkpoint dictionary to path.
+
+  The checkpoint is written to a temporary file in the same directory,
+  flushed to disk and then renamed over path, so path always holds either
+  the previous or the new complete checkpoint.
+
+  Args:
+    state: A dictionary of checkpoint state (tensors, numbers, lists...).
+    path: A file path to save the checkpoint to.
+  """
+  path = Path(path)
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp_path = path.with_name(path.name + ".tmp")
+  with open(tmp_path, "wb") as f:
+    torch.save(obj=state, f=f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+  """Loads a checkpoint saved with save_checkpoint() onto the CPU.
+
+  Args:
+    path: A file path to a checkpoint.
+
+  Returns:
+    The checkpoint dictionary.
+  """
+  # Checkpoints hold Python/NumPy RNG states, so they can't be loaded with weights_only
+  return torch.load(f=path, map_location="cpu", weights_only=False)
+
+
+class CheckpointWriter:
+  """Saves checkpoints from a background thread.
+
+  save() copies the state to CPU memory on the calling thread and returns
+  straight away; a worker thread then writes it with save_checkpoint().
+  At most one checkpoint waits behind the one being written, after which
+  save() blocks rather than piling up snapshots in memory.
+
+  Example usage:
+    writer = CheckpointWriter()
+    writer.save(state={"model": model.state_dict()},
+                path="checkpoints/checkpoint.pth")
+    writer.close() # waits for pending writes
+  """
+  def __init__(self) -> None:
+    self._queue = queue.Queue(maxsize=1)
+    self._error: Optional[BaseException] = None
+    self._thread = threading.Thread(target=self._run, daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        return
+      state, path = item
+      try:
+        save_checkpoint(state=state, path=path)
+      except BaseException as e:
+        self._error = e
+
+  def _raise_error(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise RuntimeError("Writing a checkpoint failed") from error
+
+  def save(self, state: Dict[str, Any], path: str):
+    """Snapshots state and queues it to be written to path."""
+    self._raise_error()
+    self._queue.put((_to_cpu(state), path))
+
+  def close(self):
+    """Waits for queued checkpoints to be written and stops the thread."""
+    if self._thread.is_alive():
+      self._queue.put(None)
+      self._thread.join()
+    self._raise_error()
@@ -3,7 +3,7 @@ import gradio as gr
 import os
 import torch
 
-from model import create_effnetb2_model
+from model import create_effnetb2_model, to_memory_format
 from timeit import default_timer as timer
 from typing import Tuple, Dict
 
@@ -26,6 +26,9 @@ effnetb2.load_state_dict(
     )
 )
 
+# Optionally store weights in channels_last (NHWC) memory format (see model.USE_CHANNELS_LAST)
+effnetb2 = to_memory_format(effnetb2)
+
 ### 3. Predict function ###
 
 # Create predict function
@@ -36,7 +39,7 @@ def predict(img) -> Tuple[Dict, float]:
     start_time = timer()
     
     # Transform the target image and add a batch dimension
-    img = effnetb2_transforms(img).unsqueeze(0)
+    img = to_memory_format(effnetb2_transforms(img).unsqueeze(0))
     
     # Put model into evaluation mode and turn on inference mode
     effnetb2.eval()
@@ -1,8 +1,13 @@
+import os
 import torch
 import torchvision
 
 from torch import nn
 
+# Set USE_CHANNELS_LAST=1 to run the model in channels_last (NHWC) memory format. Whether that's faster
+# depends on the model and CPU, so measure first (see Going Modular/benchmark_channels_last.py)
+USE_CHANNELS_LAST = os.environ.get("USE_CHANNELS_LAST", "0") == "1"
+
 
 def create_effnetb2_model(num_classes:int=3, 
                           seed:int=42):
@@ -34,3 +39,10 @@ def create_effnetb2_model(num_classes:int=3,
     )
     
     return model, transforms
+
+
+def to_memory_format(x):
+    """Converts a model or 4D image batch to channels_last if USE_CHANNELS_LAST is set (else returns it as is)."""
+    if USE_CHANNELS_LAST:
+        return x.to(memory_format=torch.channels_last)
+    return x